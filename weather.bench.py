@@ -0,0 +1,475 @@
+#!/usr/bin/python3
+# vim set noexpandtab copyindent preserveindent softtabstop=0 shiftwidth=4 tabstop=4
+##############################################################################
+# Benchmarks for weather.py
+#
+#   --startup   Time how long python takes to load weather.py and fail if it
+#               is over the startup budget, or if any of the heavy modules
+#               got imported at load time.
+#   --cli       Time complete weather.py runs (single station, --forecast,
+#               --hourly and --stations N stations at once) against a local
+#               stand-in for api.weather.gov, with a cold and a warm cache,
+#               and report the peak RSS of each run.
+#   --functions Time get_wx_emoji(), get_sunrise_sunset(), clean_timestamp()
+#               and display_weather_data() inside one interpreter, first call
+#               and steady state, plus the peak memory the first call needs.
+#   --memory    Hold --memory N (default 10000) stations' observations the
+#               way the daemon and exporter do, as the decoded GeoJSON and as
+#               weather.py's compact Observation records, and report the
+#               bytes each station costs with either.
+#   --serve     Just run the stand-in API so weather.py can be pointed at it
+#               by hand with WEATHER_API_URL.
+#
+# The stand-in serves the responses in weather.bench.fixtures/ for any
+# station (the grid data's forecast times are moved to start the day before
+# the run), and can add --latency to every response and fail --error-rate of
+# them with a 503 so the retry path gets measured too.
+#
+# Results are printed as json so runs can be compared between releases.
+##############################################################################
+import sys,os,argparse
+import json
+import subprocess
+import statistics
+import time
+import threading
+import random
+import re
+import tempfile
+import datetime
+
+#############################################################################
+# Settings
+#############################################################################
+ME = os.path.basename(sys.argv[0])
+WEATHER_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weather.py')
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weather.bench.fixtures')
+
+# Milliseconds loading weather.py may take, measured inside the interpreter.
+# A script run as __main__ is compiled from source every time, so the load
+# is done the same way and the budget includes compiling.
+STARTUP_BUDGET_MS = 50
+# None of these should be imported just by loading weather.py
+HEAVY_MODULES = ['requests', 'urllib3', 'ephem', 'dateutil', 'sqlite3', 'zoneinfo',
+                 'shutil', 'argparse', 'concurrent.futures', 'socketserver', 'email.utils']
+
+# Compiles and runs weather.py the way the interpreter does for a script,
+# but under a module name so main() does not run, and reports how long that
+# took plus which heavy modules came along with it (site hooks may already
+# have imported some of them, those don't count against weather.py)
+LOAD_SNIPPET = """
+import time
+start = time.perf_counter()
+import sys, types
+already = set(sys.modules)
+weather = types.ModuleType('weather')
+weather.__file__ = {!r}
+sys.modules['weather'] = weather
+with open(weather.__file__, 'rb') as f:
+    exec(compile(f.read(), weather.__file__, 'exec'), weather.__dict__)
+elapsed = (time.perf_counter() - start) * 1000
+print(elapsed, ' ' . join(m for m in {!r} if m in sys.modules and m not in already))
+""" . format(WEATHER_PY, HEAVY_MODULES)
+
+# Stand-in API routes, first match wins.  The fixtures are for KEWR,
+# station routes get that swapped for the station asked for.
+FIXTURE_ROUTES = [
+    (r'^/stations/([^/]+)/observations/latest$', 'observation_latest.json'),
+    (r'^/stations/([^/]+)$', 'station.json'),
+    (r'^/stations$', 'stations.json'),
+    (r'^/points/[^/]+$', 'points.json'),
+    (r'^/gridpoints/[^/]+/[^/]+/forecast$', 'forecast.json'),
+    (r'^/gridpoints/[^/]+/[^/]+$', 'gridpoint.json'),
+]
+# Fixtures whose dates are moved so they start the day before the run,
+# otherwise --hourly finds nothing at the current time once they are old
+FIXTURE_DATED = ['gridpoint.json']
+FIXTURE_STATION = b'KEWR'
+FIXTURE_API_URL = b'https://api.weather.gov'
+# Seed for --error-rate so two runs fail the same requests
+ERROR_SEED = 1
+
+# Arguments for each --cli scenario, many gets --stations made up IDs
+CLI_SCENARIOS = [
+    ('single', ['--allvalues', '--icon', 'KEWR']),
+    ('forecast', ['--forecast', 'KEWR']),
+    ('hourly', ['--hourly', 'KEWR']),
+    ('many', ['--allvalues', '--script']),
+]
+# Target seconds of calls per --functions measurement
+FUNCTION_MIN_TIME = 0.2
+# Stations held by --memory
+MEMORY_STATIONS = 10000
+
+#############################################################################
+# Startup budget check -- the budget applies to the in-process load time,
+# the wall clock numbers against a bare interpreter are for reference
+#############################################################################
+def bench_startup(runs, budget_ms):
+    load_times = []
+    wall_times = []
+    base_times = []
+    heavy = set()
+    for run in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        base_times.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', LOAD_SNIPPET], check=True, capture_output=True, text=True)
+        wall_times.append((time.perf_counter() - start) * 1000)
+        fields = result.stdout.split()
+        load_times.append(float(fields[0]))
+        heavy.update(fields[1:])
+
+    load_ms = statistics.median(load_times)
+    return({'bench': 'startup', 'runs': runs,
+            'load_ms': round(load_ms, 2),
+            'budget_ms': budget_ms,
+            'interpreter_wall_ms': round(statistics.median(base_times), 2),
+            'load_wall_ms': round(statistics.median(wall_times), 2),
+            'heavy_modules_loaded': sorted(heavy),
+            'ok': load_ms <= budget_ms and not heavy})
+
+#############################################################################
+# Move every date in a fixture by the same number of days so the earliest
+# falls on first_day
+#############################################################################
+def shift_fixture_dates(body, first_day):
+    pattern = re.compile(rb'(\d{4}-\d\d-\d\d)(?=T\d\d:)')
+    earliest = min(datetime.date.fromisoformat(date.decode('ascii')) for date in pattern.findall(body))
+    shift = first_day - earliest
+
+    def moved(match):
+        date = datetime.date.fromisoformat(match.group(1).decode('ascii')) + shift
+        return(date.isoformat().encode('ascii'))
+
+    return(pattern.sub(moved, body))
+
+#############################################################################
+# Stand-in API -- returns (server, base url), the server runs in a daemon
+# thread until shutdown().  server.stats counts requests and injected errors.
+#############################################################################
+def start_api_server(fixtures_dir, latency_ms=0, error_rate=0, port=0):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    fixtures = {}
+    for pattern, name in FIXTURE_ROUTES:
+        with open(os.path.join(fixtures_dir, name), 'rb') as f:
+            fixtures[name] = f.read()
+        if name in FIXTURE_DATED:
+            yesterday = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=1)
+            fixtures[name] = shift_fixture_dates(fixtures[name], yesterday)
+    routes = [(re.compile(pattern), name) for pattern, name in FIXTURE_ROUTES]
+    errors = random.Random(ERROR_SEED)
+    lock = threading.Lock()
+    stats = {'requests': 0, 'errors_injected': 0, 'not_found': 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status, body, content_type='application/geo+json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'public, max-age=60')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            with lock:
+                stats['requests'] += 1
+                fail = error_rate > 0 and errors.random() < error_rate
+                if fail:
+                    stats['errors_injected'] += 1
+            if latency_ms:
+                time.sleep(latency_ms / 1000)
+            if fail:
+                problem = {'type': 'https://api.weather.gov/problems/UnexpectedProblem', 'title': 'Unexpected Problem',
+                           'status': 503, 'detail': 'Injected by weather.bench.py'}
+                self.send_body(503, json.dumps(problem).encode('utf-8'), 'application/problem+json')
+                return
+            for route, name in routes:
+                match = route.match(path)
+                if match is None:
+                    continue
+                body = fixtures[name].replace(FIXTURE_API_URL, server.base_url.encode('utf-8'))
+                if match.groups():
+                    body = body.replace(FIXTURE_STATION, match.group(1).encode('utf-8'))
+                self.send_body(200, body)
+                return
+            with lock:
+                stats['not_found'] += 1
+            self.send_body(404, b'{"status": 404, "title": "Not Found"}', 'application/problem+json')
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.base_url = 'http://127.0.0.1:{}' . format(server.server_address[1])
+    server.stats = stats
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return(server, server.base_url)
+
+#############################################################################
+# Environment that keeps weather.py's cache, history and daemon socket under
+# root and sends its requests to the stand-in
+#############################################################################
+def bench_environ(base_url, root):
+    env = dict(os.environ)
+    env['WEATHER_API_URL'] = base_url
+    for name in ('XDG_CACHE_HOME', 'XDG_DATA_HOME', 'XDG_RUNTIME_DIR'):
+        env[name] = os.path.join(root, name.lower())
+        os.makedirs(env[name], exist_ok=True)
+    return(env)
+
+#############################################################################
+# Run weather.py once, returns (milliseconds, peak RSS in KB, exit status)
+#############################################################################
+def run_cli(argv, env):
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, WEATHER_PY] + argv, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pid, status, usage = os.wait4(proc.pid, 0)
+    elapsed = (time.perf_counter() - start) * 1000
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return(elapsed, usage.ru_maxrss, proc.returncode)
+
+#############################################################################
+# End to end runs -- cold runs get an empty cache directory each time, warm
+# runs share one that a first untimed run filled
+#############################################################################
+def bench_cli(runs, stations, latency_ms, error_rate, fixtures_dir):
+    results = []
+    server, base_url = start_api_server(fixtures_dir, latency_ms, error_rate)
+    try:
+        with tempfile.TemporaryDirectory(prefix='weather.bench.') as tmp:
+            for scenario, argv in CLI_SCENARIOS:
+                if scenario == 'many':
+                    argv = argv + ['K{:03d}' . format(n) for n in range(stations)]
+                for cache in ('cold', 'warm'):
+                    if cache == 'warm':
+                        env = bench_environ(base_url, os.path.join(tmp, scenario))
+                        run_cli(argv, env)
+                    times = []
+                    rss = []
+                    failures = 0
+                    requests_before = server.stats['requests']
+                    for run in range(runs):
+                        if cache == 'cold':
+                            env = bench_environ(base_url, os.path.join(tmp, '{}-{}' . format(scenario, run)))
+                        elapsed, maxrss, status = run_cli(argv, env)
+                        times.append(elapsed)
+                        rss.append(maxrss)
+                        if status != 0:
+                            failures += 1
+                    results.append({'bench': 'cli', 'scenario': scenario, 'cache': cache, 'runs': runs,
+                                    'stations': stations if scenario == 'many' else 1,
+                                    'latency_ms': latency_ms, 'error_rate': error_rate,
+                                    'median_ms': round(statistics.median(times), 2),
+                                    'min_ms': round(min(times), 2), 'max_ms': round(max(times), 2),
+                                    'peak_rss_kb': max(rss),
+                                    'requests_per_run': round((server.stats['requests'] - requests_before) / runs, 2),
+                                    'failures': failures,
+                                    'ok': failures == 0 or error_rate > 0})
+    finally:
+        server.shutdown()
+    return(results)
+
+#############################################################################
+# Per-function costs.  weather.py is loaded into this interpreter pointed at
+# the stand-in, "first" times a call with weather.py's lru caches emptied
+# (what one CLI run pays), "steady" the per-call cost once they are filled.
+#############################################################################
+def load_weather(env):
+    import importlib.util
+    os.environ.update(env)
+    spec = importlib.util.spec_from_file_location('weather', WEATHER_PY)
+    weather = importlib.util.module_from_spec(spec)
+    sys.modules['weather'] = weather
+    spec.loader.exec_module(weather)
+    return(weather)
+
+def clear_caches(weather):
+    for value in list(weather.__dict__.values()):
+        if hasattr(value, 'cache_clear'):
+            value.cache_clear()
+
+def time_calls(function):
+    # Enough calls to fill FUNCTION_MIN_TIME, best of 5 rounds
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for call in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= FUNCTION_MIN_TIME / 5:
+            break
+        number *= 10
+    best = elapsed
+    for repeat in range(4):
+        start = time.perf_counter()
+        for call in range(number):
+            function()
+        best = min(best, time.perf_counter() - start)
+    return(best / number)
+
+def bench_functions(runs, latency_ms, error_rate, fixtures_dir):
+    import contextlib
+    import tracemalloc
+
+    results = []
+    server, base_url = start_api_server(fixtures_dir, latency_ms, error_rate)
+    try:
+        with tempfile.TemporaryDirectory(prefix='weather.bench.') as tmp:
+            weather = load_weather(bench_environ(base_url, tmp))
+            station_id = 'KEWR'
+            observation = weather.fetch_weather_data(station_id)
+            stationID,stationName,stationLON,stationLAT = observation[0]
+            properties = observation[1]['properties']
+            options = weather.build_display_options(weather.build_parser().parse_args(['--allvalues', '--icon', station_id]))
+
+            with open(os.devnull, 'w') as devnull:
+                functions = [
+                    ('get_wx_emoji', lambda: weather.get_wx_emoji(properties['textDescription'], 'day')),
+                    ('get_sunrise_sunset', lambda: weather.get_sunrise_sunset(stationLAT, stationLON)),
+                    ('clean_timestamp', lambda: weather.clean_timestamp(properties['timestamp'])),
+                    ('display_weather_data', lambda: weather.display_weather_data(station_id, options, observation)),
+                ]
+                with contextlib.redirect_stdout(devnull):
+                    for name, function in functions:
+                        first_times = []
+                        for run in range(runs):
+                            clear_caches(weather)
+                            start = time.perf_counter()
+                            function()
+                            first_times.append(time.perf_counter() - start)
+
+                        clear_caches(weather)
+                        tracemalloc.start()
+                        function()
+                        first_peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.reset_peak()
+                        function()
+                        steady_peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+
+                        steady = time_calls(function)
+                        results.append({'bench': 'function', 'function': name, 'runs': runs,
+                                        'first_call_us': round(statistics.median(first_times) * 1e6, 2),
+                                        'steady_call_us': round(steady * 1e6, 3),
+                                        'first_call_peak_kb': round(first_peak / 1024, 1),
+                                        'steady_call_peak_kb': round(steady_peak / 1024, 1),
+                                        'ok': True})
+    finally:
+        server.shutdown()
+    return(results)
+
+#############################################################################
+# Memory held per station.  Every station gets its own decode of the
+# fixture observation, as it would coming off the wire, and only what is
+# kept once the whole set is loaded is counted.
+#############################################################################
+def bench_memory(stations, fixtures_dir):
+    import gc
+    import tracemalloc
+
+    weather = load_weather({})
+    with open(os.path.join(fixtures_dir, 'observation_latest.json'), 'rb') as file:
+        payload = file.read()
+    with open(os.path.join(fixtures_dir, 'station.json'), 'rb') as file:
+        station = json.loads(file.read())
+    longitude, latitude = station['geometry']['coordinates'][:2]
+    name = station['properties']['name']
+
+    def held(build):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        kept = [build('K{:05d}' . format(index)) for index in range(stations)]
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del kept
+        return(size, peak, elapsed)
+
+    raw = held(lambda station_id: ((station_id, name, longitude, latitude), weather.json_loads(payload)))
+    compact = held(lambda station_id: weather.Observation.from_payload((station_id, name, longitude, latitude), weather.json_loads(payload)))
+    return({'bench': 'memory', 'stations': stations,
+            'raw_bytes_per_station': round(raw[0] / stations),
+            'compact_bytes_per_station': round(compact[0] / stations),
+            'ratio': round(raw[0] / compact[0], 2),
+            'raw_peak_mb': round(raw[1] / 1048576, 1),
+            'compact_peak_mb': round(compact[1] / 1048576, 1),
+            'raw_load_us': round(raw[2] / stations * 1e6, 2),
+            'compact_load_us': round(compact[2] / stations * 1e6, 2),
+            'ok': compact[0] < raw[0]})
+
+#############################################################################
+# --serve -- run the stand-in in the foreground until interrupted or
+# terminated, then print what it served
+#############################################################################
+def stop_serving(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(port, latency_ms, error_rate, fixtures_dir):
+    import signal
+    signal.signal(signal.SIGTERM, stop_serving)
+    server, base_url = start_api_server(fixtures_dir, latency_ms, error_rate, port)
+    print ("Serving {} at {}, try: WEATHER_API_URL={} {} KEWR" . format(fixtures_dir, base_url, base_url, WEATHER_PY), flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    print (json.dumps(dict({'bench': 'serve'}, **server.stats)))
+
+#############################################################################
+# main()
+#############################################################################
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for weather.py')
+    parser.add_argument("--startup", help="Check weather.py load time against the startup budget", action="store_true")
+    parser.add_argument("--cli", help="Time whole weather.py runs against the stand-in API", action="store_true")
+    parser.add_argument("--functions", help="Time individual weather.py functions", action="store_true")
+    parser.add_argument("--memory", metavar="N", type=int, nargs='?', const=MEMORY_STATIONS, help="Compare the memory N stations' observations hold (default {})" . format(MEMORY_STATIONS))
+    parser.add_argument("--serve", metavar="PORT", type=int, help="Only run the stand-in API on PORT (0 picks one)")
+    parser.add_argument("--runs", metavar="N", type=int, default=20, help="Number of runs per measurement (default 20)")
+    parser.add_argument("--budget", metavar="MS", type=float, default=STARTUP_BUDGET_MS, help="Startup budget in ms (default {})" . format(STARTUP_BUDGET_MS))
+    parser.add_argument("--stations", metavar="N", type=int, default=50, help="Number of stations in the --cli many scenario (default 50)")
+    parser.add_argument("--latency", metavar="MS", type=float, default=0, help="Delay every stand-in response by MS milliseconds")
+    parser.add_argument("--error-rate", metavar="FRACTION", type=float, default=0, help="Fail this fraction of stand-in responses with a 503")
+    parser.add_argument("--fixtures", metavar="DIR", default=FIXTURES_DIR, help="Directory of responses the stand-in serves (default {})" . format(FIXTURES_DIR))
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve, args.latency, args.error_rate, args.fixtures)
+        sys.exit(0)
+
+    if not (args.startup or args.cli or args.functions or args.memory):
+        parser.print_help()
+        sys.exit(1)
+
+    results = []
+    if args.startup:
+        results.append(bench_startup(args.runs, args.budget))
+    if args.cli:
+        results.extend(bench_cli(args.runs, args.stations, args.latency, args.error_rate, args.fixtures))
+    if args.functions:
+        results.extend(bench_functions(args.runs, args.latency, args.error_rate, args.fixtures))
+    if args.memory:
+        results.append(bench_memory(args.memory, args.fixtures))
+
+    for result in results:
+        print(json.dumps(result))
+
+    if not all(result['ok'] for result in results):
+        sys.exit(1)
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+# vim set noexpandtab copyindent preserveindent softtabstop=0 shiftwidth=4 tabstop=4
+##############################################################################
+# Status bar client for weather.py --daemon
+#
+# Takes weather.py's arguments and asks a running weather.py --daemon for
+# the result, like weather.py --client.  weather.py is compiled from source
+# every time it runs; this loads only weather_parts/client.py, so an answer
+# from the daemon takes a few ms more than starting the interpreter.
+#
+# When no daemon is listening, or the arguments need a run of their own
+# (see LOCAL_OPTIONS in weather_parts/client.py), weather.py is run in its
+# place with the same arguments.
+##############################################################################
+import sys,os
+from weather_parts.client import run_client
+
+#############################################################################
+# Settings
+#############################################################################
+WEATHER_PY = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'weather.py')
+
+#############################################################################
+# main()
+#############################################################################
+def main():
+    status = run_client(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+    argv = [arg for arg in sys.argv[1:] if arg != '--client']
+    os.execv(sys.executable, [sys.executable, WEATHER_PY] + argv)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# vim set noexpandtab copyindent preserveindent softtabstop=0 shiftwidth=4 tabstop=4
+##############################################################################
+# Prometheus exporter for weather.py
+#
+# Serves /metrics with the current observation of each StationID given as
+# gauges labelled by station, in the units the API reports them in
+# (celsius, percent, pascals, meters per second, degrees).  A refresh loop
+# fetches every --refresh seconds through weather.py's own fetch path, so
+# its retries and station index apply, and a scrape only ever formats what
+# is already in memory, from the moment the exporter starts listening.
+# Every refresh goes to the API, revalidating the cached observation, so
+# the fetch metrics time real requests and not cache hits.
+#
+# Also exported about the exporter itself, per station:
+#   weather_exporter_fetch_duration_seconds   histogram of fetch latency
+#   weather_exporter_fetch_errors_total       failed fetches
+#   weather_exporter_up                       1 if the last fetch worked
+#   weather_exporter_data_age_seconds         since the last good fetch
+#   weather_observation_age_seconds           since the station reported
+#
+# weather.py is loaded as a module instead of run as a script, so python
+# keeps its compiled bytecode and the exporter code costs weather.py runs
+# nothing.
+##############################################################################
+import sys,os,argparse
+import time
+import threading
+import importlib.util
+import concurrent.futures
+
+#############################################################################
+# Settings
+#############################################################################
+ME = os.path.basename(sys.argv[0])
+WEATHER_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weather.py')
+
+# [HOST:]PORT to listen on, no HOST means every interface
+LISTEN_DEFAULT = '9877'
+REFRESH_DEFAULT = 60
+JOBS_DEFAULT = 8
+
+# Fetch latency histogram buckets in seconds
+FETCH_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Prometheus unit and scale from the API value for each kind of field in
+# weather.FIELD_DESCRIPTORS, the API gives wind speeds in km/h
+METRIC_UNITS = {
+    'temp': ('celsius', 1),
+    'percent': ('percent', 1),
+    'pressure': ('pascals', 1),
+    'speed': ('meters_per_second', 1 / 3.6),
+    'angle': ('degrees', 1),
+}
+
+# station_id -> what the refresh loop last saw for it
+STATIONS = {}
+STATIONS_LOCK = threading.Lock()
+
+#############################################################################
+# Load weather.py as the module 'weather'
+#############################################################################
+def load_weather():
+    spec = importlib.util.spec_from_file_location('weather', WEATHER_PY)
+    weather = importlib.util.module_from_spec(spec)
+    sys.modules['weather'] = weather
+    spec.loader.exec_module(weather)
+    return(weather)
+
+#############################################################################
+# Refresh loop -- fetch one station and record the result, the previous
+# observation keeps being served when a fetch fails
+#############################################################################
+def new_station_state():
+    return({'name': None, 'observation': None, 'fetched': None, 'up': 0, 'errors': 0,
+            'buckets': [0] * len(FETCH_BUCKETS), 'count': 0, 'sum': 0.0})
+
+def refresh_station(weather, station_id):
+    started = time.perf_counter()
+    name = None
+    observation = None
+    try:
+        # Only the compact Observation is kept, not the decoded payload
+        observation = weather.as_observation(weather.fetch_weather_data(station_id, revalidate=True))
+        name = observation.name
+        # urlreq() answers with the cached copy when the API fails
+        if observation.stale is not None:
+            raise weather.WeatherAPIError(weather.stale_note(observation.stale))
+        failed = None
+    except (weather.WeatherAPIError, LookupError, TypeError, ValueError) as err:
+        failed = err
+    elapsed = time.perf_counter() - started
+
+    with STATIONS_LOCK:
+        state = STATIONS[station_id]
+        state['count'] += 1
+        state['sum'] += elapsed
+        for index, bucket in enumerate(FETCH_BUCKETS):
+            if elapsed <= bucket:
+                state['buckets'][index] += 1
+        if name is not None:
+            state['name'] = name
+        if failed is None:
+            state['observation'] = observation
+            state['fetched'] = time.time()
+            state['up'] = 1
+        else:
+            state['errors'] += 1
+            state['up'] = 0
+    if failed is not None:
+        print ("{}: refresh of {} failed: {}" . format(ME, station_id, failed), file=sys.stderr)
+
+def refresh_all(weather, station_ids, jobs):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        list(executor.map(lambda station_id: refresh_station(weather, station_id), station_ids))
+
+# The first refresh runs here too, so /metrics is served while it is
+# still waiting on the API
+def refresh_loop(weather, station_ids, jobs, interval, stop_event):
+    while True:
+        refresh_all(weather, station_ids, jobs)
+        if stop_event.wait(interval):
+            break
+
+#############################################################################
+# /metrics in the Prometheus text format
+#############################################################################
+def label_value(value):
+    return(str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+def format_value(value):
+    return(repr(float(value)))
+
+def render_metrics(weather):
+    now = time.time()
+    with STATIONS_LOCK:
+        stations = sorted((station_id, dict(state, buckets=list(state['buckets']))) for station_id, state in STATIONS.items())
+
+    lines = []
+    def family(name, kind, help_text, samples):
+        lines.append('# HELP {} {}' . format(name, help_text))
+        lines.append('# TYPE {} {}' . format(name, kind))
+        for suffix, labels, value in samples:
+            label_text = ',' . join('{}="{}"' . format(key, label_value(label)) for key, label in labels)
+            lines.append('{}{}{{{}}} {}' . format(name, suffix, label_text, format_value(value)))
+
+    family('weather_station_info', 'gauge', 'Station name, always 1',
+           [('', [('station', station_id), ('name', state['name'])], 1) for station_id, state in stations if state['name'] is not None])
+
+    for descriptor in weather.FIELD_DESCRIPTORS:
+        unit, scale = METRIC_UNITS[descriptor.kind]
+        key = descriptor.record_key
+        samples = []
+        for station_id, state in stations:
+            value = getattr(state['observation'], descriptor.field, None)
+            if value is not None:
+                samples.append(('', [('station', station_id)], value * scale))
+        family('weather_{}_{}' . format(key, unit), 'gauge', 'Latest observed {}' . format(key.replace('_', ' ')), samples)
+
+    samples = []
+    for station_id, state in stations:
+        try:
+            samples.append(('', [('station', station_id)], now - weather.parse_iso_timestamp(state['observation'].timestamp)))
+        except (AttributeError, TypeError, ValueError):
+            pass
+    family('weather_observation_age_seconds', 'gauge', 'Seconds since the station made the observation being served', samples)
+
+    family('weather_exporter_up', 'gauge', 'Whether the last fetch of the station worked',
+           [('', [('station', station_id)], state['up']) for station_id, state in stations])
+    family('weather_exporter_data_age_seconds', 'gauge', 'Seconds since the last good fetch of the station',
+           [('', [('station', station_id)], now - state['fetched']) for station_id, state in stations if state['fetched'] is not None])
+    family('weather_exporter_fetch_errors_total', 'counter', 'Fetches of the station that failed',
+           [('', [('station', station_id)], state['errors']) for station_id, state in stations])
+
+    samples = []
+    for station_id, state in stations:
+        for bucket, count in zip(FETCH_BUCKETS, state['buckets']):
+            samples.append(('_bucket', [('station', station_id), ('le', format_value(bucket))], count))
+        samples.append(('_bucket', [('station', station_id), ('le', '+Inf')], state['count']))
+        samples.append(('_sum', [('station', station_id)], state['sum']))
+        samples.append(('_count', [('station', station_id)], state['count']))
+    family('weather_exporter_fetch_duration_seconds', 'histogram', 'Time taken to fetch the station', samples)
+
+    return('\n' . join(lines) + '\n')
+
+#############################################################################
+# HTTP server -- returns the server, serve_forever() it
+#############################################################################
+def parse_listen(listen):
+    host, _, port = listen.rpartition(':')
+    return((host.strip('[]'), int(port)))
+
+def start_server(weather, address):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?', 1)[0] == '/metrics':
+                body = render_metrics(weather).encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif self.path == '/':
+                body = b'<html><body><a href="/metrics">/metrics</a></body></html>\n'
+                content_type = 'text/html'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+
+    return(Server(address, Handler))
+
+def stop_serving(signum, frame):
+    raise KeyboardInterrupt
+
+#############################################################################
+# main()
+#############################################################################
+def main():
+    import signal
+    parser = argparse.ArgumentParser(usage='%(prog)s [options] StationID [StationID ...]', description='Prometheus exporter for weather.py')
+    parser.add_argument("stationID", metavar="StationID", type=str, nargs='*', help="The wx station ID(s) to export")
+    parser.add_argument("--stations-file", metavar="FILE", help="Read StationIDs from FILE, one per line ('-' for stdin)")
+    parser.add_argument("--listen", metavar="[HOST:]PORT", default=LISTEN_DEFAULT, help="Address to serve /metrics on (default {})" . format(LISTEN_DEFAULT))
+    parser.add_argument("--refresh", metavar="SECONDS", type=int, default=REFRESH_DEFAULT, help="How often stations are fetched (default {})" . format(REFRESH_DEFAULT))
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=JOBS_DEFAULT, help="Number of stations to fetch concurrently (default {})" . format(JOBS_DEFAULT))
+    args = parser.parse_args()
+
+    weather = load_weather()
+    weather.HTTP_POOL_SIZE = max(weather.HTTP_POOL_SIZE, args.jobs)
+
+    station_ids = list(args.stationID)
+    if args.stations_file:
+        try:
+            station_ids.extend(weather.read_stations_file(args.stations_file))
+        except OSError as err:
+            print ("{}: unable to read stations file: {}" . format(ME, err), file=sys.stderr)
+            sys.exit(1)
+    # StationIDs are not case sensitive, export each one once
+    station_ids = list(dict.fromkeys(station_id.upper() for station_id in station_ids))
+    if not station_ids:
+        print ("{}: no StationID given" . format(ME), file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        server = start_server(weather, parse_listen(args.listen))
+    except (OSError, ValueError) as err:
+        print ("{}: unable to listen on {}: {}" . format(ME, args.listen, err), file=sys.stderr)
+        sys.exit(1)
+
+    for station_id in station_ids:
+        STATIONS[station_id] = new_station_state()
+
+    signal.signal(signal.SIGTERM, stop_serving)
+    serving = threading.Thread(target=server.serve_forever, daemon=True)
+    serving.start()
+
+    stop_event = threading.Event()
+    refresher = threading.Thread(target=refresh_loop, args=(weather, station_ids, args.jobs, max(1, args.refresh), stop_event), daemon=True)
+    refresher.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    stop_event.set()
+    server.shutdown()
+    server.server_close()
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
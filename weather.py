@@ -13,68 +13,622 @@
 #   Displaying during the day.
 # Updated June 12 2025
 #   Added --forecast option to display forecast for given stationID
+# Updated October 2026
+#   Added on-disk response cache for urlreq() with ETag/Last-Modified
+#   revalidation (--no-cache to bypass)
+#   Added local station/grid index so station metadata and /points lookups
+#   are only fetched once
+#   Accept multiple StationIDs (or --stations-file) fetched concurrently with
+#   --jobs workers; API errors no longer exit from inside urlreq()
+#   All requests go through one pooled requests.Session with timeouts and
+#   retries (--timeout, --retries)
+#   Added --daemon mode serving cached results over a unix socket and
+#   --client to query it
+#   Heavy modules are imported only by the code paths that need them, see
+#   weather.bench.py --startup for the startup budget check
+#   Sunrise/sunset now come from a precomputed per-station table of a year of
+#   sun events; day/night is a binary search and handles polar day/night
+#   Replaced the per-call weather_conditions dict in get_wx_emoji() with a
+#   classifier that tokenizes the NWS description
+#   Added numpy array versions of the unit conversions for bulk processing,
+#   p_to_i() no longer crashes on missing pressure
+#   Added --sync-history to incrementally store a station's observations
+#   Added --query with hourly/daily rollups kept up to date as observations
+#   are stored (--record stores the ones fetched by a normal run)
+#   urlreq() parses the response body once, --sync-history streams pages
+#   through urlreq_stream() instead of holding them in memory
+#   Added --format json/jsonl/msgpack for typed output straight from the
+#   observation instead of formatted strings
+#   Added --watch, polling each station just after its learned report
+#   cadence says a new observation is due and printing only on change
+#   WEATHER_API_URL overrides the API base URL, weather.bench.py uses it to
+#   benchmark against a local server replaying fixture responses
+#   Added --export-bundle and --offline for hosts without network access
+#   Added --deadline, API errors and slow responses fall back to the cached
+#   copy marked stale while it is refreshed in the background
+#   Processes started together for the same station share one fetch per
+#   URL through lock files in the cache directory
+#   Added --near/--near-file to find the closest stations to coordinates
+#   from a k-d tree over a locally cached station catalog
+#   Added --timings, --timings-file (or WEATHER_TIMINGS) to record how long
+#   each phase of a run took, down to DNS/connect/TLS/server/download for
+#   each request
+#   Added weather.exporter.py, a Prometheus exporter serving the current
+#   observations of many stations from an in-process refresh loop
+#   Added --template, a format string compiled once into a render function.
+#   The default layout is built from the same templates with the titles
+#   kept at module level.
+#   Observation fields are described once in FIELD_DESCRIPTORS, used by the
+#   text layout, --template, --format records and weather.exporter.py.
+#   Responses and cache entries are decoded with orjson or simdjson when
+#   one is installed.
+#   Output is rendered from compact slotted Observation records, which the
+#   daemon and weather.exporter.py keep per station instead of the raw
+#   GeoJSON (weather.bench.py --memory measures 10k stations)
+#   Added --hourly, hourly temperature, precipitation, sky cover and wind
+#   from the forecast grid data, --at looks up one point in time.  The grid
+#   data is streamed layer by layer and kept out of the response cache
+#   The code only some runs need (--near, --hourly, --format, bundles,
+#   history, --watch, --daemon, --client) moved to the weather_parts package
+#   next to this script and is imported on first use
+#   Added weather.client.py, a --client that starts without compiling this
+#   script.  --client reads --stations-file/--near-file itself and runs
+#   locally when given options the daemon can't honour per client
+#   (--no-cache, --offline, --timeout, --timings, --export-bundle, ...)
 ##############################################################################
-import sys,os,argparse
-import requests
+import sys,os
 import json
 import datetime 
 from datetime import datetime as dt
-import dateutil.parser as dp
 import time
-import zoneinfo
-import ephem
-import shutil
+import threading
+import functools
+import collections
+import bisect
+# Everything else (requests, ephem, sqlite3, argparse, ...) is imported
+# where it is used so --client and status bar runs start quickly, and so is
+# the weather_parts package holding the code only some runs need
 
 #############################################################################
-# 
+# Raised by urlreq() when the API returns an error so that one bad station
+# does not take down a whole batch.  Callers decide whether to exit.
 #############################################################################
-def urlreq(api_endpoint, method='get', headers=None, payload=None):
-        if method == "post":
-            if headers == None:
-                response = requests.post(api_endpoint, json=payload)
-            elif payload == None:
-                response = requests.post(api_endpoint, headers=headers)
-            else:
-                response = requests.post(api_endpoint, json=payload, headers=headers)
+class WeatherAPIError(Exception):
+    pass
+
+#############################################################################
+# --timings -- with TIMINGS set to a list each @timed function appends a
+# {'phase', 'start_ms', 'ms', ...} record to it as it returns, and
+# timing_note() adds details (cache outcome, bytes, ...) to the innermost
+# one running in this thread.  main() writes them out with totals at exit.
+# When TIMINGS is None a timed call costs one extra function call.
+#############################################################################
+TIMING_LOCAL = threading.local()
+
+def timed(phase):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if TIMINGS is None:
+                return(function(*args, **kwargs))
+            record = timing_begin(phase)
+            try:
+                return(function(*args, **kwargs))
+            finally:
+                timing_end(record)
+        return(wrapper)
+    return(decorate)
+
+def timing_begin(phase, **fields):
+    record = {'phase': phase, 'start_ms': round((time.perf_counter() - TIMINGS_EPOCH) * 1000, 3)}
+    record.update(fields)
+    record['_outer'] = getattr(TIMING_LOCAL, 'record', None)
+    TIMING_LOCAL.record = record
+    return(record)
+
+# Stop adding timing_note()s to record without finishing it
+def timing_pop(record):
+    if '_outer' in record:
+        TIMING_LOCAL.record = record.pop('_outer')
+
+def timing_end(record):
+    timing_pop(record)
+    record['ms'] = round((time.perf_counter() - TIMINGS_EPOCH) * 1000 - record['start_ms'], 3)
+    TIMINGS.append(record)
+
+def timing_note(**fields):
+    if TIMINGS is None:
+        return
+    record = getattr(TIMING_LOCAL, 'record', None)
+    if record is not None:
+        record.update(fields)
+
+# Adds the milliseconds since started to key of the current record, a
+# request that is retried connects more than once
+def timing_add_ms(key, started):
+    record = getattr(TIMING_LOCAL, 'record', None)
+    if record is not None:
+        record[key] = round(record.get(key, 0) + (time.perf_counter() - started) * 1000, 3)
+
+# Wrap the DNS lookup, TCP connect and TLS handshake urllib3 does so the
+# request they happen in gets dns_ms, connect_ms (which includes dns_ms)
+# and tls_ms.  Only installed when --timings is on.
+def timing_install_hooks():
+    import socket
+    import ssl
+    import urllib3.util.connection
+
+    def hook(owner, name, key):
+        original = getattr(owner, name)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return(original(*args, **kwargs))
+            finally:
+                timing_add_ms(key, started)
+        setattr(owner, name, wrapper)
+    hook(socket, 'getaddrinfo', 'dns_ms')
+    hook(urllib3.util.connection, 'create_connection', 'connect_ms')
+    hook(ssl.SSLContext, 'wrap_socket', 'tls_ms')
+
+# One json record per run: every phase in the order they finished plus
+# per-phase totals, bytes read off the wire and cache outcomes
+def write_timings(argv, total_ms):
+    phases = {}
+    cache = {}
+    wire_bytes = 0
+    for record in TIMINGS:
+        totals = phases.setdefault(record['phase'], {'count': 0, 'ms': 0})
+        totals['count'] += 1
+        totals['ms'] = round(totals['ms'] + record['ms'], 3)
+        wire_bytes += record.get('wire_bytes', 0)
+        if 'cache' in record:
+            cache[record['cache']] = cache.get(record['cache'], 0) + 1
+    report = {'argv': argv, 'total_ms': round(total_ms, 3), 'wire_bytes': wire_bytes,
+              'cache': cache, 'phases': phases, 'events': TIMINGS}
+    line = json.dumps(report, separators=(',', ':'))
+    if TIMINGS_OUTPUT == '-':
+        print (line, file=sys.stderr)
+        return
+    try:
+        with open(TIMINGS_OUTPUT, 'a') as f:
+            f.write(line + '\n')
+    except OSError as err:
+        print ("{}: unable to write timings: {}" . format(ME, err), file=sys.stderr)
+
+#############################################################################
+# JSON decoding -- json_loads() decodes API responses and cache entries with
+# the first of JSON_DECODERS that is installed, picked on first use so the
+# import is only paid by runs that decode something.  orjson and simdjson
+# are several times faster than the json module.  WEATHER_JSON_DECODER
+# names one to use instead.
+#############################################################################
+JSON_LOADS = None
+
+def pick_json_decoder():
+    wanted = os.environ.get('WEATHER_JSON_DECODER')
+    for name in ([wanted] if wanted else JSON_DECODERS):
+        if name == 'json':
+            break
+        try:
+            return(__import__(name).loads)
+        except (ImportError, AttributeError):
+            continue
+    return(json.loads)
+
+def json_loads(raw):
+    global JSON_LOADS
+    if JSON_LOADS is None:
+        JSON_LOADS = pick_json_decoder()
+    return(JSON_LOADS(raw))
+
+#############################################################################
+# Response cache helpers -- entries live as one json file per URL under
+# CACHE_DIR/http and are evicted least recently used first once the
+# directory grows past CACHE_MAX_BYTES
+#############################################################################
+def cache_path(api_endpoint):
+    import hashlib
+    digest = hashlib.sha1(api_endpoint.encode('utf-8')).hexdigest()
+    return(os.path.join(CACHE_DIR, 'http', '{}.json' . format(digest)))
+
+def cache_load(api_endpoint):
+    try:
+        with open(cache_path(api_endpoint), 'rb') as f:
+            entry = json_loads(f.read())
+    except (OSError, ValueError):
+        return(None)
+    if entry.get('url') != api_endpoint:
+        return(None)
+    return(entry)
+
+def cache_touch(api_endpoint):
+    # Bump mtime so LRU eviction sees this entry as recently used
+    try:
+        os.utime(cache_path(api_endpoint))
+    except OSError:
+        pass
+
+def cache_ttl(api_endpoint, response_headers):
+    import re
+    import email.utils
+
+    # Per-endpoint overrides win over whatever the server told us
+    for pattern, ttl in CACHE_TTL_OVERRIDES:
+        if re.search(pattern, api_endpoint):
+            return(ttl)
+
+    cache_control = response_headers.get('Cache-Control', '').lower()
+    directives = [d.strip() for d in cache_control.split(',') if d.strip()]
+    if 'no-store' in directives:
+        return(None)
+    if 'no-cache' in directives:
+        return(0)
+    for directive in directives:
+        if directive.startswith('max-age='):
+            try:
+                max_age = int(directive.split('=', 1)[1])
+                age = int(response_headers.get('Age', 0))
+            except ValueError:
+                break
+            return(max(max_age - age, 0))
+
+    expires = response_headers.get('Expires')
+    if expires:
+        try:
+            expires_time = email.utils.parsedate_to_datetime(expires).timestamp()
+            return(max(round(expires_time - time.time()), 0))
+        except (TypeError, ValueError):
+            return(0)
+
+    return(CACHE_DEFAULT_TTL)
+
+def cache_store(api_endpoint, data, response_headers, entry=None):
+    ttl = cache_ttl(api_endpoint, response_headers)
+    if ttl is None:
+        return()
+    if entry is None:
+        entry = {'url': api_endpoint}
+    entry['data'] = data
+    entry['expires'] = time.time() + ttl
+    entry['stored'] = time.time()
+    # A 304 does not always repeat the validators, so keep the old ones
+    if response_headers.get('ETag'):
+        entry['etag'] = response_headers['ETag']
+    if response_headers.get('Last-Modified'):
+        entry['last_modified'] = response_headers['Last-Modified']
+
+    path = cache_path(api_endpoint)
+    tmp_path = '{}.{}.tmp' . format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        return()
+    cache_evict()
+    return()
+
+# Per-URL lock next to the cache entry, returns (fd or None, waited).  The
+# kernel drops a flock when its holder dies so a crashed process never
+# leaves a URL locked.  Gives up after SINGLE_FLIGHT_WAIT and fetches anyway.
+def cache_lock(api_endpoint):
+    try:
+        import fcntl
+    except ImportError:
+        return(None, False)
+    path = cache_path(api_endpoint)[:-len('.json')] + '.lock'
+    give_up = time.time() + SINGLE_FLIGHT_WAIT
+    waited = False
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() >= give_up:
+                        os.close(fd)
+                        return(None, True)
+                    waited = True
+                    time.sleep(SINGLE_FLIGHT_POLL)
+            # cache_evict() may have removed the file while we waited on it
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    return(fd, waited)
+            except OSError:
+                pass
+            os.close(fd)
+    except OSError:
+        return(None, waited)
+
+def cache_unlock(fd):
+    if fd is not None:
+        os.close(fd)
+
+def cache_evict():
+    cache_dir = os.path.join(CACHE_DIR, 'http')
+    entries = []
+    total = 0
+    try:
+        with os.scandir(cache_dir) as it:
+            for item in it:
+                if item.is_file() and item.name.endswith('.json'):
+                    st = item.stat()
+                    entries.append((st.st_mtime, st.st_size, item.path))
+                    total += st.st_size
+    except OSError:
+        return()
+    if total <= CACHE_MAX_BYTES:
+        return()
+    entries.sort()
+    for mtime, size, path in entries:
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        try:
+            os.remove(path[:-len('.json')] + '.lock')
+        except OSError:
+            pass
+        total -= size
+        if total <= CACHE_MAX_BYTES:
+            break
+    return()
 
+#############################################################################
+# Shared HTTP client -- every request goes through one requests.Session so
+# connections are kept alive and reused.  The adapter retries 429/5xx
+# responses and connection errors with jittered exponential backoff.
+#############################################################################
+HTTP_SESSION = None
+HTTP_SESSION_LOCK = threading.Lock()
+
+def get_http_session():
+    global HTTP_SESSION
+    with HTTP_SESSION_LOCK:
+        if HTTP_SESSION is not None:
+            return(HTTP_SESSION)
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry_options = {'total': HTTP_RETRIES, 'backoff_factor': HTTP_BACKOFF,
+                         'status_forcelist': (429, 500, 502, 503, 504),
+                         'allowed_methods': frozenset(['GET', 'HEAD']),
+                         'respect_retry_after_header': True, 'raise_on_status': False}
+        try:
+            retry = Retry(backoff_jitter=HTTP_BACKOFF, **retry_options)
+        except TypeError:
+            # urllib3 < 2.0 has no jitter option
+            retry = Retry(**retry_options)
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({"User-Agent": "weather.py, weather_py@malato.org", "Accept-Encoding": "gzip, deflate"})
+        HTTP_SESSION = session
+        if TIMINGS is not None:
+            timing_install_hooks()
+    return(HTTP_SESSION)
+
+#############################################################################
+# Raise WeatherAPIError for the status codes that mean the request failed
+#############################################################################
+def check_api_status(response):
+    if response.status_code == 401:
+        raise WeatherAPIError("Authorization denied -- Did our token expire ?")
+    elif response.status_code == 422:
+        raise WeatherAPIError("Unable to process request -- bad secret ?")
+    elif response.status_code not in (200, 202, 204):
+        raise WeatherAPIError("Unable to process request, an error occured: [{}]" . format(response.status_code))
+
+#############################################################################
+# 
+#############################################################################
+@timed('urlreq')
+def urlreq(api_endpoint, method='get', headers=None, payload=None, cache=True, revalidate=False, stale=True):
+        timing_note(url=api_endpoint)
+        # --offline never touches the network (or even imports requests)
+        if OFFLINE_BUNDLE is not None:
+                from weather_parts.bundle import bundle_lookup
+                timing_note(cache='offline')
+                return(bundle_lookup(api_endpoint))
+        cache_entry = None
+        use_cache = CACHE_ENABLED and cache
+        timing_note(cache='miss' if use_cache else 'bypass')
         if method == "get":
                 headers = {"Content-Type": "application/json", "User-Agent": "weather.py, weather_py@malato.org"}
-                response = requests.get(api_endpoint, headers=headers)
+                if use_cache:
+                        cache_entry = cache_load(api_endpoint)
+                if cache_entry is not None:
+                        # revalidate skips the fresh check but still sends the validators
+                        if cache_entry['expires'] > time.time() and not revalidate:
+                                cache_touch(api_endpoint)
+                                timing_note(cache='hit')
+                                return(cache_entry['data'])
+                        timing_note(cache='expired')
+                        # Stale -- ask the server if it changed since we stored it
+                        if cache_entry.get('etag'):
+                                headers['If-None-Match'] = cache_entry['etag']
+                        if cache_entry.get('last_modified'):
+                                headers['If-Modified-Since'] = cache_entry['last_modified']
+
+        # stale=False still revalidates an expired entry, but errors raise
+        if cache_entry is None or not stale:
+                return(urlreq_send(api_endpoint, method, headers, payload, cache_entry, use_cache))
+
+        # With something to fall back on, errors and a blown --deadline
+        # return the cached copy marked stale instead
+        if FETCH_DEADLINE is None:
+                try:
+                        return(urlreq_send(api_endpoint, method, headers, payload, cache_entry, use_cache))
+                except WeatherAPIError as err:
+                        timing_note(cache='stale')
+                        return(stale_data(cache_entry, 'error: {}' . format(err)))
+        refresh = urlreq_background(api_endpoint, method, headers, payload, cache_entry, use_cache)
+        if not refresh['done'].wait(max(0, FETCH_DEADLINE - time.time())):
+                timing_note(cache='stale')
+                return(stale_data(cache_entry, 'deadline'))
+        if 'error' in refresh:
+                timing_note(cache='stale')
+                return(stale_data(cache_entry, 'error: {}' . format(refresh['error'])))
+        return(refresh['data'])
+
+#############################################################################
+# The network half of urlreq(), cache_entry is the stale entry being
+# revalidated if there is one
+#############################################################################
+def urlreq_send(api_endpoint, method, headers, payload, cache_entry, use_cache):
+        if method != "get" or not use_cache:
+                return(urlreq_request(api_endpoint, method, headers, payload, cache_entry, use_cache))
+
+        # Single-flight: one process fetches a URL while the others wait on
+        # its lock and then read what it stored
+        started = time.time()
+        lock_fd, waited = cache_lock(api_endpoint)
+        try:
+                if waited:
+                        entry = cache_load(api_endpoint)
+                        if entry is not None and entry.get('stored', 0) >= started:
+                                timing_note(cache='shared')
+                                return(entry['data'])
+                return(urlreq_request(api_endpoint, method, headers, payload, cache_entry, use_cache))
+        finally:
+                cache_unlock(lock_fd)
+
+@timed('http')
+def urlreq_request(api_endpoint, method, headers, payload, cache_entry, use_cache):
+        # Only now do we need the network stack
+        import requests
+        session = get_http_session()
+        timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        if TIMINGS is not None:
+                # setup_ms is importing requests and building the session
+                sent = time.perf_counter()
+                record = TIMING_LOCAL.record
+                record['url'] = api_endpoint
+                record['setup_ms'] = round((sent - TIMINGS_EPOCH) * 1000 - record['start_ms'], 3)
+        try:
+            if method == "post":
+                if headers == None:
+                    response = session.post(api_endpoint, json=payload, timeout=timeout)
+                elif payload == None:
+                    response = session.post(api_endpoint, headers=headers, timeout=timeout)
+                else:
+                    response = session.post(api_endpoint, json=payload, headers=headers, timeout=timeout)
+
+            if method == "get":
+                response = session.get(api_endpoint, headers=headers, timeout=timeout)
+        except requests.exceptions.RequestException as err:
+            raise WeatherAPIError("Unable to reach {}: {}" . format(api_endpoint, err))
+        if TIMINGS is not None:
+                # elapsed runs up to the response headers, the rest is the body
+                elapsed_ms = response.elapsed.total_seconds() * 1000
+                record['server_ms'] = round(max(0, elapsed_ms - record.get('connect_ms', 0) - record.get('tls_ms', 0)), 3)
+                record['download_ms'] = round(max(0, (time.perf_counter() - sent) * 1000 - elapsed_ms), 3)
+                record['status'] = response.status_code
+                record['bytes'] = len(response.content or b'')
+                record['wire_bytes'] = response.raw.tell()
         # Check various status return codes
-        if response.status_code == 401:
-                print ("Authorization denied -- Did our token expire ?")
-                sys.exit(1)
-        elif response.status_code == 422:
-                print ("Unable to process request -- bad secret ?")
-                sys.exit(1)
+        if response.status_code == 304 and cache_entry is not None:
+                cache_store(api_endpoint, cache_entry['data'], response.headers, cache_entry)
+                return(cache_entry['data'])
         elif response.status_code == 204:
                 # this means no content success which is what gets returned after some put requests
                 # We just return here
                 return()
         elif response.status_code == 202:
                 print ("The request has been accepted for processing")
-        elif response.status_code != 200:
-                print ("Unable to process request, an error occured: [{}]" . format(response.status_code))
-                #sys.exit ("Failed to fetch station data -- possible invalid station_id specified?")
-                sys.exit(1)
+        else:
+                check_api_status(response)
         if response.content == None:
                 data = None
         else:
-                responsemsg = response.content
-                responsemsg = responsemsg.decode('utf-8')
-                if responsemsg == "Request needs authentication!":
-                        print("Cannot authenticate with TOKEN, headers passed were[{}]" . format(headers))
-                        sys.exit(1)
-                data = response.json()
+                # Parse straight from the bytes, decoding to a str first
+                # just to compare it would copy the whole body again
+                if response.content.startswith(b"Request needs authentication!"):
+                        raise WeatherAPIError("Cannot authenticate with TOKEN, headers passed were[{}]" . format(headers))
+                if TIMINGS is not None:
+                        decode_started = time.perf_counter()
+                try:
+                        data = json_loads(response.content)
+                except ValueError as err:
+                        raise WeatherAPIError("Invalid JSON from {}: {}" . format(api_endpoint, err))
+                if TIMINGS is not None:
+                        timing_add_ms('decode_ms', decode_started)
+                if method == "get" and use_cache and response.status_code == 200:
+                        cache_store(api_endpoint, data, response.headers)
         return(data)
 #############################################################################
+# Stale-while-revalidate -- with --deadline the request runs in its own
+# thread and urlreq() gives up waiting on it when the deadline passes.  The
+# thread carries on and refreshes the cache for the next run, main() closes
+# stdout and waits for it before exiting so the caller is not held up.
+#############################################################################
+BACKGROUND_REFRESHES = []
+BACKGROUND_LOCK = threading.Lock()
+
+def urlreq_background(api_endpoint, method, headers, payload, cache_entry, use_cache):
+    refresh = {'done': threading.Event()}
+    def run():
+        try:
+            refresh['data'] = urlreq_send(api_endpoint, method, headers, payload, cache_entry, use_cache)
+        except Exception as err:
+            refresh['error'] = err
+        finally:
+            refresh['done'].set()
+    thread = threading.Thread(target=run, name='refresh {}' . format(api_endpoint))
+    with BACKGROUND_LOCK:
+        BACKGROUND_REFRESHES.append(thread)
+    thread.start()
+    return(refresh)
+
+def finish_background_refreshes():
+    with BACKGROUND_LOCK:
+        threads = list(BACKGROUND_REFRESHES)
+    if not any(thread.is_alive() for thread in threads):
+        return()
+    # Let whoever reads our output have it now
+    try:
+        sys.stdout.flush()
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+    except (OSError, ValueError):
+        pass
+    for thread in threads:
+        thread.join()
+    return()
+
+# The cached copy of a response, marked with why and how old it is
+def stale_data(cache_entry, reason):
+    data = cache_entry['data']
+    if not isinstance(data, dict):
+        return(data)
+    data = dict(data)
+    stored = cache_entry.get('stored')
+    data[STALE_KEY] = {'reason': reason, 'age': None if stored is None else round(time.time() - stored)}
+    return(data)
+
+def stale_note(stale):
+    if stale['age'] is None:
+        return("Stale data ({})" . format(stale['reason']))
+    return("Stale data ({}), {} min old" . format(stale['reason'], stale['age'] // 60))
+
+#############################################################################
 # Convert ISO 8601 UTC Timestamp to Local Time
 #############################################################################
 def clean_timestamp(utc_timestamp_str):
     iso8601_timestamp = "%Y-%m-%dT%H:%M:%S%z"
     utc_timestamp = dt.strptime(utc_timestamp_str, iso8601_timestamp)
     # Get localtime
-    local_timezone = dt.now(zoneinfo.ZoneInfo('UTC')).astimezone().tzinfo
+    local_timezone = dt.now(datetime.timezone.utc).astimezone().tzinfo
     local_timestamp = utc_timestamp.astimezone(local_timezone)
     local_timefmt = "%Y-%m-%d %H:%M:%S %Z"
     local_timefmt = "%m/%d/%Y %H:%M:%S %Z"
@@ -82,6 +636,38 @@ def clean_timestamp(utc_timestamp_str):
 
     return(local_timestamp_str)
 
+#############################################################################
+# Seconds since the epoch of an ISO 8601 timestamp
+#############################################################################
+def parse_iso_timestamp(timestamp):
+    return(int(dt.fromisoformat(timestamp).timestamp()))
+
+#############################################################################
+# Unit conversion formulas -- written so they work the same on a single
+# float or a whole numpy array.  The scalar helpers used by the CLI and the
+# *_array() versions used for bulk processing are both built on these.
+#############################################################################
+KMH_TO_MPH = 0.62137
+MM_PER_INCH = 25.4
+PA_TO_INHG = 0.00029530
+COMPASS_SECTORS = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW", "N"]
+
+def convert_c_to_f(temp):
+    return((temp * 1.8000) + 32)
+
+def convert_kmh_to_mph(speed):
+    return(speed * KMH_TO_MPH)
+
+def convert_pa_to_inhg(pa):
+    return(pa * PA_TO_INHG)
+
+def convert_mm_to_in(mm):
+    return(mm / MM_PER_INCH)
+
+def convert_angle_to_sector(direction):
+    # Index into COMPASS_SECTORS, before rounding
+    return((direction % 360) / 22.5)
+
 #############################################################################
 # 
 #############################################################################
@@ -90,7 +676,7 @@ def calc_temp(temp,metricflag=False):
     if temp is not None:
         if not metricflag:
             # Convert C to F
-            temp = (temp * 1.8000) + 32
+            temp = convert_c_to_f(temp)
             unit = '°F'
         else:
             unit = '°C'
@@ -105,7 +691,7 @@ def calc_wind(wind,metricflag=False):
     if wind is not None:
         if not metricflag:
             # Convert to mph
-            wind = wind * 0.62137
+            wind = convert_kmh_to_mph(wind)
             unit = 'mph'
         else:
             unit = 'km/h'
@@ -117,9 +703,8 @@ def calc_wind(wind,metricflag=False):
 #############################################################################
 def c_to_f(temp):
     # Convert C to F
-    unit = 'F'
     if temp is not None:
-        temp = (temp * 1.8000) + 32
+        temp = convert_c_to_f(temp)
         temp = round(temp)
     return(temp)
 
@@ -127,17 +712,12 @@ def c_to_f(temp):
 # Convert Pascals to Inches of Mercury
 #############################################################################
 def p_to_i(pa):
-    unit = ''
     i = None
     if pa is not None:
         unit = 'in'
-        i = pa * 0.00029530
+        i = convert_pa_to_inhg(pa)
         i = round(i,2)
         i = '{}{}' . format(i, unit)
-    unit = 'in'
-    i = pa * 0.00029530
-    i = round(i,2)
-    i = '{}{}' . format(i, unit)
     return(i)
 
 #############################################################################
@@ -146,7 +726,7 @@ def p_to_i(pa):
 def k_to_m(km):
     unit = 'mph'
     if km is not None:
-        km = km * 0.62137
+        km = convert_kmh_to_mph(km)
         km = round(km)
         km = '{}{}' . format(km, unit)
     return(km)
@@ -155,49 +735,318 @@ def k_to_m(km):
 # Convert Wind angle to compass direction
 #############################################################################
 def angle2compass(direction):
-    if direction:
-        sector = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE", "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW", "N"]
-        index = direction%360
-        index = round(index / 22.5)
-        compassdir = sector[index]
-        return(compassdir)
+    # Same answer as angle2compass_array(), None when missing and 0 is N
+    if direction is None or direction != direction:
+        return(None)
+    return(COMPASS_SECTORS[round(convert_angle_to_sector(direction))])
+
+#############################################################################
+# Array versions of the conversions for bulk processing.  Each takes any
+# sequence of raw API values (None allowed) and returns a float numpy
+# array with NaN where the value was missing.  Needs numpy, which is only
+# imported when one of these is called.
+#############################################################################
+def to_float_array(values):
+    import numpy as np
+    return(np.array(values, dtype=float))
+
+def calc_temp_array(temps, metricflag=False):
+    import numpy as np
+    temps = to_float_array(temps)
+    if not metricflag:
+        temps = convert_c_to_f(temps)
+        unit = '°F'
+    else:
+        unit = '°C'
+    return(np.round(temps), unit)
+
+def calc_wind_array(winds, metricflag=False):
+    import numpy as np
+    winds = to_float_array(winds)
+    if not metricflag:
+        winds = convert_kmh_to_mph(winds)
+        unit = 'mph'
     else:
-        return(direction)
+        unit = 'km/h'
+    return(np.round(winds), unit)
+
+def p_to_i_array(pressures):
+    import numpy as np
+    return(np.round(convert_pa_to_inhg(to_float_array(pressures)), 2), 'in')
+
+# Returns an object array of compass directions, None where the direction
+# was missing
+def angle2compass_array(directions):
+    import numpy as np
+    directions = to_float_array(directions)
+    missing = np.isnan(directions)
+    index = np.round(convert_angle_to_sector(np.where(missing, 0, directions))).astype(int)
+    compass = np.array(COMPASS_SECTORS, dtype=object)[index]
+    compass[missing] = None
+    return(compass)
 
 #############################################################################
-# Get Sunrise and Sunset times based on station coordinates
+# Convert columns of raw observation values in one call.  columns maps the
+# observation property names (temperature, dewpoint, windSpeed, ...) to
+# sequences of values as returned by the API; the result maps the same
+# names to (array, unit).
 #############################################################################
-def get_sunrise_sunset(latitude, longitude):
-    date = datetime.date.today()
+OBSERVATION_COLUMN_CONVERTERS = {
+    'temperature': calc_temp_array, 'dewpoint': calc_temp_array,
+    'windChill': calc_temp_array, 'heatIndex': calc_temp_array,
+    'windSpeed': calc_wind_array, 'windGust': calc_wind_array,
+}
+
+def convert_observation_columns(columns, metricflag=False):
+    import numpy as np
+    converted = {}
+    for name, values in columns.items():
+        if name in OBSERVATION_COLUMN_CONVERTERS:
+            converted[name] = OBSERVATION_COLUMN_CONVERTERS[name](values, metricflag)
+        elif name == 'barometricPressure':
+            converted[name] = p_to_i_array(values)
+        elif name == 'windDirection':
+            converted[name] = (angle2compass_array(values), '')
+        elif name == 'relativeHumidity':
+            converted[name] = (np.round(to_float_array(values)), '%')
+        else:
+            converted[name] = (to_float_array(values), '')
+    return(converted)
+
+#############################################################################
+# Sun event tables -- for each station (coordinates rounded to 0.01 degree)
+# and year we ask ephem once for every sunrise and sunset and keep them on
+# disk.  Events are stored as int64 epoch seconds * 2, plus 1 for a rise,
+# so the array sorts by time and a single bisect tells us whether the sun
+# is up.  Each table covers a couple of days either side of the year so
+# lookups near new year still find the previous event.
+#############################################################################
+SUN_TABLE_MAGIC = b'SUN1'
+SUN_TABLE_MARGIN = 3 * 86400
+
+def sun_table_path(latitude, longitude, year):
+    return(os.path.join(CACHE_DIR, 'sun', '{:.2f}_{:.2f}_{}.bin' . format(latitude, longitude, year)))
+
+@timed('ephem')
+def build_sun_table(latitude, longitude, year):
+    import ephem
+    import calendar
+
+    start = calendar.timegm((year, 1, 1, 0, 0, 0)) - SUN_TABLE_MARGIN
+    end = calendar.timegm((year + 1, 1, 1, 0, 0, 0)) + SUN_TABLE_MARGIN
+    epoch = float(ephem.Date('1970/1/1'))
+
     observer = ephem.Observer()
     observer.lat = str(latitude)
     observer.long = str(longitude)
-    observer.date = date
+    sun = ephem.Sun()
+
+    # Is the sun up when the table starts ?  Matters for polar day/night
+    # where the last event can be weeks before the time we look up.
+    observer.date = ephem.Date(start / 86400.0 + epoch)
+    sun.compute(observer)
+    # ephem rises and sets on the refracted upper limb
+    initial_up = 1 if sun.alt > -sun.radius else 0
+
+    events = []
+    when = start
+    while when < end:
+        observer.date = ephem.Date(when / 86400.0 + epoch)
+        found = []
+        for kind, next_event in ((1, observer.next_rising), (0, observer.next_setting)):
+            try:
+                found.append((round((float(next_event(sun)) - epoch) * 86400), kind))
+            except ephem.CircumpolarError:
+                pass
+        if not found:
+            # Sun neither rises nor sets today, try again tomorrow
+            when += 86400
+            continue
+        event_time, kind = min(found)
+        if event_time >= end:
+            break
+        events.append(event_time * 2 + kind)
+        when = event_time + 60
+
+    return(initial_up, events)
+
+def write_sun_table(path, year, initial_up, events):
+    import array
+    import struct
+
+    tmp_path = '{}.{}.tmp' . format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<4sHB', SUN_TABLE_MAGIC, year, initial_up))
+            array.array('q', events).tofile(f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def read_sun_table(path, year):
+    import array
+    import struct
+
+    header_size = struct.calcsize('<4sHB')
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+    except OSError:
+        return(None)
+    if len(raw) < header_size:
+        return(None)
+    magic, table_year, initial_up = struct.unpack('<4sHB', raw[:header_size])
+    if magic != SUN_TABLE_MAGIC or table_year != year:
+        return(None)
+    events = array.array('q')
+    events.frombytes(raw[header_size:])
+    return(initial_up, events)
+
+# Tables stay in memory for the life of the process (daemon, batches)
+@functools.lru_cache(maxsize=1024)
+def load_sun_table(latitude, longitude, year):
+    latitude = round(latitude, 2)
+    longitude = round(longitude, 2)
+    if OFFLINE_BUNDLE is not None:
+        from weather_parts.bundle import bundle_member, bundle_sun_key
+        table = bundle_member('sun/' + bundle_sun_key(latitude, longitude, year))
+        if table is not None:
+            table = json_loads(table)
+            return((table['initial_up'], table['events']))
+    path = sun_table_path(latitude, longitude, year)
+    table = read_sun_table(path, year)
+    if table is None:
+        initial_up, events = build_sun_table(latitude, longitude, year)
+        write_sun_table(path, year, initial_up, events)
+        table = (initial_up, events)
+    return(table)
+
+def sun_table_for(latitude, longitude, when):
+    year = time.gmtime(when).tm_year
+    return(load_sun_table(round(latitude, 2), round(longitude, 2), year))
+
+#############################################################################
+# Is the sun up at the station -- binary search over the sun event table
+#############################################################################
+def is_daytime(latitude, longitude, when=None):
+    if when is None:
+        when = time.time()
+    when = int(when)
+    initial_up, events = sun_table_for(latitude, longitude, when)
+    index = bisect.bisect_right(events, when * 2 + 1) - 1
+    if index < 0:
+        return(bool(initial_up))
+    return(bool(events[index] & 1))
 
-    sunrise = observer.next_rising(ephem.Sun())
-    sunset = observer.next_setting(ephem.Sun())
+#############################################################################
+# Get Sunrise and Sunset times based on station coordinates
+#############################################################################
+def get_sun_events(latitude, longitude):
+    # First rise and set after local midnight today as epoch seconds.
+    # Either can be None during polar day or night.
+    midnight = dt.combine(datetime.date.today(), datetime.time()).timestamp()
+    midnight = int(midnight)
+    initial_up, events = sun_table_for(latitude, longitude, midnight)
+
+    sunrise = None
+    sunset = None
+    index = bisect.bisect_left(events, midnight * 2)
+    while index < len(events) and (sunrise is None or sunset is None):
+        event_time, kind = divmod(events[index], 2)
+        if event_time >= midnight + 86400:
+            break
+        if kind and sunrise is None:
+            sunrise = event_time
+        elif not kind and sunset is None:
+            sunset = event_time
+        index += 1
 
-    # return in localtime
-    sunrise = ephem.Date(sunrise)
-    sunrise = ephem.localtime(sunrise)
-    sunrise = sunrise.strftime("%m/%d/%Y %H:%M:%S")
+    return (sunrise, sunset)
+
+@timed('sun')
+def get_sunrise_sunset(latitude, longitude):
+    sunrise, sunset = get_sun_events(latitude, longitude)
 
-    sunset = ephem.Date(sunset)
-    sunset = ephem.localtime(sunset)
-    sunset = sunset.strftime("%m/%d/%Y %H:%M:%S")
+    # return in localtime
+    if sunrise is not None:
+        sunrise = dt.fromtimestamp(sunrise).strftime("%m/%d/%Y %H:%M:%S")
+    if sunset is not None:
+        sunset = dt.fromtimestamp(sunset).strftime("%m/%d/%Y %H:%M:%S")
 
     return (sunrise, sunset)
 
+#############################################################################
+# Station index -- a small sqlite database holding station metadata and the
+# /points grid resolution for each station we have looked up.  Rows are
+# filled in lazily and refreshed once they are older than
+# STATION_INDEX_MAX_AGE.
+#############################################################################
+def station_index_connect():
+    import sqlite3
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(STATION_INDEX, timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""CREATE TABLE IF NOT EXISTS stations (
+                        station_id TEXT PRIMARY KEY, name TEXT, lon REAL, lat REAL,
+                        station_updated REAL, office TEXT, grid_x INTEGER, grid_y INTEGER,
+                        forecast_url TEXT, forecast_hourly_url TEXT,
+                        forecast_grid_data_url TEXT, points_updated REAL)""")
+    return(conn)
+
+def station_index_get(station_id):
+    import sqlite3
+    if not CACHE_ENABLED:
+        return(None)
+    try:
+        conn = station_index_connect()
+        try:
+            row = conn.execute("SELECT * FROM stations WHERE station_id = ?", (station_id.upper(),)).fetchone()
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error):
+        return(None)
+    if row is None:
+        return(None)
+    return(dict(row))
+
+def station_index_put(station_id, **fields):
+    import sqlite3
+    fields['station_id'] = station_id.upper()
+    columns = ', '.join(fields)
+    placeholders = ', '.join('?' * len(fields))
+    updates = ', '.join('{0} = excluded.{0}' . format(key) for key in fields if key != 'station_id')
+    sql = "INSERT INTO stations ({}) VALUES ({}) ON CONFLICT(station_id) DO UPDATE SET {}" . format(columns, placeholders, updates)
+    try:
+        conn = station_index_connect()
+        try:
+            with conn:
+                conn.execute(sql, tuple(fields.values()))
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error):
+        pass
+    return()
+
+def station_index_fresh(row, column):
+    return(row is not None and row[column] is not None and time.time() - row[column] < STATION_INDEX_MAX_AGE)
+
 #############################################################################
 # Get WX Station Information -- returns ID and Name
 #############################################################################
+@timed('station_info')
 def get_wx_station_info(station_id):
-    
+
+    row = station_index_get(station_id)
+    if station_index_fresh(row, 'station_updated'):
+        timing_note(station=station_id, index='hit')
+        return(row['station_id'],row['name'],row['lon'],row['lat'])
+
     # URL Stuff
     #api_url = 'https://api.weather.gov'
     api_url = API_URL
     station_url = '{}/stations/{}' . format(api_url, station_id)
-
+    timing_note(station=station_id, index='miss')
     station_data = urlreq(station_url)
     # Get Station Specific Data
     stationID = station_data["properties"]["stationIdentifier"]
@@ -206,408 +1055,263 @@ def get_wx_station_info(station_id):
     stationLON = station_data["geometry"]["coordinates"][0]
     stationLAT = station_data["geometry"]["coordinates"][1]
 
+    fields = {'name': stationName, 'lon': stationLON, 'lat': stationLAT, 'station_updated': time.time()}
+    if row is not None and (row['lon'], row['lat']) != (stationLON, stationLAT):
+        # Station moved, the old grid resolution no longer applies
+        fields['points_updated'] = None
+    station_index_put(stationID, **fields)
+
     return(stationID,stationName,stationLON,stationLAT)
 
+#############################################################################
+# Get forecast grid for a WX Station -- returns dict with office, gridX,
+# gridY and the forecast URLs
+#############################################################################
+def get_wx_station_grid(station_id, stationLAT, stationLON):
+
+    row = station_index_get(station_id)
+    if station_index_fresh(row, 'points_updated'):
+        return(row)
+
+    station_forecast_url = '{}/points/{},{}' . format(API_URL, stationLAT, stationLON)
+    points_data = urlreq(station_forecast_url)
+    properties = points_data["properties"]
+
+    grid = {'office': properties.get("gridId"), 'grid_x': properties.get("gridX"), 'grid_y': properties.get("gridY"),
+            'forecast_url': properties.get("forecast"), 'forecast_hourly_url': properties.get("forecastHourly"),
+            'forecast_grid_data_url': properties.get("forecastGridData"), 'points_updated': time.time()}
+    station_index_put(station_id, **grid)
+
+    return(grid)
+
 #############################################################################
 # Determine if we need to use NT icons or regular day icons 
 #############################################################################
-def get_icon_type(sunrise,sunset):
-    iconset=()
-    ct = dt.now()
-    AMorPM = ct.strftime("%p")
-
-    #print(sunrise)
-    #print(sunset)
-
-    # Get current time in unix format 
-    current_time = round(time.time())
-    sunset_time = dp.parse(sunset)
-    sunset_time = round(sunset_time.timestamp())
-    sunset_time = sunset_time + 86400 # need to adjust for one day
-    sunrise_time = dp.parse(sunrise)
-    sunrise_time = round(sunrise_time.timestamp())
-    #print("Current Time: {}" . format(current_time))
-    #print("Sunrise Time: {}" . format(sunrise_time))
-    #print("Sunset Time: {}" . format(sunset_time))
-
-    if AMorPM == "PM":
-        #sunset_time = dp.parse(sunset)
-        #sunset_time = round(sunset_time.timestamp())
-        #if current_time - sunset_time > 0:
-        if current_time > sunset_time:
-            iconset = "night"
-        else:
-            iconset = "day"
-    elif AMorPM == "AM":
-        #sunrise_time = dp.parse(sunrise)
-        #sunrise_time = round(sunrise_time.timestamp())
-
-        #if current_time - sunrise_time < 0:
-        if current_time < sunrise_time:
-            iconset = "night"
+def get_icon_type(latitude, longitude):
+    if is_daytime(latitude, longitude):
+        iconset = "day"
+    else:
+        iconset = "night"
+    return(iconset)
+
+#############################################################################
+# Weather icons, taken from:
+# https://symbl.cc/en/emoji/travel-and-places/sky-and-weather/
+# The sky icons differ based on whether it is "NIGHT" or "DAY" which is
+# defined by whether the sun has risen or set.
+#############################################################################
+WX_ICONS_COMMON = {
+    'Cloudy': '☁️',
+    'Rainy': '🌧️',
+    'Tstorms': '⛈️',
+    'ThunderStorm': '⚡',
+    'LightThunder': '🌩️',
+    'Snowy': '🌨️',
+    'Snow': '❄️',
+    'SnowRain': "❄",
+    'Ice': '🧊',
+    'Windy': '🌬️',
+    'Foggy': '🌫️',
+    'Coastal_Storm': '🌊',
+    'Haze': '🌫️',
+    'Smog': '🌁',
+    'Tornado': '🌪️',
+    'Hurricane': '🌀',
+}
+WX_ICONS = {
+    'day': dict(WX_ICONS_COMMON, Clear='🌞', Mostly_Clear='☀️', Partly_Cloudy='🌤️',
+                Variable_Cloudy='⛅', Mostly_Cloudy='🌥️', Showers='🌦️'),
+    'night': dict(WX_ICONS_COMMON, Clear='🌛', Mostly_Clear='🌛', Partly_Cloudy='☾',
+                  Variable_Cloudy='☁', Mostly_Cloudy='☁️', Showers='🌧️'),
+}
+WX_UNKNOWN_ICON = "❓"
+
+#############################################################################
+# Weather description classifier -- NWS textDescription values are built
+# from an intensity (light/heavy), "in vicinity" and a list of phenomena
+# joined with "and"/"with" (definitions from weather.gov/forecast-icons).
+# Rather than list every combination we pick the terms out and decide the
+# icon from the set of phenomena.
+#############################################################################
+# Spelling variants seen in the wild, fixed before matching
+WX_SPELLING = [
+    (r'\bvincinity\b', 'vicinity'),
+    (r'\bhazy\b', 'haze'),
+    (r'\bthunderstorms\b', 'thunderstorm'),
+    (r'\bt-storms?\b', 'thunderstorm'),
+    (r'\bwarming\b', 'warning'),
+]
+
+# Term -> token, longest terms are matched first
+WX_TERMS = {
+    'light': 'light', 'heavy': 'heavy', 'in vicinity': 'vicinity',
+    'tornado/water spout': 'tornado', 'tornado': 'tornado', 'water spout': 'tornado', 'funnel cloud': 'tornado',
+    'hurricane': 'hurricane', 'tropical storm': 'tropical_storm',
+    'thunderstorm': 'thunderstorm', 'blizzard': 'blizzard',
+    'freezing rain': 'freezing_rain', 'freezing drizzle': 'freezing_rain',
+    'small hail/snow pellets': 'small_hail', 'snow pellets': 'small_hail', 'ice pellets': 'ice_pellets',
+    'ice crystals': 'ice_crystals', 'hail': 'hail',
+    'blowing snow': 'snow', 'low drifting snow': 'snow', 'snow grains': 'snow', 'snow': 'snow',
+    'rain': 'rain', 'drizzle': 'rain', 'showers': 'showers',
+    'unknown precipitation': 'precipitation', 'precipitation': 'precipitation',
+    'freezing fog': 'fog', 'shallow fog': 'fog', 'partial fog': 'fog', 'patches of fog': 'fog',
+    'fog/mist': 'fog', 'fog': 'fog', 'mist': 'fog',
+    'haze': 'haze', 'smoke': 'smoke', 'volcanic ash': 'smoke', 'dust': 'dust', 'sand': 'dust',
+    'fair': 'clear', 'clear': 'clear', 'mostly clear': 'mostly_clear', 'a few clouds': 'few_clouds',
+    'partly cloudy': 'partly_cloudy', 'mostly cloudy': 'mostly_cloudy', 'overcast': 'overcast', 'cloudy': 'overcast',
+    'breezy': 'breezy', 'windy': 'windy', 'squalls': 'windy', 'squall': 'windy', 'hot': 'hot', 'cold': 'cold',
+}
+
+# Sky cover icons, plain and "with haze"
+WX_SKY_ICONS = {'clear': 'Clear', 'mostly_clear': 'Mostly_Clear', 'few_clouds': 'Partly_Cloudy',
+                'partly_cloudy': 'Partly_Cloudy', 'mostly_cloudy': 'Mostly_Cloudy', 'overcast': 'Cloudy'}
+WX_SKY_HAZE_ICONS = {'clear': 'Mostly_Clear', 'mostly_clear': 'Mostly_Clear', 'few_clouds': 'Variable_Cloudy',
+                     'partly_cloudy': 'Partly_Cloudy', 'mostly_cloudy': 'Mostly_Cloudy', 'overcast': 'Haze'}
+
+# Compiled on first use so loading the script stays cheap
+@functools.lru_cache(maxsize=None)
+def get_wx_patterns():
+    import re
+    spelling = [(re.compile(pattern), replacement) for pattern, replacement in WX_SPELLING]
+    terms = sorted(WX_TERMS, key=len, reverse=True)
+    term_re = re.compile(r'(?<![a-z])(' + '|' . join(re.escape(term) for term in terms) + r')(?![a-z])')
+    return(spelling, term_re)
+
+#############################################################################
+# Split a description into (intensity, in vicinity, set of phenomena)
+#############################################################################
+def parse_wx_description(description):
+    spelling, term_re = get_wx_patterns()
+    text = description.lower()
+    for pattern, replacement in spelling:
+        text = pattern.sub(replacement, text)
+
+    intensity = None
+    vicinity = False
+    phenomena = set()
+    for match in term_re.finditer(text):
+        token = WX_TERMS[match.group(1)]
+        if token in ('light', 'heavy'):
+            if intensity is None:
+                intensity = token
+        elif token == 'vicinity':
+            vicinity = True
         else:
-            iconset = "day"
+            phenomena.add(token)
 
-    return(iconset)
+    return(intensity, vicinity, frozenset(phenomena))
 
 #############################################################################
-# Define Dictionary to hold weather emoji for each weather type
+# Map a description to an icon name in WX_ICONS, None if we can't tell.
+# Memoized since a station reports the same few strings all day.
 #############################################################################
-def get_wx_emoji(weather,sunrise,sunset):
-    
-    ##############################################################################
-    # Define Sky Conditions that match specific emoji
-    # Taken from:
-    # https://symbl.cc/en/emoji/travel-and-places/sky-and-weather/
-    ##############################################################################
-    # These Icons differ based on whether it is "NIGHT" or "DAY" which is 
-    # defined by whether the sun has risen or set.
-    # Determine what iconset to use based on return value from function
-    iconset=get_icon_type(sunrise,sunset)
-
-    if iconset == "day":
-        Clear = '🌞'
-        Mostly_Clear = '☀️'
-        Partly_Cloudy = '🌤️'
-        Variable_Cloudy = '⛅'
-        Mostly_Cloudy = '🌥️'
-        Showers = '🌦️'
-
-    elif iconset == "night":
-        Clear = '🌛'
-        Mostly_Clear = '🌛'
-        Partly_Cloudy = '☾'
-        Variable_Cloudy = '☁'
-        Mostly_Cloudy = '☁️'
-        Showers = '🌧️'
-
-    # These icons can be used day or night
-    Cloudy ='☁️'
-    Rainy = '🌧️'
-    Tstorms = '⛈️'
-    ThunderStorm = '⚡'
-    LightThunder = '🌩️'
-    Snowy = '🌨️'
-    Snow = '❄️'
-    SnowRain = "❄"
-    Ice = '🧊'
-    Windy = '🌬️'
-    Foggy = '🌫️'
-    Coastal_Storm = '🌊'
-    Haze = '🌫️'
-    Smog = '🌁'
-    Tornado = '🌪️'
-    Hurricane = '🌀'
-
-    # Define dictionary for weather conditions
-    # Definitions from weather.gov/forecast-icons
-    weather_conditions = {
-        "fair": Clear,
-        "clear": Clear,
-        "fair with haze": Mostly_Clear,
-        "clear with haze": Mostly_Clear,
-        "fair and breezy": Clear,
-        "clear breezy": Clear,
-        "a few clouds": Partly_Cloudy,
-        "a few clouds with haze": Variable_Cloudy,
-        "a few clouds and breezy": Partly_Cloudy,
-        "mostly clear": Mostly_Clear,
-        "partly cloudy": Partly_Cloudy,
-        "partly cloudy with hazy": Partly_Cloudy,
-        "partly cloudy and breezy": Partly_Cloudy,
-        "mostly cloudy": Mostly_Cloudy,
-        "mostly cloudy with haze": Mostly_Cloudy,
-        "mostly cloudy and breezy": Mostly_Cloudy,
-        "fog/mist": Foggy,
-        "shallow fog": Foggy,
-        "cloudy": Cloudy,
-        "overcast": Cloudy,
-        "overcast with hazy": Haze,
-        "overcast and breezy": Cloudy,
-        "light rain": Rainy,
-        "drizzle": Rainy,
-        "light drizzle": Rainy,
-        "heavy drizzle": Rainy,
-        "light rain fog/mist": Rainy,
-        "light rain and fog/mist": Rainy,
-        "light rain and fog": Rainy,
-        "fog/mist and light rain": Rainy,
-        "drizzle fog/mist": Rainy,
-        "light drizzle fog/mist": Rainy,
-        "light drizzle and fog/mist": Rainy,
-        "heavy drizzle fog/mist": Rainy,
-        "light rain fog": Rainy,
-        "drizzle fog": Rainy,
-        "light drizzle fog": Rainy,
-        "heavy drizzle fog": Rainy,
-        "rain": Rainy,
-        "heavy rain": Rainy,
-        "rain fog/mist": Rainy,
-        "rain and fog/mist": Rainy,
-        "heavy rain fog/mist": Rainy,
-        "heavy rain and fog/mist": Rainy,
-        "rain fog": Rainy,
-        "heavy rain fog": Rainy,
-        "thunderstorm in vicinity hail haze": ThunderStorm,
-        "thunderstorm haze in vicinity hail": ThunderStorm,
-        "thunderstorm light rain hail haze": ThunderStorm,
-        "thunderstorm heavy rain hail haze": ThunderStorm,
-        "thunderstorm hail fog": ThunderStorm,
-        "thunderstorm light rain hail fog": ThunderStorm,
-        "thunderstorm heavy rain hail fog": ThunderStorm,
-        "thunderstorm small hail/snow pellets": ThunderStorm,
-        "thunderstorm rain small hail/snow pellets": ThunderStorm,
-        "light thunderstorm rain small hail/snow pellets": LightThunder,
-        "heavy thunderstorm rain small hail/snow pellets": LightThunder,
-        "thunderstorm": Tstorms,
-        "thunderstorm rain": Tstorms,
-        "light thunderstorm rain": LightThunder,
-        "heavy thunderstorm rain": Tstorms,
-        "thunderstorm rain fog/mist": LightThunder,
-        "light thunderstorm rain fog/mist": LightThunder,
-        "light thunderstorms and light rain and fog/mist": LightThunder,
-        "heavy thunderstorm rain fog and windy": LightThunder,
-        "heavy thunderstorm rain fog/mist": LightThunder,
-        "heavy thunderstorms and heavy rain and fog/mist": LightThunder,
-        "thunderstorm showers in vicinity": LightThunder,
-        "light thunderstorm rain haze": LightThunder,
-        "heavy thunderstorm rain haze": LightThunder,
-        "thunderstorm fog": LightThunder,
-        "light thunderstorm rain fog": LightThunder,
-        "heavy thunderstorm rain fog": LightThunder,
-        "thunderstorm light rain": LightThunder,
-        "thunderstorm heavy rain": LightThunder,
-        "thunderstorm rain fog/mist": LightThunder,
-        "thunderstorm light rain fog/mist": LightThunder,
-        "thunderstorm heavy rain fog/mist": LightThunder,
-        "thunderstorm in vicinity fog/mist": ThunderStorm,
-        "thunderstorm in vicinity fog": ThunderStorm,
-        "thunderstorm showers in vicinity": Tstorms,
-        "thunderstorm in vicinity haze": ThunderStorm,
-        "thunderstorm haze in vicinity": ThunderStorm,
-        "thunderstorm light rain haze":  LightThunder,
-        "thunderstorm heavy rain haze": LightThunder,
-        "thunderstorm fog": ThunderStorm,
-        "thunderstorm light rain fog": Tstorms,
-        "thunderstorm heavy rain fog": LightThunder,
-        "thunderstorm hail": ThunderStorm,
-        "light thunderstorm rain hail": ThunderStorm,
-        "heavy thunderstorm rain hail": ThunderStorm,
-        "thunderstorm rain hail fog/mist": LightThunder,
-        "light thunderstorm rain hail fog/mist": LightThunder,
-        "heavy thunderstorm rain hail fog/hail": LightThunder,
-        "thunderstorm showers in vicinity hail": LightThunder,
-        "light thunderstorm rain hail haze": LightThunder,
-        "heavy thunderstorm rain hail haze": LightThunder,
-        "thunderstorm hail fog": ThunderStorm,
-        "light thunderstorm rain hail fog": LightThunder,
-        "heavy thunderstorm rain hail fog":LightThunder,
-        "heavy thunderstorms and heavy rain": LightThunder,
-        "thunderstorms and rain": LightThunder,
-        "thunderstorms and rain and fog/mist": LightThunder,
-        "thunderstorm light rain hail":LightThunder,
-        "thunderstorm heavy rain hail": Tstorms,
-        "thunderstorm rain hail fog/mist": Tstorms,
-        "thunderstorm light rain hail fog/mist": Tstorms,
-        "thunderstorm heavy rain hail fog/mist": Tstorms,
-        "thunderstorm in vicinity hail": ThunderStorm,
-        "thunderstorm in vicinity hail haze": ThunderStorm,
-        "thunderstorm haze in vicinity hail": ThunderStorm,
-        "thunderstorm light rain hail haze": LightThunder,
-        "thunderstorm heavy rain hail haze": LightThunder,
-        "thunderstorm hail fog": ThunderStorm,
-        "thunderstorm light rain hail fog": Tstorms,
-        "thunderstorm heavy rain hail fog": Tstorms,
-        "thunderstorm small hail/snow pellets": Tstorms,
-        "thunderstorm rain small hail/snow pellets": Tstorms,
-        "thunderstorms": Tstorms,
-        "light thunderstorm rain small hail/snow pellets": Tstorms,
-        "heavy thunderstorm rain small hail/snow pellets": Tstorms,
-        "rain ice pellets": SnowRain,
-        "light rain ice pellets": SnowRain,
-        "heavy rain ice pellets": SnowRain,
-        "Drizzle Ice Pellets": SnowRain,
-        "light drizzle ice pellets": SnowRain,
-        "heavy drizzle ice pellets": SnowRain,
-        "ice pellets rain": SnowRain,
-        "light ice pellets rain": SnowRain,
-        "heavy ice pellets rain": SnowRain,
-        "ice pellets drizzle": SnowRain,
-        "light ice pellets drizzle": SnowRain,
-        "heavy ice pellets drizzle": SnowRain,
-        "freezing rain": SnowRain,
-        "freezing drizzle": SnowRain,
-        "light freezing rain": SnowRain,
-        "light freezing drizzle": SnowRain,
-        "heavy freezing rain": SnowRain,
-        "heavy freezing drizzle": SnowRain,
-        "freezing rain in vicinity": SnowRain,
-        "freezing drizzle in vicinity": SnowRain,
-        "freezing rain rain": SnowRain,
-        "light freezing rain rain": SnowRain,
-        "heavy freezing rain rain": SnowRain,
-        "rain freezing rain": SnowRain,
-        "light rain freezing rain": SnowRain,
-        "heavy rain freezing rain": SnowRain,
-        "freezing drizzle rain": SnowRain,
-        "light freezing drizzle rain": SnowRain,
-        "heavy freezing drizzle rain": SnowRain,
-        "rain freezing drizzle": SnowRain,
-        "light rain freezing drizzle": SnowRain,
-        "heavy rain freezing drizzle": SnowRain,
-        "freezing rain snow": SnowRain,
-        "light freezing rain snow": SnowRain,
-        "heavy freezing rain snow": SnowRain,
-        "freezing drizzle snow": SnowRain,
-        "light freezing drizzle snow": SnowRain,
-        "heavy freezing drizzle snow": SnowRain,
-        "snow freezing rain": SnowRain,
-        "light snow freezing rain": SnowRain,
-        "heavy snow freezing rain": SnowRain,
-        "snow freezing drizzle": SnowRain,
-        "light snow freezing drizzle": SnowRain,
-        "heavy snow freezing drizzle": SnowRain,
-        "ice pellets": Ice,
-        "light ice pellets": Ice,
-        "heavy ice pellets": Ice,
-        "ice pellets in vicinity": Ice,
-        "showers ice pellets": Ice,
-        "thunderstorm ice pellets": Ice,
-        "ice crystals": Ice,
-        "hail": Ice,
-        "small hail/snow pellets": Ice,
-        "light small hail/snow pellets": Ice,
-        "heavy small hail/snow pellets": Ice,
-        "showers hail": Ice,
-        "hail showers": Ice,
-        "snow ice pellets": Ice,
-        "rain snow": SnowRain,
-        "light rain snow": SnowRain,
-        "heavy rain snow": SnowRain,
-        "snow rain": SnowRain,
-        "light snow rain": SnowRain,
-        "heavy snow rain": SnowRain,
-        "drizzle snow": SnowRain,
-        "light drizzle snow": SnowRain,
-        "heavy drizzle snow": SnowRain,
-        "snow drizzle": SnowRain,
-        "light snow drizzle": SnowRain,
-        "heavy drizzle snow": SnowRain,
-        "snow": Snow,
-        "light snow": Snow,
-        "heavy snow": Snow,
-        "snow showers": Snow,
-        "light snow showers": Snow,
-        "heavy snow showers": Snow,
-        "showers snow": Snow,
-        "light showers snow": Snow,
-        "heavy showers snow": Snow,
-        "snow fog/mist": Snow,
-        "light snow fog/mist": Snow,
-        "light snow and fog/mist": Snow,
-        "heavy snow fog/mist": Snow,
-        "snow showers fog/mist": Snow,
-        "light snow showers fog/mist": Snow,
-        "heavy snow showers fog/mist": Snow,
-        "showers snow fog/mist": Snow,
-        "light showers snow fog/mist": Snow,
-        "heavy showers snow fog/mist": Snow,
-        "snow fog": Snow,
-        "light snow fog": Snow,
-        "heavy snow fog": Snow,
-        "snow showers fog": Snow,
-        "light showers snow fog/mist": Snow,
-        "heavy showers snow fog/mist": Snow,
-        "snow fog": Snow,
-        "light snow fog": Snow,
-        "heavy snow fog": Snow,
-        "snow showers fog": Snow,
-        "light snow showers fOg": Snow,
-        "heavy snow showers fog": Snow,
-        "showers in vicinity snow": Snow,
-        "snow showers in vicinity": Snow,
-        "snow showers in vicinity fog/mist": Snow,
-        "snow showers in vicinity fog": Snow,
-        "low drifting snow": Snow,
-        "blowing snow": Snow,
-        "snow and blowing snow": Snow,
-        "snow low drifting snow": Snow,
-        "snow blowing snow": Snow,
-        "light snow low drifting snow": Snow,
-        "light snow blowing snow": Snow,
-        "light snow blowing snow fog/mist": Snow,
-        "heavy snow low drifting snow": Snow,
-        "heavy snow blowing snow": Snow,
-        "thunderstorm snow": Snow,
-        "light thunderstorm snow": Snow,
-        "heavy thunderstorm snow": Snow,
-        "snow grains": Snow,
-        "light snow grains": Snow,
-        "heavy snow grains": Snow,
-        "heavy blowing snow": Snow,
-        "blowing snow in vicinity": Snow,
-        "funnel cloud": Tornado,
-        "funnel cloud in vicinity": Tornado,
-        "tornado/water spout": Tornado,
-        "tornado": Tornado,
-        "hurricane warming": Hurricane,
-        "hurricane watch": Hurricane,
-        "tropical storm warning": Coastal_Storm,
-        "tropical storm watch": Coastal_Storm,
-        "tropical storm conditions presently exist w/hurricane warning in effect": Coastal_Storm,
-        "windy": Windy,
-        "breezy": Windy,
-        "fair and windy": Windy,
-        "a few clouds and windy": Windy,
-        "partly cloudy and windy": Windy,
-        "mostly cloudy and windy": Windy,
-        "overcast and windy": Windy,
-        "smoke": Smog,
-        "haze": Haze,
-        "hot": Mostly_Clear,
-        "cold": Ice,
-        "blizzard": Snow,
-        "freezing fog": Foggy,
-        "partial fog": Foggy,
-        "patches of fog": Foggy,
-        "fog in vicinity": Foggy,
-        "freezing fog in vicinity": Foggy,
-        "shallow fog in vincinity": Foggy,
-        "partial fog in vincinity": Foggy,
-        "patches of fog in vicinity": Foggy,
-        "showers in vicinity fog": Foggy,
-        "light freezing fog": Foggy,
-        "heavy freezing fog": Foggy,
-	"fog": Foggy
-    }
-
-    # Return UNICODE value for emoji
-    return(weather_conditions.get(weather.lower(), "❓"))
+@functools.lru_cache(maxsize=512)
+def classify_wx_description(description):
+    intensity, vicinity, phenomena = parse_wx_description(description)
+    if not phenomena:
+        return(None)
+
+    # Showers in the vicinity are not falling on the station.  Automated
+    # stations report precipitation they can't tell the type of (often in
+    # winter) as "Unknown Precipitation", it counts as wet like rain.
+    nearby_showers = vicinity and 'showers' in phenomena
+    wet = not nearby_showers and bool(phenomena & {'rain', 'showers', 'precipitation'})
+
+    if 'tornado' in phenomena:
+        return('Tornado')
+    if 'tropical_storm' in phenomena:
+        return('Coastal_Storm')
+    if 'hurricane' in phenomena:
+        return('Hurricane')
+    if 'thunderstorm' in phenomena:
+        if 'snow' in phenomena:
+            return('Snow')
+        if 'ice_pellets' in phenomena and not wet:
+            return('Ice')
+        if 'small_hail' in phenomena:
+            return('Tstorms')
+        if wet:
+            if intensity == 'light':
+                return('LightThunder')
+            return('Tstorms')
+        if phenomena == {'thunderstorm'} and not vicinity:
+            return('Tstorms')
+        # Dry thunder, in the vicinity or with only fog/haze/hail
+        return('ThunderStorm')
+    if 'blizzard' in phenomena:
+        return('Snow')
+    if 'freezing_rain' in phenomena:
+        return('SnowRain')
+    if wet and 'rain' in phenomena and ('snow' in phenomena or 'ice_pellets' in phenomena):
+        return('SnowRain')
+    if phenomena & {'ice_pellets', 'ice_crystals', 'hail', 'small_hail'}:
+        return('Ice')
+    if 'snow' in phenomena:
+        return('Snow')
+    if wet and phenomena & {'rain', 'precipitation'}:
+        return('Rainy')
+    if wet:
+        return('Showers')
+    if 'fog' in phenomena:
+        return('Foggy')
+    if nearby_showers:
+        return('Showers')
+    if 'smoke' in phenomena:
+        return('Smog')
+    if 'dust' in phenomena:
+        return('Haze')
+    if 'windy' in phenomena:
+        return('Windy')
+    for sky in WX_SKY_ICONS:
+        if sky in phenomena:
+            if 'haze' in phenomena:
+                return(WX_SKY_HAZE_ICONS[sky])
+            return(WX_SKY_ICONS[sky])
+    if 'haze' in phenomena:
+        return('Haze')
+    if 'breezy' in phenomena:
+        return('Windy')
+    if 'hot' in phenomena:
+        return('Mostly_Clear')
+    if 'cold' in phenomena:
+        return('Ice')
+    return(None)
+
+#############################################################################
+# Return UNICODE value for weather emoji, iconset comes from get_icon_type()
+#############################################################################
+@timed('emoji')
+def get_wx_emoji(weather,iconset):
+    if not weather:
+        return(WX_UNKNOWN_ICON)
+    icon_name = classify_wx_description(weather)
+    return(WX_ICONS[iconset].get(icon_name, WX_UNKNOWN_ICON))
+
 #############################################################################
 # Print Weather Forecast to screen 
 #############################################################################
-def display_weather_forecast(station_id):
+@timed('forecast')
+def display_weather_forecast(station_id, stdout=None):
 
     # This function "prints" the forecast for given stationID.  It really should
     # just return a data structure but for now this does the job.
+    import shutil
     
     stationID,stationName,stationLON,stationLAT = get_wx_station_info(station_id)
 
     # Get Station Forecast Information
-    station_forecast_url = '{}/points/{},{}' . format(API_URL, stationLAT, stationLON)
-    forecast_station_data = urlreq(station_forecast_url)
-
-    #pretty_json = json.dumps(forecast_station_data, indent=4)
-    #print (pretty_json)
+    grid = get_wx_station_grid(stationID, stationLAT, stationLON)
 
     # This is the URL we parse for forecast data
-    forecast_url = forecast_station_data["properties"]["forecast"]
+    forecast_url = grid["forecast_url"]
     forecast_grid_data = urlreq(forecast_url)
 
     # Print Header
     header = 'Forecast Information for {}({})' . format(stationName, stationID)
-    print(header)
-    print('')
+    print(header, file=stdout)
+    if forecast_grid_data.get(STALE_KEY) is not None:
+        print(stale_note(forecast_grid_data[STALE_KEY]), file=stdout)
+    print('', file=stdout)
     # Print the Forecast 
     for period in forecast_grid_data["properties"]["periods"]:
         DashNumber = len(period['name'])
@@ -618,18 +1322,295 @@ def display_weather_forecast(station_id):
         seperator = "-" * DashNumber
         centered_seperator = seperator.center(cwidth)
         #print (period['name'])
-        print (centered_PeriodName)
-        print (centered_seperator)
+        print (centered_PeriodName, file=stdout)
+        print (centered_seperator, file=stdout)
         #print ("-" * DashNumber)
-        print (period['detailedForecast'])
-        print ("*" * cwidth)
+        print (period['detailedForecast'], file=stdout)
+        print ("*" * cwidth, file=stdout)
 
     return()
-    
+
+#############################################################################
+# Fetch station info and latest observation -- this is the network part of
+# display_weather_data() and is what runs in the worker pool
+#############################################################################
+def fetch_weather_data(station_id, revalidate=False):
+
+    #api_url = 'https://api.weather.gov'
+    api_url = API_URL
+    station_info = get_wx_station_info(station_id)
+
+    # Get Station Data Information
+    station_data_url = '{}/stations/{}/observations/latest' . format(api_url, station_id)
+    data = urlreq(station_data_url, revalidate=revalidate)
+
+    return(station_info, data)
+
+#############################################################################
+# Look up a station's observation -- in daemon mode this is served from the
+# in-memory set kept fresh by the refresh loop, and any station asked for
+# gets subscribed to it
+#############################################################################
+def get_weather_data(station_id):
+    if WARM_OBSERVATIONS is None:
+        return(fetch_weather_data(station_id))
+
+    key = station_id.upper()
+    with WARM_LOCK:
+        warm = WARM_OBSERVATIONS.get(key)
+    if warm is not None:
+        return(warm[1])
+
+    observation = as_observation(fetch_weather_data(station_id))
+    with WARM_LOCK:
+        WARM_OBSERVATIONS[key] = (time.time(), observation)
+    return(observation)
+
+#############################################################################
+# Fetch many stations with a bounded pool of workers.  Yields
+# (station_id, observation, error) in input order, or as each one
+# finishes when as_completed is set.  fetch replaces get_weather_data()
+# for fetching something else per station.
+#############################################################################
+def fetch_weather_data_many(station_ids, jobs, as_completed=False, revalidate=False, fetch=None):
+    import concurrent.futures
+    if fetch is None and revalidate:
+        fetch = functools.partial(fetch_weather_data, revalidate=True)
+    elif fetch is None:
+        fetch = get_weather_data
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = {executor.submit(fetch, station_id): station_id for station_id in station_ids}
+        if as_completed:
+            ordered = concurrent.futures.as_completed(futures)
+        else:
+            ordered = futures
+        for future in ordered:
+            station_id = futures[future]
+            try:
+                yield (station_id, future.result(), None)
+            except (WeatherAPIError, LookupError, TypeError, ValueError) as err:
+                yield (station_id, None, err)
+
+#############################################################################
+# Field descriptors -- the measured values an observation carries.  Each
+# FieldDescriptor has the template field name (with field_unit next to it),
+# the display option that picks it, its title in the default layout, the
+# path to the value under the observation's properties, the kind of value
+# (which DISPLAY_CONVERTERS/record_value() converter applies), what to show
+# instead of a value of 0 (zero) and its key in --format records
+# (record_key).  Only the fields asked for are ever looked up.
+#############################################################################
+def display_percent(value, metricflag=False):
+    if value is None:
+        return(None, '')
+    return(round(value), '%')
+
+def display_pressure(value, metricflag=False):
+    return(p_to_i(value), '')
+
+def display_compass(value, metricflag=False):
+    return(angle2compass(value), '')
+
+DISPLAY_CONVERTERS = {'temp': calc_temp, 'speed': calc_wind, 'percent': display_percent,
+                      'pressure': display_pressure, 'angle': display_compass}
+
+FieldDescriptor = collections.namedtuple('FieldDescriptor', ('field', 'option', 'title', 'path', 'kind', 'zero', 'record_key'))
+
+FIELD_DESCRIPTORS = (
+    FieldDescriptor('temp', 'display_temp', 'Current Temperature: ', ('temperature', 'value'), 'temp', None, 'temperature'),
+    FieldDescriptor('humidity', 'display_humidity', 'Current Humidity: ', ('relativeHumidity', 'value'), 'percent', None, 'humidity'),
+    FieldDescriptor('dewpoint', 'display_dewpoint', 'Current Dewpoint: ', ('dewpoint', 'value'), 'temp', None, 'dewpoint'),
+    FieldDescriptor('pressure', 'display_pressure', 'Current Pressure: ', ('barometricPressure', 'value'), 'pressure', None, 'pressure'),
+    FieldDescriptor('windchill', 'display_windchill', 'Current windchill: ', ('windChill', 'value'), 'temp', None, 'windchill'),
+    FieldDescriptor('heatindex', 'display_heatindex', 'Current Heatindex: ', ('heatIndex', 'value'), 'temp', None, 'heatindex'),
+    FieldDescriptor('wind', 'display_windspeed', 'Current Wind: ', ('windSpeed', 'value'), 'speed', 'Calm', 'wind_speed'),
+    FieldDescriptor('wind_gust', 'display_windgust', 'Current Wind Gust: ', ('windGust', 'value'), 'speed', None, 'wind_gust'),
+    FieldDescriptor('wind_dir', 'display_winddirection', 'Current Wind Direction: ', ('windDirection', 'value'), 'angle', 'N/A', 'wind_direction'),
+)
+
+# Walk path down from properties, None if any step is missing
+def field_value(properties, path):
+    value = properties
+    for key in path:
+        if not isinstance(value, dict):
+            return(None)
+        value = value.get(key)
+    return(value)
+
+#############################################################################
+# Compact observations -- a station and its latest observation as slots
+# holding just what the output code reads, a few hundred bytes where the
+# nested GeoJSON dicts urlreq() returns take several KB.  The daemon and
+# weather.exporter.py keep one per station and let go of the decoded
+# payload as soon as it is converted.  Measured values are kept as the API
+# sent them, under their FIELD_DESCRIPTORS field name.
+#############################################################################
+class Observation(object):
+    __slots__ = ('station_id', 'name', 'latitude', 'longitude', 'timestamp', 'description', 'stale') + tuple(descriptor.field for descriptor in FIELD_DESCRIPTORS)
+
+    @classmethod
+    def from_payload(cls, station_info, data):
+        self = cls()
+        self.station_id, self.name, self.longitude, self.latitude = station_info
+        properties = data["properties"]
+        # Stations reporting together share the same timestamp and a
+        # handful of descriptions cover most of them
+        self.timestamp = sys.intern(properties["timestamp"])
+        description = properties.get("textDescription")
+        self.description = None if description is None else sys.intern(description)
+        self.stale = data.get(STALE_KEY)
+        for descriptor in FIELD_DESCRIPTORS:
+            setattr(self, descriptor.field, field_value(properties, descriptor.path))
+        return(self)
+
+# Take either an Observation or the (station_info, data) fetch_weather_data()
+# returns
+def as_observation(observation):
+    if isinstance(observation, Observation):
+        return(observation)
+    station_info, data = observation
+    return(Observation.from_payload(station_info, data))
+
+#############################################################################
+# Output templates -- every line display_weather_data() prints, and a
+# user's --template, is a format string over the fields in
+# TEMPLATE_GROUPS.  compile_template() parses one once into a render
+# function taking the station's context (its Observation and the metric
+# flag); each group computes a few related fields and only runs if the
+# template uses one of them.
+#############################################################################
+def template_station(context):
+    observation = context['observation']
+    return({'station': observation.station_id, 'name': observation.name, 'latitude': observation.latitude, 'longitude': observation.longitude})
+
+def template_timestamp(context):
+    return({'timestamp': clean_timestamp(context['observation'].timestamp)})
+
+def template_sun(context):
+    observation = context['observation']
+    sunrise, sunset = get_sunrise_sunset(observation.latitude, observation.longitude)
+    return({'sunrise': sunrise, 'sunset': sunset})
+
+def template_weather(context):
+    return({'weather': context['observation'].description})
+
+def template_icon(context):
+    observation = context['observation']
+    return({'icon': get_wx_emoji(observation.description, get_icon_type(observation.latitude, observation.longitude))})
+
+def template_field(descriptor):
+    field = descriptor.field
+    convert = DISPLAY_CONVERTERS[descriptor.kind]
+    def group(context):
+        raw = getattr(context['observation'], field)
+        value, unit = convert(raw, context['metric'])
+        # A wind direction of 0 comes with calm wind, its compass name is N
+        if descriptor.zero is not None and (value == 0 or raw == 0):
+            value, unit = descriptor.zero, ''
+        return({field: value, field + '_unit': unit})
+    return(group)
+
+def template_stale(context):
+    return({'stale': 'stale' if context['observation'].stale is not None else ''})
+
+TEMPLATE_GROUPS = (
+    (('station', 'name', 'latitude', 'longitude'), template_station),
+    (('timestamp',), template_timestamp),
+    (('sunrise', 'sunset'), template_sun),
+    (('weather',), template_weather),
+    (('icon',), template_icon),
+) + tuple(((descriptor.field, descriptor.field + '_unit'), template_field(descriptor)) for descriptor in FIELD_DESCRIPTORS) + (
+    (('stale',), template_stale),
+)
+TEMPLATE_FIELDS = {field: group for fields, group in TEMPLATE_GROUPS for field in fields}
+
+# Raises ValueError for a bad template or an unknown field
+@functools.lru_cache(maxsize=None)
+def compile_template(template):
+    import string
+    steps = []
+    groups = []
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if field is None:
+            steps.append((literal, None, '', None))
+            continue
+        if field not in TEMPLATE_FIELDS:
+            raise ValueError("unknown field {{{}}}, fields are: {}" . format(field, ' ' . join(TEMPLATE_FIELDS)))
+        if '{' in spec:
+            raise ValueError("nested fields are not supported in {{{}:{}}}" . format(field, spec))
+        if conversion not in (None, 's', 'r', 'a'):
+            raise ValueError("unknown conversion !{} in {{{}}}" . format(conversion, field))
+        if TEMPLATE_FIELDS[field] not in groups:
+            groups.append(TEMPLATE_FIELDS[field])
+        steps.append((literal, field, spec, conversion))
+    steps = tuple(steps)
+    groups = tuple(groups)
+
+    def render(context):
+        # Groups other lines already ran for this station are reused
+        values = context.setdefault('values', {})
+        done = context.setdefault('groups', set())
+        for group in groups:
+            if group not in done:
+                values.update(group(context))
+                done.add(group)
+        parts = []
+        for literal, field, spec, conversion in steps:
+            parts.append(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 'a':
+                value = ascii(value)
+            elif conversion == 's' or value is None:
+                value = str(value)
+            try:
+                parts.append(format(value, spec))
+            except ValueError:
+                # A number spec on a value that is text this time
+                parts.append(str(value))
+        return(''.join(parts))
+    return(render)
+
+# The default layout: the header, then the weather line and one line per
+# FIELD_DESCRIPTORS option picked, titles are left out with --valuesonly
+WEATHER_TITLE = 'Current Weather: '
+DISPLAY_HEADER = (
+    "=" * 60,
+    "Station: {station:<10}{name}",
+    "Timestamp: {timestamp}",
+    "Coordinates: LON[{longitude}], LAT[{latitude}]",
+    "Sunrise: {sunrise}, Sunset: {sunset}",
+    "=" * 60,
+)
+
+#############################################################################
+# Print list returned by display_weather_data(), one line or '|' delimited
+#############################################################################
+@timed('print')
+def print_weather_data(station_id, weather_display_list, options, multi_station=False, stdout=None):
+    if options['display_template'] is not None:
+        # {station} is there for telling stations apart
+        for item in weather_display_list:
+            print(item, file=stdout)
+    elif options['display_script']:
+        if multi_station:
+            weather_display_list = [station_id] + weather_display_list
+        if weather_display_list:
+            print ("|" . join(str(item) for item in weather_display_list), file=stdout)
+    else:
+        if multi_station and not options['display_headers']:
+            print ("{}:" . format(station_id), file=stdout)
+        for item in weather_display_list:
+            print(item, file=stdout)
+
 #############################################################################
 # Print Weather Data to screen based on options
 #############################################################################
-def display_weather_data(station_id, options):
+@timed('render')
+def display_weather_data(station_id, options, observation=None, stdout=None):
     
     weather_display_list = []
 
@@ -638,319 +1619,555 @@ def display_weather_data(station_id, options):
     else:
         metricflag = False
 
-    #api_url = 'https://api.weather.gov'
-    api_url = API_URL
-    # Get Station Information
-    #station_url = '{}/stations/{}' . format(api_url, station_id)
-
-    stationID,stationName,stationLON,stationLAT = get_wx_station_info(station_id)
-
-    # Get Station Data Information
-    station_data_url = '{}/stations/{}/observations/latest' . format(api_url, station_id)
-    data = urlreq(station_data_url)
-
-    # Values from station data
-    current_timestamp = data["properties"]["timestamp"]
-
-    # Create dictionary used for titles:
-    titles_dict = {'weather':'Current Weather: ', 'temperature':'Current Temperature: ', 'humidity': 'Current Humidity: ',
-                   'dewpoint':'Current Dewpoint: ', 'pressure':'Current Pressure: ', 'windchill':'Current windchill: ',
-                   'heatindex':'Current Heatindex: ', 'wind':'Current Wind: ', 'windgust':'Current Wind Gust: ', 'winddir':'Current Wind Direction: ' 
-                  }
+    # Use prefetched data when called from the multi-station worker pool
+    if observation is None:
+        observation = get_weather_data(station_id)
+    observation = as_observation(observation)
 
-    if (options['display_notitles']):
-        # zero out all values in titles_dict
-        for key in titles_dict:
-            titles_dict[key] = ''
+    context = {'observation': observation, 'metric': metricflag}
 
-    # Get sunrise and sunset times of station for current date
-    sunrise,sunset = get_sunrise_sunset(stationLAT,stationLON)
+    # A --template replaces the whole layout with one line
+    if options['display_template'] is not None:
+        return([compile_template(options['display_template'])(context)])
 
     ####################################################################
     # Display Weather Station Header Information
     ####################################################################
     if (options['display_headers']):
-        current_timestamp = clean_timestamp(current_timestamp)
-        print ("=" * 60)    
-        print ("Station: {:<10}{}" . format(stationID, stationName))
-        print ("Timestamp: {}" . format(current_timestamp))
-        print ("Coordinates: LON[{}], LAT[{}]" . format(stationLON, stationLAT))
-        print ("Sunrise: {}, Sunset: {}" . format(sunrise, sunset))
-        print ("=" * 60)    
-    # Display values based on options
+        for line in DISPLAY_HEADER:
+            print (compile_template(line)(context), file=stdout)
+
     ####################################################################
-    # Display Weather Conditions
+    # Display Weather Conditions, with --script the icon is a field of
+    # its own
     ####################################################################
+    templates = []
     if (options['display_weather']):
-        current_weather = data["properties"]["textDescription"]
-        title = titles_dict['weather']
-        if display_icon:
-            weather_icon = get_wx_emoji(current_weather,sunrise,sunset)
-            if not icononly:
-                if scriptFlag:
-                    weather_display_icon = "{}{}" . format(title,weather_icon)
-                    weather_display_format = "{}{}" . format(title,current_weather)
-                else:
-                    weather_display_format = "{}{}{}" . format(title,current_weather,weather_icon)
-            else:
-                weather_display_format = "{}{}" . format(title,weather_icon)
+        title = '' if options['display_notitles'] else WEATHER_TITLE
+        if not options['display_icon']:
+            templates.append(title + '{weather}')
+        elif options['display_icononly']:
+            templates.append(title + '{icon}')
+        elif options['display_script']:
+            templates.extend([title + '{weather}', title + '{icon}'])
         else:
-             weather_display_format = "{}{}" . format(title,current_weather)
-
-        weather_display_list.append(weather_display_format)
-        if display_icon:
-            if scriptFlag:
-                if not icononly:
-                    weather_display_list.append(weather_display_icon)
-        
-    ####################################################################
-    # Display Temperature
-    ####################################################################
-    if (options['display_temp']):
-        current_temp = data["properties"]["temperature"]["value"]
-        current_temp,unit=calc_temp(current_temp,metricflag)
-        title = titles_dict['temperature']
-        temp_display_format = "{}{}{}" . format(title,current_temp,unit)
-        weather_display_list.append(temp_display_format)
+            templates.append(title + '{weather}{icon}')
 
     ####################################################################
-    # Display Humidity
+    # Display the other values picked, in FIELD_DESCRIPTORS order
     ####################################################################
-    if (options['display_humidity']):
-        current_humidity = data["properties"]["relativeHumidity"]["value"]
-        if current_humidity is not None:
-            current_humidity = round(current_humidity)
-            unit = '%'
-        title = titles_dict['humidity']
-        humidity_display_format = "{}{}{}" . format(title,current_humidity,unit)
-        weather_display_list.append(humidity_display_format)
+    for descriptor in FIELD_DESCRIPTORS:
+        if options[descriptor.option]:
+            title = '' if options['display_notitles'] else descriptor.title
+            templates.append('%s{%s}{%s_unit}' % (title, descriptor.field, descriptor.field))
 
-    ####################################################################
-    # Display dewpoint
-    ####################################################################
-    if (options['display_dewpoint']):
-        current_dewpoint = data["properties"]["dewpoint"]["value"]
-        current_dewpoint,unit = calc_temp(current_dewpoint,metricflag)
-        title = titles_dict['dewpoint']
-        dewpoint_display_format = "{}{}{}" . format(title,current_dewpoint,unit)
-        weather_display_list.append(dewpoint_display_format)
+    for template in templates:
+        weather_display_list.append(compile_template(template)(context))
 
     ####################################################################
-    # Display Barametric Pressure
+    # Mark data urlreq() fell back to the cache for
     ####################################################################
-    if (options['display_pressure']):
-        current_pressure = data["properties"]["barometricPressure"]["value"]
-        title = titles_dict['pressure']
-        current_pressure = p_to_i(current_pressure)
-        pressure_display_format = "{}{}" . format(title,current_pressure,unit)
-        weather_display_list.append(pressure_display_format)
+    stale = observation.stale
+    if stale is not None and not options['display_icononly']:
+        if options['display_script']:
+            weather_display_list.append('stale')
+        else:
+            weather_display_list.append(stale_note(stale))
 
-    ####################################################################
-    # Display Windchill 
-    ####################################################################
-    if (options['display_windchill']):
-        current_windchill = data["properties"]["windChill"]["value"]
-        current_windchill,unit = calc_temp(current_windchill,metricflag)
-        title = titles_dict['windchill']
-        windchill_display_format = "{}{}{}" . format(title,current_windchill,unit)
-        weather_display_list.append(windchill_display_format)
+    # return list of data to caller
+    return(weather_display_list)
 
-    ####################################################################
-    # Display Heat Index
-    ####################################################################
-    if (options['display_heatindex']):
-        current_heatindex = data["properties"]["heatIndex"]["value"]
-        current_heatindex,unit = calc_temp(current_heatindex,metricflag)
-        title = titles_dict['heatindex']
-        heatindex_display_format = "{}{}{}" . format(title,current_heatindex,unit)
-        weather_display_list.append(heatindex_display_format)
+#############################################################################
+# Choices for options handled in weather_parts -- the --format names (see
+# write_records()) and QUERY_FIELDS, which maps the names --query takes to
+# (history column, kind of value) so results come out in the same units as
+# display_weather_data()
+#############################################################################
+RECORD_FORMATS = ('text', 'json', 'jsonl', 'msgpack')
+
+QUERY_FIELDS = {
+    'temperature': ('temperature', 'temp'),
+    'dewpoint': ('dewpoint', 'temp'),
+    'humidity': ('relative_humidity', 'percent'),
+    'pressure': ('barometric_pressure', 'pressure'),
+    'wind': ('wind_speed', 'wind'),
+    'windgust': ('wind_gust', 'wind'),
+    'windchill': ('wind_chill', 'temp'),
+    'heatindex': ('heat_index', 'temp'),
+}
+QUERY_PERIODS = ('hour', 'day', 'total')
+
+#############################################################################
+# Build the argument parser -- shared by the CLI and the daemon, which parses
+# the arguments forwarded by each client
+#############################################################################
+def build_parser():
+    import argparse
+    parser = argparse.ArgumentParser(usage='%(prog)s [options] StationID [StationID ...]',description='Utlilty for printing weather conditions')
+    parser.add_argument("stationID", metavar="StationID", type=str, nargs='*', help="The name of the wx station ID(s) to get condition from")
+    parser.add_argument("-t", "--temp", help="Print temparature for given stationID", action="store_true", default=False)
+    parser.add_argument("-H", "--humidity", help="Print humidity for given stationID", action="store_true", default=False)
+    parser.add_argument("-d", "--dewpoint", help="Print dewpoint for given stationID", action="store_true", default=False)
+    parser.add_argument("-w", "--weather", help="Print weather for given stationID", action="store_true", default=False)
+    parser.add_argument("-p", "--pressure", help="Print barametric pressure for given stationID", action="store_true", default=False)
+    parser.add_argument("-W", "--windchill", help="Print windchill for given stationID", action="store_true", default=False)
+    parser.add_argument("-i", "--heatindex", help="Print heatindex for given stationID", action="store_true", default=False)
+    parser.add_argument("-c", "--winddirection", help="Print wind direction for given stationID", action="store_true", default=False)
+    parser.add_argument("-g", "--windgust", help="Print wind gust for given stationID", action="store_true", default=False)
+    parser.add_argument("-s", "--windspeed", help="Print wind speed for given stationID", action="store_true", default=False)
+    parser.add_argument("--forecast", help="Print Forecast for given StationID", action="store_true", default=False)
+    parser.add_argument("--hourly", help="Print hourly temperature, dewpoint, precipitation, sky cover and wind from the forecast grid data for given StationID(s)", action="store_true")
+    parser.add_argument("--hours", metavar="N", type=int, default=GRID_HOURS_DEFAULT, help="How many hours --hourly prints (default {})" . format(GRID_HOURS_DEFAULT))
+    parser.add_argument("--at", metavar="TIME", help="Print the --hourly values at TIME instead, an ISO 8601 time (local unless it has an offset) or +HOURS from now")
+    parser.add_argument("--script", help="Print all data formated on a single line for parsing by external script", action="store_true")
+    parser.add_argument("--metric", help="Print all data in metric units", action="store_true")
+    parser.add_argument("--valuesonly", help="Display on data values, no titles", action="store_true")
+    parser.add_argument("--noheaders", help="Don't display header with station info", action="store_true")
+    parser.add_argument("--allvalues", help="Dislay all data values", action="store_true")
+    parser.add_argument("--icon", help="Display weather icon for weather value", action="store_true")
+    parser.add_argument("--icononly", help="only display icons for weather value", action="store_true")
+    parser.add_argument("--template", metavar="TEMPLATE", help="Print one line per station laid out by TEMPLATE, e.g. '{icon} {temp}{temp_unit} {wind_dir} {wind}', fields are: " + ' ' . join('{%s}' % field for field in TEMPLATE_FIELDS))
+    parser.add_argument("--format", choices=RECORD_FORMATS, default='text', help="Output format, json/jsonl/msgpack print typed values for all fields unless some are picked (default text)")
+    parser.add_argument("--no-cache", help="Bypass the on-disk response cache", action="store_true")
+    parser.add_argument("--stations-file", metavar="FILE", help="Read StationIDs from FILE, one per line ('-' for stdin)")
+    parser.add_argument("--near", metavar="LAT,LON", action="append", help="Print the stations closest to LAT,LON (may be repeated)")
+    parser.add_argument("--near-file", metavar="FILE", help="Read LAT,LON points for --near from FILE, one per line ('-' for stdin)")
+    parser.add_argument("-k", "--nearest", metavar="N", type=int, default=1, help="How many stations --near prints per point (default 1)")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=8, help="Number of stations to fetch concurrently (default 8)")
+    parser.add_argument("--as-completed", help="Print stations as they finish instead of in input order", action="store_true")
+    parser.add_argument("--timeout", metavar="SECONDS", type=float, default=HTTP_READ_TIMEOUT, help="Read timeout for API requests (default {})" . format(HTTP_READ_TIMEOUT))
+    parser.add_argument("--deadline", metavar="MS", type=float, help="If fresh data is not in within MS milliseconds use the cached copy marked stale and refresh it in the background")
+    parser.add_argument("--timings", action="store_true", default=False, help="Write how long each phase (DNS, connect, TLS, server, download, decode, rendering, ...) took, bytes read and cache hits as a json record to stderr, WEATHER_TIMINGS=1 does the same")
+    parser.add_argument("--timings-file", metavar="FILE", help="Append the --timings record to FILE instead, WEATHER_TIMINGS=FILE does the same")
+    parser.add_argument("--retries", metavar="N", type=int, default=HTTP_RETRIES, help="Retries on connection errors and 429/5xx responses (default {})" . format(HTTP_RETRIES))
     
-    ####################################################################
-    # Display Wind
-    ####################################################################
-    if (options['display_windspeed']):
-        current_wind_speed = data["properties"]["windSpeed"]["value"]
-        current_wind_speed,unit = calc_wind(current_wind_speed,metricflag)
-        if current_wind_speed == 0:
-            current_wind_speed = "Calm"
-            unit = ''
-        title = titles_dict['wind']
-        wind_display_format = "{}{}{}" . format(title,current_wind_speed,unit)
-        weather_display_list.append(wind_display_format)
+    parser.add_argument("--export-bundle", metavar="FILE", help="Save what the given StationID(s) need to FILE for use with --offline")
+    parser.add_argument("--offline", action="store_true", default=False, help="Answer from a bundle made by --export-bundle instead of the network, everything but --sync-history works offline")
+    parser.add_argument("--bundle", metavar="FILE", help="Bundle --offline reads (default {})" . format(BUNDLE_DEFAULT))
+    parser.add_argument("--sync-history", help="Store all observations newer than the last synced one for given StationID(s)", action="store_true")
+    parser.add_argument("--history-days", metavar="DAYS", type=int, default=HISTORY_DEFAULT_DAYS, help="How far back the first --sync-history goes (default {})" . format(HISTORY_DEFAULT_DAYS))
+    parser.add_argument("--record", help="Store the observations fetched by this run in the local history", action="store_true")
+    parser.add_argument("--query", metavar="FIELD", choices=sorted(QUERY_FIELDS), help="Print min/max/mean of FIELD from the local history, one of: {}" . format(', ' . join(sorted(QUERY_FIELDS))))
+    parser.add_argument("--period", choices=QUERY_PERIODS, default='day', help="Bucket --query results by hour, day or one total (default day)")
+    parser.add_argument("--days", metavar="DAYS", type=int, default=7, help="How many days back --query looks (default 7)")
+    parser.add_argument("--watch", help="Stay running, fetch again just after each station is expected to report and print only when values change", action="store_true")
+    parser.add_argument("--daemon", help="Stay resident and serve cached results over a unix socket", action="store_true")
+    parser.add_argument("--client", help="Ask a running --daemon for the result instead of fetching", action="store_true")
+    parser.add_argument("--socket", metavar="PATH", help="Unix socket used by --daemon and --client (default weather.py-UID.sock in $XDG_RUNTIME_DIR or /tmp)")
+    parser.add_argument("--refresh", metavar="SECONDS", type=int, default=DAEMON_REFRESH, help="How often --daemon refreshes subscribed stations (default {})" . format(DAEMON_REFRESH))
+
+    return(parser)
 
-    ####################################################################
-    # Display Wind Gust
-    ####################################################################
-    if (options['display_windgust']):
-        current_wind_gust = data["properties"]["windGust"]["value"]
-        current_wind_gust,unit = calc_wind(current_wind_gust,metricflag)
-        title = titles_dict['windgust']
-        windgust_display_format = "{}{}{}" . format(title,current_wind_gust,unit)
-        weather_display_list.append(windgust_display_format)
+#############################################################################
+# define options to pass to display_weather_data() based on command line options
+#############################################################################
+def build_display_options(args):
+    if args.forecast:
+        display_forecast = True
+    else:
+        display_forecast = False
+    if args.weather:
+        display_weather = True
+    else:
+        display_weather = False
+    if args.temp:
+        display_temp = True
+    else:
+        display_temp = False
+    if args.humidity:
+        display_humidity = True
+    else:
+        display_humidity = False
+    if args.windchill:
+        display_windchill = True
+    else:
+        display_windchill = False
+    if args.heatindex:
+        display_heatindex = True
+    else:
+        display_heatindex = False
+    if args.dewpoint:
+        display_dewpoint = True
+    else:
+        display_dewpoint = False
+    if args.winddirection:
+        display_winddirection = True
+    else:
+        display_winddirection = False
+    if args.windspeed:
+        display_windspeed = True
+    else:
+        display_windspeed = False
+    if args.windgust: 
+        display_windgust = True
+    else:
+        display_windgust = False
+    if args.pressure:
+        display_pressure = True
+    else:
+        display_pressure = False
 
-    ####################################################################
-    # Display Wind Direction
-    ####################################################################
-    if (options['display_winddirection']):
-        current_wind_direction = data["properties"]["windDirection"]["value"]
-        title = titles_dict['winddir']
-        current_wind_direction = angle2compass(current_wind_direction)
-        if current_wind_direction == 0:
-            current_wind_direction = 'N/A'
-        wind_direction_display_format = "{}{}" . format(title,current_wind_direction)
-        weather_display_list.append(wind_direction_display_format)
+    if args.metric:
+        display_metric = True
+    else:
+        display_metric = False
+
+    if args.valuesonly or args.script:
+        display_notitles = True
+    else:
+        display_notitles = False
+
+    if args.noheaders or args.script:
+        display_headers = False
+    else:
+        display_headers = True
+
+    if args.script:
+        display_script = True
+    else:
+        display_script = False
+
+    if args.icon:
+        display_icon = True
+    else:
+        display_icon = False
+
+    if args.icononly:
+        display_icon = True
+        icononly = True
+        display_headers = False
+        display_notitles = True
+    else:
+        icononly = False
+
+    display_options = { 'display_weather':display_weather, 'display_temp':display_temp, 'display_humidity':display_humidity, 'display_windchill':display_windchill, 
+                        'display_heatindex':display_heatindex, 'display_dewpoint': display_dewpoint, 'display_winddirection':display_winddirection, 'display_windspeed':display_windspeed,
+                        'display_windgust':display_windgust, 'display_pressure':display_pressure, 'display_metric':display_metric, 'display_notitles':display_notitles, 'display_headers':display_headers, 'display_icon':display_icon,
+                        'display_icononly':icononly, 'display_script':display_script, 'display_forecast':display_forecast,
+                        'display_template':args.template}
+
+    # Display all data values if --allvalues flag is set
+    if args.allvalues:
+        for key in display_options:
+            # we don't turn these flags on because they are not data related
+            if key in ("display_metric", "display_notitles", "display_headers", "display_icon", "display_icononly", "display_script", "display_forecast", "display_template"):
+                next
+            else:
+                display_options[key] = True
+
+    return(display_options)
 
-    # return list of data to caller
-    return(weather_display_list)
 #############################################################################
-# main() 
+# StationIDs from a --stations-file, one per line ('-' for stdin) with
+# blank lines and # comments skipped
+#############################################################################
+def read_stations_file(path):
+    if path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as stations_file:
+            lines = stations_file.readlines()
+    station_ids = []
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if line:
+            station_ids.append(line)
+    return(station_ids)
+
+#############################################################################
+# Print weather for the stations given on the command line to stdout and
+# stderr (sys.stdout/sys.stderr if not given), returns the exit status
+#############################################################################
+def run_weather(args, stdout=None, stderr=None):
+    if stderr is None:
+        stderr = sys.stderr
+    display_options = build_display_options(args)
+
+    station_ids = list(args.stationID)
+    if args.stations_file:
+        try:
+            station_ids.extend(read_stations_file(args.stations_file))
+        except OSError as err:
+            print ("{}: unable to read stations file: {}" . format(ME, err), file=stderr)
+            return(1)
+
+    if args.near or args.near_file:
+        from weather_parts.catalog import run_nearest
+        return(run_nearest(args, stdout, stderr))
+
+    if args.template is not None:
+        if args.format != 'text':
+            print ("{}: --template only applies to --format text" . format(ME), file=stderr)
+            return(1)
+        try:
+            compile_template(args.template)
+        except ValueError as err:
+            print ("{}: bad --template: {}" . format(ME, err), file=stderr)
+            return(1)
+
+    if not station_ids:
+        print ("{}: no StationID given" . format(ME), file=stderr)
+        return(1)
+
+    multi_station = len(station_ids) > 1
+    exit_status = 0
+
+    if args.export_bundle:
+        from weather_parts.bundle import export_bundle
+        return(export_bundle(args.export_bundle, station_ids, stdout, stderr))
+
+    if args.sync_history:
+        if OFFLINE_BUNDLE is not None:
+            print ("{}: --sync-history needs the network, it can not be used with --offline" . format(ME), file=stderr)
+            return(1)
+        import sqlite3
+        from weather_parts.history import sync_station_history
+        for station_id in station_ids:
+            try:
+                stored = sync_station_history(station_id, args.history_days)
+            except (WeatherAPIError, sqlite3.Error, OSError) as err:
+                print ("{}: unable to sync history: {}" . format(station_id, err), file=stderr)
+                exit_status = 1
+                continue
+            print ("{}: stored {} new observations" . format(station_id, stored), file=stdout)
+        return(exit_status)
+
+    if args.query:
+        import sqlite3
+        from weather_parts.history import display_history_query
+        for station_id in station_ids:
+            try:
+                display_history_query(station_id, args.query, args.period, args.days, display_options, stdout)
+            except (sqlite3.Error, OSError) as err:
+                print ("{}: unable to query history: {}" . format(station_id, err), file=stderr)
+                exit_status = 1
+        return(exit_status)
+
+    if args.hourly:
+        from weather_parts.grid import run_hourly
+        return(run_hourly(args, station_ids, display_options, stdout, stderr))
+
+    if display_options['display_forecast']:
+        for station_id in station_ids:
+            try:
+                weather_forecast_list = display_weather_forecast(station_id, stdout)
+            except WeatherAPIError as err:
+                print (err, file=stdout)
+                exit_status = 1
+        return(exit_status)
+
+    if args.watch:
+        from weather_parts.watch import run_watch
+        return(run_watch(args, station_ids, display_options))
+
+    if args.format != 'text':
+        from weather_parts.records import run_weather_records
+        return(run_weather_records(args, station_ids, display_options, stdout, stderr))
+
+    if args.record:
+        from weather_parts.history import record_observation
+
+    if not multi_station:
+        # Populate list with weather data
+        try:
+            observation = get_weather_data(station_ids[0])
+            weather_display_list = display_weather_data(station_ids[0], display_options, observation, stdout)
+        except WeatherAPIError as err:
+            print (err, file=stdout)
+            return(1)
+        print_weather_data(station_ids[0], weather_display_list, display_options, stdout=stdout)
+        if args.record:
+            record_observation(station_ids[0], observation, stderr)
+        return(0)
+
+    for station_id, observation, err in fetch_weather_data_many(station_ids, args.jobs, args.as_completed):
+        if err is None:
+            try:
+                weather_display_list = display_weather_data(station_id, display_options, observation, stdout)
+            except (LookupError, TypeError, ValueError) as render_err:
+                err = render_err
+        if err is not None:
+            print ("{}|error: {}" . format(station_id, err), file=stderr)
+            exit_status = 1
+            continue
+        print_weather_data(station_id, weather_display_list, display_options, multi_station, stdout)
+        if args.record:
+            record_observation(station_id, observation, stderr)
+
+    return(exit_status)
+
+#############################################################################
+# Settings
 #############################################################################
 ME=sys.argv[0]
 ME=os.path.basename(ME)
-API_URL = 'https://api.weather.gov'
-
-parser = argparse.ArgumentParser(usage='%(prog)s [options] StationID',description='Utlilty for printing weather conditions')
-parser.add_argument("stationID", metavar="StationID", type=str, help="The name of the wx station ID to get condition from")
-parser.add_argument("-t", "--temp", help="Print temparature for given stationID", action="store_true", default=False)
-parser.add_argument("-H", "--humidity", help="Print humidity for given stationID", action="store_true", default=False)
-parser.add_argument("-d", "--dewpoint", help="Print dewpoint for given stationID", action="store_true", default=False)
-parser.add_argument("-w", "--weather", help="Print weather for given stationID", action="store_true", default=False)
-parser.add_argument("-p", "--pressure", help="Print barametric pressure for given stationID", action="store_true", default=False)
-parser.add_argument("-W", "--windchill", help="Print windchill for given stationID", action="store_true", default=False)
-parser.add_argument("-i", "--heatindex", help="Print heatindex for given stationID", action="store_true", default=False)
-parser.add_argument("-c", "--winddirection", help="Print wind direction for given stationID", action="store_true", default=False)
-parser.add_argument("-g", "--windgust", help="Print wind gust for given stationID", action="store_true", default=False)
-parser.add_argument("-s", "--windspeed", help="Print wind speed for given stationID", action="store_true", default=False)
-parser.add_argument("--forecast", help="Print Forecast for given StationID", action="store_true", default=False)
-parser.add_argument("--script", help="Print all data formated on a single line for parsing by external script", action="store_true")
-parser.add_argument("--metric", help="Print all data in metric units", action="store_true")
-parser.add_argument("--valuesonly", help="Display on data values, no titles", action="store_true")
-parser.add_argument("--noheaders", help="Don't display header with station info", action="store_true")
-parser.add_argument("--allvalues", help="Dislay all data values", action="store_true")
-parser.add_argument("--icon", help="Display weather icon for weather value", action="store_true")
-parser.add_argument("--icononly", help="only display icons for weather value", action="store_true")
-
-
-# check for arguments passed
-if len(sys.argv) == 1:
-   parser.print_help()
-   sys.exit(1)
-
-args = parser.parse_args()
-
-if args.forecast:
-    display_forecast = True
-else:
-    display_forecast = False
-# define options to pass to display_weather_data() based on command line options
-if args.weather:
-    display_weather = True
-else:
-    display_weather = False
-if args.temp:
-    display_temp = True
-else:
-    display_temp = False
-if args.humidity:
-    display_humidity = True
-else:
-    display_humidity = False
-if args.windchill:
-    display_windchill = True
-else:
-    display_windchill = False
-if args.heatindex:
-    display_heatindex = True
-else:
-    display_heatindex = False
-if args.dewpoint:
-    display_dewpoint = True
-else:
-    display_dewpoint = False
-if args.winddirection:
-    display_winddirection = True
-else:
-    display_winddirection = False
-if args.windspeed:
-    display_windspeed = True
-else:
-    display_windspeed = False
-if args.windgust: 
-    display_windgust = True
-else:
-    display_windgust = False
-if args.pressure:
-    display_pressure = True
-else:
-    display_pressure = False
-
-if args.metric:
-    display_metric = True
-else:
-    display_metric = False
-
-if args.valuesonly or args.script:
-    display_notitles = True
-else:
-    display_notitles = False
-
-if args.noheaders or args.script:
-    display_headers = False
-else:
-    display_headers = True
-
-if args.script:
-    scriptFlag = True
-else:
-    scriptFlag = False
-
-if args.icon:
-    display_icon = True
-else:
-    display_icon = False
-
-if args.icononly:
-    display_icon = True
-    icononly = True
-    display_headers = False
-    display_notitles = True
-else:
-    icononly = False
-
-display_options = { 'display_weather':display_weather, 'display_temp':display_temp, 'display_humidity':display_humidity, 'display_windchill':display_windchill, 
-                    'display_heatindex':display_heatindex, 'display_dewpoint': display_dewpoint, 'display_winddirection':display_winddirection, 'display_windspeed':display_windspeed,
-                    'display_windgust':display_windgust, 'display_pressure':display_pressure, 'display_metric':display_metric, 'display_notitles':display_notitles, 'display_headers':display_headers, 'display_icon':display_icon}
-
-
-station_id = args.stationID
-
-if display_forecast:
-   weather_forecast_list = display_weather_forecast(station_id)
-   sys.exit(0)
-
-# Display all data values if --allvalues flag is set
-if args.allvalues:
-    for key in display_options:
-        # we don't turn these flags on because they are not data related
-        if key == "display_metric" or key == "display_notitles" or key == "display_headers":
-            next
-        else:
-            display_options[key] = True
-
-# Populate list with weather data
-weather_display_list = display_weather_data(station_id, display_options)
-
-if args.script:
-    listsize = len(weather_display_list)
-    counter=0
-    for item in weather_display_list:
-        if counter < listsize -1:
-            print (item, end="|")
-            counter = counter+1
-        else:
-            print (item)
-else:
-    for item in weather_display_list:
-        print(item)
+# WEATHER_API_URL points us at a stand-in server, see weather.bench.py --serve
+API_URL = os.environ.get('WEATHER_API_URL', 'https://api.weather.gov')
+
+# Fast JSON decoders to try in order, json is the stdlib fallback
+JSON_DECODERS = ('orjson', 'simdjson', 'json')
+
+# Response cache settings
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'weather.py')
+CACHE_ENABLED = True
+CACHE_MAX_BYTES = 4 * 1024 * 1024
+# Used when the server sends no Cache-Control/Expires
+CACHE_DEFAULT_TTL = 60
+# Per-endpoint TTL overrides in seconds, first matching regex wins.
+# Station metadata and /points grids practically never change, and
+# observations only update about once an hour.
+CACHE_TTL_OVERRIDES = [
+    (r'/stations/[^/]+$', 7 * 86400),
+    (r'/points/[^/]+$', 7 * 86400),
+    (r'/observations/latest$', 300),
+]
+# How long to wait for another process fetching the same URL, and how
+# often to check if it is done
+SINGLE_FLIGHT_WAIT = 5
+SINGLE_FLIGHT_POLL = 0.01
+
+# HTTP client settings, timeouts are in seconds
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 10
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_POOL_SIZE = 8
+# Bytes read at a time by urlreq_stream()
+HTTP_STREAM_CHUNK = 64 * 1024
+
+# Station/grid index settings
+STATION_INDEX = os.path.join(CACHE_DIR, 'stations.db')
+STATION_INDEX_MAX_AGE = 30 * 86400
+
+# Station catalog used by --near, the station list rarely changes
+CATALOG_PATH = os.path.join(CACHE_DIR, 'catalog.bin')
+CATALOG_MAX_AGE = 30 * 86400
+CATALOG_PAGE_SIZE = 500
+CATALOG_LEAF_SIZE = 8
+EARTH_RADIUS_KM = 6371.0
+
+# Hours --hourly prints by default, the grid data covers about a week
+GRID_HOURS_DEFAULT = 24
+
+# Observation history settings, the API keeps about a week of observations
+DATA_DIR = os.path.join(os.environ.get('XDG_DATA_HOME', os.path.expanduser('~/.local/share')), 'weather.py')
+HISTORY_DB = os.path.join(DATA_DIR, 'history.db')
+HISTORY_DEFAULT_DAYS = 7
+HISTORY_PAGE_SIZE = 500
+HISTORY_BATCH_SIZE = 100
+
+# Offline bundle settings, --offline without --bundle reads BUNDLE_DEFAULT
+BUNDLE_DEFAULT = os.path.join(DATA_DIR, 'bundle.zip')
+BUNDLE_VERSION = 2
+BUNDLE_INDEX = 'bundle.json'
+BUNDLE_CATALOG = 'catalog.bin'
+# Set by --offline: the loaded bundle, urlreq() answers from it
+OFFLINE_BUNDLE = None
+
+# Set by --timings or WEATHER_TIMINGS: the list @timed phases are recorded
+# in, written to TIMINGS_OUTPUT ('-' for stderr) at exit
+TIMINGS = None
+TIMINGS_OUTPUT = None
+TIMINGS_EPOCH = 0
+
+# Set by --deadline: time.time() by which urlreq() falls back to the cache
+FETCH_DEADLINE = None
+# Key urlreq() adds to cached data it returns in place of a fresh response
+STALE_KEY = '_stale'
+
+# --watch settings, in seconds.  Stations report hourly until we have
+# learned otherwise, and new observations usually take a few minutes to
+# show up in the API.
+WATCH_DEFAULT_PERIOD = 3600
+WATCH_DEFAULT_LAG = 300
+WATCH_MIN_INTERVAL = 60
+WATCH_MAX_INTERVAL = 900
+WATCH_MARGIN = 30
+WATCH_JITTER = 300
+WATCH_LAG_STEP = 10
+WATCH_SEED_COUNT = 48
+
+# Daemon settings, refresh interval is in seconds.  The socket and the
+# client's settings are in weather_parts/client.py, which weather.client.py
+# loads on its own
+DAEMON_REFRESH = 60
+
+# Set by the daemon: station_id -> (fetched time, Observation)
+WARM_OBSERVATIONS = None
+WARM_LOCK = threading.Lock()
 
-sys.exit()
+#############################################################################
+# main() 
+#############################################################################
+def main():
+    global CACHE_ENABLED, HTTP_READ_TIMEOUT, HTTP_RETRIES, HTTP_POOL_SIZE, OFFLINE_BUNDLE, FETCH_DEADLINE
+    global TIMINGS, TIMINGS_OUTPUT, TIMINGS_EPOCH
+    started = time.time()
+
+    # Hand the arguments straight to a running daemon before paying for
+    # argparse or any of the heavy imports (weather.client.py does the same
+    # without compiling this script, for status bars)
+    if '--client' in sys.argv[1:]:
+        from weather_parts.client import run_client
+        status = run_client(sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+        # No daemon listening or a run of our own, do the work ourselves
+
+    parser = build_parser()
+
+    # check for arguments passed
+    if len(sys.argv) == 1:
+       parser.print_help()
+       sys.exit(1)
+
+    args = parser.parse_args()
+
+    timings_output = args.timings_file or ('-' if args.timings else os.environ.get('WEATHER_TIMINGS'))
+    if timings_output:
+        TIMINGS_OUTPUT = '-' if timings_output == '1' else timings_output
+        TIMINGS_EPOCH = time.perf_counter()
+        TIMINGS = []
+
+    if args.no_cache:
+        CACHE_ENABLED = False
+    HTTP_READ_TIMEOUT = args.timeout
+    HTTP_RETRIES = max(0, args.retries)
+    HTTP_POOL_SIZE = max(HTTP_POOL_SIZE, args.jobs)
+    if args.bundle and not args.offline:
+        print ("{}: --bundle only applies to --offline" . format(ME), file=sys.stderr)
+        sys.exit(1)
+    if args.offline:
+        bundle_path = args.bundle or BUNDLE_DEFAULT
+        from weather_parts.bundle import load_bundle
+        try:
+            OFFLINE_BUNDLE = load_bundle(bundle_path)
+        except (OSError, ValueError) as err:
+            print ("{}: unable to read bundle {}: {}" . format(ME, bundle_path, err), file=sys.stderr)
+            sys.exit(1)
+
+    if args.daemon:
+        from weather_parts.daemon import run_daemon
+        sys.exit(run_daemon(args))
+
+    # The daemon answers from memory, only plain runs get a deadline
+    if args.deadline is not None:
+        FETCH_DEADLINE = started + args.deadline / 1000
+
+    status = run_weather(args)
+    finish_background_refreshes()
+    if TIMINGS is not None:
+        write_timings(sys.argv[1:], (time.time() - started) * 1000)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    # weather_parts imports us as weather, make that this run rather than
+    # a second copy of the script
+    sys.modules['weather'] = sys.modules[__name__]
+    try:
+        main()
+    except ModuleNotFoundError as err:
+        if err.name is None or err.name.split('.')[0] != 'weather_parts':
+            raise
+        print ("{}: {} is missing, this run needs the weather_parts directory next to {}" . format(ME, err.name, ME), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,14 @@
+##############################################################################
+# weather_parts -- the code only some weather.py runs need: the station
+# catalog behind --near, --hourly, --format records, offline bundles,
+# observation history, --watch, --daemon and --client.
+#
+# weather.py is a script, so it is compiled from source on every run; these
+# modules are imported the first time a run needs them and their bytecode is
+# cached like any other import.  Keep this directory next to weather.py, a
+# run that needs a missing part exits with a one-line message.
+#
+# The parts import weather for its helpers and settings.  The settings
+# main() changes for a run (OFFLINE_BUNDLE, HTTP_READ_TIMEOUT, TIMINGS, ...)
+# are read as weather.NAME so they are looked up when used.
+##############################################################################
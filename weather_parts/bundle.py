@@ -0,0 +1,150 @@
+##############################################################################
+# weather_parts/bundle.py -- --export-bundle and --offline bundles
+##############################################################################
+import sys
+import os
+import json
+import time
+import weather
+from weather import (
+    API_URL, BUNDLE_CATALOG, BUNDLE_INDEX, BUNDLE_VERSION, CATALOG_PATH, ME,
+    json_loads, load_sun_table, urlreq, WeatherAPIError)
+from weather_parts.catalog import load_catalog
+
+#############################################################################
+# Offline bundles -- --export-bundle saves everything a run needs for the
+# given stations (station metadata, latest observation, /points, forecast,
+# forecast grid data and two years of sun events) plus the station catalog
+# --near uses to one zip file.
+# --offline opens it (--bundle FILE, BUNDLE_DEFAULT without) and urlreq()
+# answers from it instead of the network.
+# Every response and sun table is a deflated json member of its own, so
+# opening a bundle only reads the zip directory and a lookup decodes just
+# the member asked for, however big the bundle is.  Responses are keyed
+# by their path under API_URL, folded to upper case since station IDs
+# are not case sensitive.  URLs the API handed out (the forecast links in
+# /points) start with the API_URL of the exporting host, that is stripped
+# too.
+#############################################################################
+def bundle_key(api_endpoint):
+    bases = [API_URL]
+    if weather.OFFLINE_BUNDLE is not None:
+        bases.append(weather.OFFLINE_BUNDLE['api_url'])
+    for base in bases:
+        if api_endpoint.startswith(base):
+            api_endpoint = api_endpoint[len(base):]
+            break
+    return(api_endpoint.upper())
+
+def bundle_sun_key(latitude, longitude, year):
+    return('{:.2f}_{:.2f}_{}' . format(latitude, longitude, year))
+
+# The raw member, None when the bundle does not have it
+def bundle_member(name):
+    try:
+        return(weather.OFFLINE_BUNDLE['archive'].read(name))
+    except KeyError:
+        return(None)
+
+def bundle_raw(api_endpoint):
+    raw = bundle_member('responses' + bundle_key(api_endpoint))
+    if raw is None:
+        raise WeatherAPIError("{} is not in the offline bundle" . format(api_endpoint))
+    return(raw)
+
+def bundle_lookup(api_endpoint):
+    return(json_loads(bundle_raw(api_endpoint)))
+
+def load_bundle(path):
+    import zipfile
+    try:
+        archive = zipfile.ZipFile(path)
+        bundle = json_loads(archive.read(BUNDLE_INDEX))
+    except (zipfile.BadZipFile, KeyError):
+        raise ValueError("not a bundle, bundles made before version {} need exporting again" . format(BUNDLE_VERSION))
+    if bundle.get('version') != BUNDLE_VERSION:
+        raise ValueError("unsupported bundle version {}" . format(bundle.get('version')))
+    bundle['archive'] = archive
+    return(bundle)
+
+def export_bundle(path, station_ids, stdout=None, stderr=None):
+    if stderr is None:
+        stderr = sys.stderr
+    import zipfile
+    exported = 0
+    exit_status = 0
+
+    # An expired copy from the cache would go into the bundle as if it were
+    # fresh, so an API error fails the station instead
+    def fetch(url, fetched, cache=True):
+        data = urlreq(url, cache=cache, stale=False)
+        fetched[bundle_key(url)] = data
+        return(data)
+
+    # Stations near each other share /points, forecasts and sun tables
+    written = set()
+    def write(archive, name, data):
+        if name not in written:
+            archive.writestr(name, json.dumps(data, separators=(',', ':')))
+            written.add(name)
+
+    year = time.gmtime().tm_year
+    tmp_path = '{}.{}.tmp' . format(path, os.getpid())
+    try:
+        archive = zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED)
+    except OSError as err:
+        print ("{}: unable to write bundle: {}" . format(ME, err), file=stderr)
+        return(1)
+    for station_id in station_ids:
+        # Only stations that export completely go in the bundle
+        fetched = {}
+        tables = {}
+        try:
+            station_data = fetch('{}/stations/{}' . format(API_URL, station_id), fetched)
+            stationLON, stationLAT = station_data["geometry"]["coordinates"][:2]
+            fetch('{}/stations/{}/observations/latest' . format(API_URL, station_id), fetched)
+            points_data = fetch('{}/points/{},{}' . format(API_URL, stationLAT, stationLON), fetched)
+            forecast_url = points_data["properties"].get("forecast")
+            if forecast_url:
+                fetch(forecast_url, fetched)
+            # Too big for the response cache, see get_grid_forecast()
+            grid_data_url = points_data["properties"].get("forecastGridData")
+            if grid_data_url:
+                fetch(grid_data_url, fetched, cache=False)
+            # This year and next so the bundle outlives new year's
+            for table_year in (year, year + 1):
+                initial_up, events = load_sun_table(stationLAT, stationLON, table_year)
+                tables[bundle_sun_key(round(stationLAT, 2), round(stationLON, 2), table_year)] = {'initial_up': initial_up, 'events': list(events)}
+        except (WeatherAPIError, LookupError, TypeError, ValueError) as err:
+            print ("{}: unable to export: {}" . format(station_id, err), file=stderr)
+            exit_status = 1
+            continue
+        try:
+            for key, data in fetched.items():
+                write(archive, 'responses' + key, data)
+            for key, table in tables.items():
+                write(archive, 'sun/' + key, table)
+        except OSError as err:
+            print ("{}: unable to write bundle: {}" . format(ME, err), file=stderr)
+            archive.close()
+            os.remove(tmp_path)
+            return(1)
+        exported += 1
+
+    try:
+        load_catalog(stderr)
+        with open(CATALOG_PATH, 'rb') as f:
+            archive.writestr(BUNDLE_CATALOG, f.read())
+    except (WeatherAPIError, OSError) as err:
+        print ("{}: unable to export the station catalog, --near will not work offline: {}" . format(ME, err), file=stderr)
+        exit_status = 1
+
+    try:
+        write(archive, BUNDLE_INDEX, {'version': BUNDLE_VERSION, 'created': int(time.time()), 'api_url': API_URL, 'stations': exported})
+        archive.close()
+        os.replace(tmp_path, path)
+    except OSError as err:
+        print ("{}: unable to write bundle: {}" . format(ME, err), file=stderr)
+        return(1)
+    print ("{}: exported {} stations to {}" . format(ME, exported, path), file=stdout)
+    return(exit_status)
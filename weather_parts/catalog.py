@@ -0,0 +1,274 @@
+##############################################################################
+# weather_parts/catalog.py -- the station catalog behind --near/--near-file
+##############################################################################
+import sys
+import os
+import json
+import time
+import weather
+from weather import (
+    API_URL, BUNDLE_CATALOG, CATALOG_LEAF_SIZE, CATALOG_MAX_AGE,
+    CATALOG_PAGE_SIZE, CATALOG_PATH, EARTH_RADIUS_KM, ME, json_loads,
+    WeatherAPIError)
+from weather_parts.stream import urlreq_stream
+from weather_parts.records import write_records
+
+#############################################################################
+# Station catalog -- every observation station from /stations, kept in
+# CATALOG_PATH and refreshed after CATALOG_MAX_AGE.  Stations are stored as
+# unit vectors in the order of an implicit k-d tree (the median of each
+# range sits in its middle, split on x, y, z by depth) so loading it is a
+# read with nothing to build, and lookups never touch the API.
+#############################################################################
+CATALOG_MAGIC = b'CAT1'
+CATALOG_HEADER = '<4sIQ'
+
+def catalog_vector(latitude, longitude):
+    import math
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    return((math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)))
+
+def fetch_catalog():
+    stations = []
+    seen_urls = set()
+    url = '{}/stations?limit={}' . format(API_URL, CATALOG_PAGE_SIZE)
+    while url and url not in seen_urls:
+        seen_urls.add(url)
+        tail = {'pagination': None}
+        features = 0
+        for feature in urlreq_stream(url, ('features',), tail):
+            features += 1
+            try:
+                station_id = feature["properties"]["stationIdentifier"]
+                longitude, latitude = feature["geometry"]["coordinates"][:2]
+            except (KeyError, TypeError, ValueError):
+                continue
+            stations.append((station_id, feature["properties"].get("name") or '', float(latitude), float(longitude)))
+        if not features:
+            break
+        url = (tail['pagination'] or {}).get("next")
+    return(stations)
+
+def build_catalog(stations):
+    # Returns the stations reordered into the k-d tree with their vectors
+    points = [catalog_vector(station[2], station[3]) + (station,) for station in stations]
+    def place(lo, hi, axis):
+        if hi - lo <= 1:
+            return
+        points[lo:hi] = sorted(points[lo:hi], key=lambda point: point[axis])
+        mid = (lo + hi) // 2
+        place(lo, mid, (axis + 1) % 3)
+        place(mid + 1, hi, (axis + 1) % 3)
+    place(0, len(points), 0)
+    return(points)
+
+def write_catalog(path, points, updated):
+    import array
+    import struct
+
+    tmp_path = '{}.{}.tmp' . format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack(CATALOG_HEADER, CATALOG_MAGIC, len(points), int(updated)))
+            for column in range(3):
+                array.array('d', (point[column] for point in points)).tofile(f)
+            f.write(json.dumps([point[3] for point in points], separators=(',', ':')).encode('utf-8'))
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def read_catalog(path):
+    try:
+        with open(path, 'rb') as f:
+            return(parse_catalog(f.read()))
+    except OSError:
+        return(None)
+
+def parse_catalog(raw):
+    import array
+    import struct
+
+    header_size = struct.calcsize(CATALOG_HEADER)
+    if len(raw) < header_size:
+        return(None)
+    magic, count, updated = struct.unpack(CATALOG_HEADER, raw[:header_size])
+    if magic != CATALOG_MAGIC:
+        return(None)
+    columns = []
+    offset = header_size
+    for column in range(3):
+        values = array.array('d')
+        values.frombytes(raw[offset:offset + count * 8])
+        columns.append(values)
+        offset += count * 8
+    try:
+        stations = json_loads(raw[offset:])
+    except ValueError:
+        return(None)
+    if len(stations) != count or any(len(values) != count for values in columns):
+        return(None)
+    return({'updated': updated, 'vectors': columns, 'stations': stations})
+
+def load_catalog(stderr=None):
+    if stderr is None:
+        stderr = sys.stderr
+    if weather.OFFLINE_BUNDLE is not None:
+        # However old, it is the one exported with the bundle
+        from weather_parts.bundle import bundle_member
+        raw = bundle_member(BUNDLE_CATALOG)
+        catalog = parse_catalog(raw) if raw is not None else None
+        if catalog is None:
+            raise WeatherAPIError("The offline bundle has no station catalog")
+        return(catalog)
+    catalog = read_catalog(CATALOG_PATH)
+    if catalog is not None and catalog['updated'] + CATALOG_MAX_AGE > time.time():
+        return(catalog)
+    try:
+        stations = fetch_catalog()
+    except WeatherAPIError as err:
+        if catalog is None:
+            raise
+        print ("{}: unable to refresh station catalog, using the old one: {}" . format(ME, err), file=stderr)
+        return(catalog)
+    if not stations:
+        if catalog is None:
+            raise WeatherAPIError("No stations returned by {}/stations" . format(API_URL))
+        return(catalog)
+    updated = time.time()
+    write_catalog(CATALOG_PATH, build_catalog(stations), updated)
+    catalog = read_catalog(CATALOG_PATH)
+    if catalog is None:
+        raise WeatherAPIError("Unable to write station catalog {}" . format(CATALOG_PATH))
+    return(catalog)
+
+#############################################################################
+# k nearest stations to a point -- returns [(distance_km, station), ...]
+# closest first.  Distances compare as squared chords between unit
+# vectors, a subtree is only searched if its splitting planes are closer
+# than the k-th best so far.  Ranges of CATALOG_LEAF_SIZE or fewer are
+# scanned instead of split further.
+#############################################################################
+def catalog_nearest(catalog, latitude, longitude, k=1):
+    import heapq
+    import math
+
+    query = catalog_vector(latitude, longitude)
+    vectors = catalog['vectors']
+    xs, ys, zs = vectors
+    qx, qy, qz = query
+    best = []
+    stack = [(0, len(xs), 0, 0.0)]
+    while stack:
+        lo, hi, axis, bound = stack.pop()
+        if len(best) == k and bound >= -best[0][0]:
+            continue
+        if hi - lo <= CATALOG_LEAF_SIZE:
+            for index in range(lo, hi):
+                dx = xs[index] - qx
+                dy = ys[index] - qy
+                dz = zs[index] - qz
+                d2 = dx * dx + dy * dy + dz * dz
+                if len(best) < k:
+                    heapq.heappush(best, (-d2, index))
+                elif d2 < -best[0][0]:
+                    heapq.heapreplace(best, (-d2, index))
+            continue
+        mid = (lo + hi) // 2
+        dx = xs[mid] - qx
+        dy = ys[mid] - qy
+        dz = zs[mid] - qz
+        d2 = dx * dx + dy * dy + dz * dz
+        if len(best) < k:
+            heapq.heappush(best, (-d2, mid))
+        elif d2 < -best[0][0]:
+            heapq.heapreplace(best, (-d2, mid))
+        diff = query[axis] - vectors[axis][mid]
+        next_axis = (axis + 1) % 3
+        # The far side is at least as far as this splitting plane and
+        # every plane above it
+        far_bound = max(bound, diff * diff)
+        if diff < 0:
+            stack.append((mid + 1, hi, next_axis, far_bound))
+            stack.append((lo, mid, next_axis, bound))
+        else:
+            stack.append((lo, mid, next_axis, far_bound))
+            stack.append((mid + 1, hi, next_axis, bound))
+
+    nearest = []
+    for d2, index in sorted(best, reverse=True):
+        distance = 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(-d2) / 2))
+        nearest.append((distance, catalog['stations'][index]))
+    return(nearest)
+
+#############################################################################
+# --near/--near-file: print the --nearest stations to each point.  --script
+# prints lat,lon|StationID|km lines, one per station, so the IDs can be cut
+# out and fed back in with --stations-file -
+#############################################################################
+def run_nearest(args, stdout=None, stderr=None):
+    if stderr is None:
+        stderr = sys.stderr
+    points = []
+    lines = list(args.near or [])
+    if args.near_file:
+        if args.near_file == '-':
+            lines.extend(sys.stdin)
+        else:
+            try:
+                with open(args.near_file) as near_file:
+                    lines.extend(near_file)
+            except OSError as err:
+                print ("{}: unable to read points file: {}" . format(ME, err), file=stderr)
+                return(1)
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        try:
+            latitude, longitude = (float(value) for value in line.replace(' ', ',').split(',') if value)
+        except ValueError:
+            print ("{}: bad point {!r}, expected LAT,LON" . format(ME, line), file=stderr)
+            return(1)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            print ("{}: point {!r} is out of range" . format(ME, line), file=stderr)
+            return(1)
+        points.append((latitude, longitude))
+    if args.nearest < 1:
+        print ("{}: --nearest must be at least 1" . format(ME), file=stderr)
+        return(1)
+    if args.format == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            print ("{}: --format msgpack needs the msgpack module" . format(ME), file=stderr)
+            return(1)
+
+    try:
+        catalog = load_catalog(stderr)
+    except WeatherAPIError as err:
+        print ("{}: unable to load station catalog: {}" . format(ME, err), file=stderr)
+        return(1)
+
+    if args.format != 'text':
+        def records():
+            for latitude, longitude in points:
+                stations = []
+                for distance, station in catalog_nearest(catalog, latitude, longitude, args.nearest):
+                    station_id, name, station_lat, station_lon = station
+                    stations.append({'id': station_id, 'name': name, 'latitude': station_lat, 'longitude': station_lon, 'distance_km': round(distance, 3)})
+                yield {'latitude': latitude, 'longitude': longitude, 'stations': stations}
+        write_records(records(), args.format, stdout)
+        return(0)
+
+    for latitude, longitude in points:
+        nearest = catalog_nearest(catalog, latitude, longitude, args.nearest)
+        point = '{},{}' . format(latitude, longitude)
+        if args.script:
+            for distance, station in nearest:
+                print ("{}|{}|{:.1f}" . format(point, station[0], distance), file=stdout)
+        else:
+            stations = ', ' . join('{} {} ({:.1f} km)' . format(station[0], station[1], distance) for distance, station in nearest)
+            print ("{}: {}" . format(point, stations), file=stdout)
+    return(0)
@@ -0,0 +1,115 @@
+##############################################################################
+# weather_parts/client.py -- --client, asking a running --daemon.  Only the
+# standard library is used, weather.client.py loads this and nothing else.
+##############################################################################
+import sys
+import os
+import json
+
+#############################################################################
+# Client -- forward our arguments to the daemon and print its answer.
+# Returns None when no daemon is listening, or when the arguments need a
+# run of our own (LOCAL_OPTIONS), so the caller can fall back to fetching
+# itself.
+#
+# The daemon is another process with its own directory and stdin, so the
+# READ_OPTIONS files are read here and sent along with the arguments.
+#############################################################################
+def client_option(arg, options):
+    # The option arg is, with or without an =VALUE
+    for option in options:
+        if arg == option or arg.startswith(option + '='):
+            return(option)
+    return(None)
+
+def client_read_lines(path):
+    # Lines of path ('-' for stdin) with blank lines and # comments skipped
+    if path == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(path) as lines_file:
+            lines = lines_file.readlines()
+    lines = [line.split('#', 1)[0].strip() for line in lines]
+    return([line for line in lines if line])
+
+def run_client(argv):
+    import socket
+    socket_path = DAEMON_SOCKET
+    forward = []
+    files = {}
+    args = iter(argv)
+    for arg in args:
+        if arg == '--':
+            forward.append(arg)
+            forward.extend(args)
+            break
+        if arg == '--client':
+            continue
+        if client_option(arg, LOCAL_OPTIONS):
+            return(None)
+        option = client_option(arg, ('--socket', '--format') + READ_OPTIONS)
+        if option is None:
+            forward.append(arg)
+            continue
+        value = arg.split('=', 1)[1] if '=' in arg else next(args, None)
+        if value is None:
+            # Let weather.py report the missing value
+            return(None)
+        if option == '--socket':
+            socket_path = value
+        elif option == '--format':
+            # msgpack is binary, the reply is json
+            if value == 'msgpack':
+                return(None)
+            forward.extend([option, value])
+        else:
+            files[option] = value
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(DAEMON_CLIENT_TIMEOUT)
+            sock.connect(socket_path)
+            # Connected, so the files are ours to read (stdin included)
+            request = {'argv': forward}
+            try:
+                if '--stations-file' in files:
+                    request['stations'] = client_read_lines(files['--stations-file'])
+                if '--near-file' in files:
+                    request['near'] = client_read_lines(files['--near-file'])
+            except OSError as err:
+                print ("{}: unable to read {}: {}" . format(CLIENT_ME, err.filename, err.strerror), file=sys.stderr)
+                return(1)
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            reply = b''
+            while not reply.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                reply += chunk
+        reply = json.loads(reply.decode('utf-8'))
+    except (OSError, ValueError):
+        return(None)
+
+    sys.stdout.write(reply.get('stdout', ''))
+    sys.stderr.write(reply.get('stderr', ''))
+    return(reply.get('status', 1))
+
+#############################################################################
+# Settings
+#############################################################################
+CLIENT_ME = os.path.basename(sys.argv[0])
+
+# Where --daemon listens and --client connects without --socket
+DAEMON_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'weather.py-{}.sock' . format(os.getuid()))
+DAEMON_CLIENT_TIMEOUT = 5
+
+# Options the daemon can't honour for one client: the settings that are
+# global in the daemon process, files it would write relative to its own
+# directory, and runs that belong to the caller (--watch, --sync-history,
+# --export-bundle).  With any of them the client runs weather.py itself.
+LOCAL_OPTIONS = ('--daemon', '--watch', '--no-cache', '--offline', '--bundle',
+                 '--timeout', '--retries', '--deadline', '--timings',
+                 '--timings-file', '--sync-history', '--export-bundle')
+
+# Files the client reads and sends as 'stations' and 'near'
+READ_OPTIONS = ('--stations-file', '--near-file')
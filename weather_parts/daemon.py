@@ -0,0 +1,134 @@
+##############################################################################
+# weather_parts/daemon.py -- --daemon, serving results over a unix socket
+##############################################################################
+import sys
+import os
+import json
+import time
+import threading
+import weather
+from weather import (
+    ME, WARM_LOCK, as_observation, build_parser, fetch_weather_data,
+    fetch_weather_data_many, run_weather)
+from weather_parts.client import DAEMON_SOCKET, LOCAL_OPTIONS, READ_OPTIONS
+
+#############################################################################
+# Daemon -- keeps the http session, response cache, station index and sun
+# times warm in one process.  Subscribed stations are refreshed every
+# --refresh seconds and clients get their answer rendered from memory.
+#
+# Protocol is one json line each way:
+#   client -> {"argv": [...], "stations": [...], "near": [...]}
+#   daemon -> {"status": N, "stdout": "...", "stderr": "..."}
+# stations and near (optional) are the lines of the client's
+# --stations-file and --near-file, read by the client.
+#############################################################################
+def daemon_refresh_loop(interval, stop_event):
+    while not stop_event.wait(interval):
+        with WARM_LOCK:
+            station_ids = list(weather.WARM_OBSERVATIONS)
+        # revalidate goes to fetch_weather_data(), get_weather_data() would
+        # hand back the warm entry being refreshed
+        for station_id, observation, err in fetch_weather_data_many(station_ids, weather.HTTP_POOL_SIZE, revalidate=True):
+            if err is not None:
+                # Keep serving the last good observation
+                print ("{}: refresh of {} failed: {}" . format(ME, station_id, err), file=sys.stderr)
+                continue
+            with WARM_LOCK:
+                weather.WARM_OBSERVATIONS[station_id.upper()] = (time.time(), as_observation(observation))
+
+# Each request is rendered into its own buffers, handed down to
+# run_weather() rather than swapped in for sys.stdout/sys.stderr, so
+# clients are answered concurrently and nothing else the daemon prints
+# (refresh errors) ends up in a reply.  The options that would change the
+# daemon's global settings or have it read or write files for a client are
+# refused, the client runs those itself.
+def daemon_render(argv, stations=(), near=()):
+    import io
+    out = io.StringIO()
+    err = io.StringIO()
+    parser = build_parser()
+    # argparse prints usage, --help and its errors itself
+    def print_message(message, file=None):
+        if message:
+            (out if file is sys.stdout else err).write(message)
+    parser._print_message = print_message
+    try:
+        args = parser.parse_args(argv)
+        refused = []
+        for option in ('--client',) + LOCAL_OPTIONS + READ_OPTIONS:
+            dest = option[2:].replace('-', '_')
+            if getattr(args, dest) != parser.get_default(dest):
+                refused.append(option)
+        args.stationID.extend(stations)
+        if near:
+            args.near = (args.near or []) + list(near)
+        if refused:
+            print ("{}: {} can not be forwarded to the daemon" . format(ME, ', ' . join(refused)), file=err)
+            status = 1
+        elif args.format == 'msgpack':
+            print ("{}: --format msgpack can not be forwarded to the daemon" . format(ME), file=err)
+            status = 1
+        else:
+            status = run_weather(args, out, err)
+    except SystemExit as exit_err:
+        status = exit_err.code if isinstance(exit_err.code, int) else 1
+    return(status, out.getvalue(), err.getvalue())
+
+def run_daemon(args):
+    import contextlib
+    import signal
+    import socketserver
+
+    class DaemonRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline().decode('utf-8'))
+                argv = [str(arg) for arg in request['argv']]
+                stations = [str(line) for line in request.get('stations', [])]
+                near = [str(line) for line in request.get('near', [])]
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return
+            status, out, err = daemon_render(argv, stations, near)
+            reply = json.dumps({'status': status, 'stdout': out, 'stderr': err})
+            try:
+                self.wfile.write(reply.encode('utf-8') + b'\n')
+            except OSError:
+                # The client timed out and is fetching for itself
+                pass
+
+    class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    weather.WARM_OBSERVATIONS = {}
+
+    # Subscribe the stations given on the command line up front
+    for station_id, observation, err in fetch_weather_data_many(args.stationID, weather.HTTP_POOL_SIZE, fetch=fetch_weather_data):
+        if err is not None:
+            print ("{}: unable to fetch {}: {}" . format(ME, station_id, err), file=sys.stderr)
+            continue
+        weather.WARM_OBSERVATIONS[station_id.upper()] = (time.time(), as_observation(observation))
+
+    socket_path = args.socket or DAEMON_SOCKET
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(socket_path)
+    server = DaemonServer(socket_path, DaemonRequestHandler)
+    os.chmod(socket_path, 0o600)
+
+    stop_event = threading.Event()
+    refresher = threading.Thread(target=daemon_refresh_loop, args=(max(1, args.refresh), stop_event), daemon=True)
+    refresher.start()
+
+    def shutdown(signum, frame):
+        stop_event.set()
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(socket_path)
+    return(0)
@@ -0,0 +1,202 @@
+##############################################################################
+# weather_parts/grid.py -- the gridpoint forecast behind --hourly and --at
+##############################################################################
+import sys
+from datetime import datetime as dt
+import time
+import functools
+from weather import (
+    ME, angle2compass_array, convert_c_to_f, convert_kmh_to_mph,
+    convert_mm_to_in, fetch_weather_data_many, get_wx_station_grid,
+    get_wx_station_info, parse_iso_timestamp, timed, to_float_array,
+    WeatherAPIError)
+from weather_parts.stream import urlreq_stream
+from weather_parts.records import write_records
+
+#############################################################################
+# Gridpoint forecast -- the grid data behind the forecast has each layer
+# (temperature, skyCover, ...) as run-length intervals:
+#   {"validTime": "2025-06-12T06:00:00+00:00/PT3H", "value": 21.1}
+# The document runs to megabytes, so it is streamed and only the values
+# of the GRID_LAYERS are kept; like every streamed response it bypasses
+# the cache.  grid_intervals() turns a layer's values into an interval
+# index, numpy arrays of
+# sorted start and end epoch seconds and the values, and grid_lookup()
+# finds the value at any number of times with one searchsorted().  The
+# hourly series are lookups on the hour.  Accumulated layers (QPF) are
+# divided out to an amount per hour so every lookup is a rate.
+#############################################################################
+# (field, grid layer, title, kind, accumulated)
+GRID_LAYERS = (
+    ('temperature', 'temperature', 'Temp', 'temp', False),
+    ('dewpoint', 'dewpoint', 'Dewpt', 'temp', False),
+    ('precip_probability', 'probabilityOfPrecipitation', 'POP', 'percent', False),
+    ('precip_amount', 'quantitativePrecipitation', 'QPF', 'precip', True),
+    ('sky_cover', 'skyCover', 'Sky', 'percent', False),
+    ('wind_speed', 'windSpeed', 'Wind', 'speed', False),
+    ('wind_gust', 'windGust', 'Gust', 'speed', False),
+    ('wind_direction', 'windDirection', 'Dir', 'angle', False),
+)
+
+@functools.lru_cache(maxsize=64)
+def parse_iso_duration(duration):
+    import re
+    match = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?', duration)
+    if match is None or duration in ('P', 'PT'):
+        raise ValueError("bad ISO 8601 duration {!r}" . format(duration))
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return(((days * 24 + hours) * 60 + minutes) * 60 + seconds)
+
+# Neighbouring grid cells share their interval boundaries, so a run over
+# many stations parses each validTime once
+@functools.lru_cache(maxsize=4096)
+def parse_valid_time(valid_time):
+    start, _, duration = valid_time.partition('/')
+    start = parse_iso_timestamp(start)
+    return((start, start + parse_iso_duration(duration)))
+
+def grid_intervals(values, accumulated=False):
+    import numpy as np
+    bounds = np.array([parse_valid_time(entry['validTime']) for entry in values], dtype=np.int64).reshape(-1, 2)
+    data = to_float_array([entry['value'] for entry in values])
+    if accumulated:
+        data = data * 3600 / np.maximum(bounds[:, 1] - bounds[:, 0], 1)
+    order = np.argsort(bounds[:, 0], kind='stable')
+    return((bounds[order, 0], bounds[order, 1], data[order]))
+
+# Values at times (epoch seconds), NaN where no interval covers the time
+def grid_lookup(intervals, times):
+    import numpy as np
+    starts, ends, values = intervals
+    times = np.asarray(times, dtype=np.int64)
+    if not len(starts):
+        return(np.full(times.shape, np.nan))
+    index = np.searchsorted(starts, times, side='right') - 1
+    clipped = np.maximum(index, 0)
+    return(np.where((index >= 0) & (times < ends[clipped]), values[clipped], np.nan))
+
+def grid_hours(start, hours):
+    import numpy as np
+    return(int(start) // 3600 * 3600 + 3600 * np.arange(hours, dtype=np.int64))
+
+# Values in the units asked for, with the unit name used in records
+def grid_column(values, kind, metricflag=False):
+    if kind == 'temp':
+        if metricflag:
+            return(values, 'degC')
+        return(convert_c_to_f(values), 'degF')
+    if kind == 'speed':
+        if metricflag:
+            return(values, 'km/h')
+        return(convert_kmh_to_mph(values), 'mph')
+    if kind == 'precip':
+        if metricflag:
+            return(values, 'mm')
+        return(convert_mm_to_in(values), 'in')
+    if kind == 'angle':
+        return(values, 'deg')
+    return(values, '%')
+
+@timed('grid')
+def get_grid_forecast(station_id):
+    station_info = get_wx_station_info(station_id)
+    stationID,stationName,stationLON,stationLAT = station_info
+    grid = get_wx_station_grid(stationID, stationLAT, stationLON)
+    if not grid.get("forecast_grid_data_url"):
+        raise WeatherAPIError("No forecast grid for {}" . format(stationID))
+    values = {descriptor[1]: [] for descriptor in GRID_LAYERS}
+    for layer, entry in urlreq_stream(grid["forecast_grid_data_url"], ('properties', frozenset(values), 'values')):
+        values[layer].append(entry)
+    layers = {}
+    for field, layer, title, kind, accumulated in GRID_LAYERS:
+        layers[field] = grid_intervals(values[layer], accumulated)
+    return((station_info, layers))
+
+#############################################################################
+# --hourly: the gridpoint forecast of each station for --hours hours from
+# this one, or at the one time given with --at.  --script prints
+# StationID|time|values lines, --format json/jsonl/msgpack one record per
+# station with a list per field lined up with 'times'.
+#############################################################################
+GRID_TEXT_UNITS = {'degF': '°F', 'degC': '°C'}
+
+def parse_at_time(value):
+    if value.startswith('+'):
+        return(time.time() + float(value[1:]) * 3600)
+    # Local time unless the timestamp has an offset
+    return(dt.fromisoformat(value).timestamp())
+
+def grid_cells(values, kind, unit):
+    if kind == 'angle':
+        return([compass or '-' for compass in angle2compass_array(values).tolist()])
+    digits = {'in': 2, 'mm': 1}.get(unit, 0)
+    unit = GRID_TEXT_UNITS.get(unit, unit)
+    return(['-' if value != value else '{:.{}f}{}' . format(value, digits, unit) for value in values.tolist()])
+
+def run_hourly(args, station_ids, display_options, stdout=None, stderr=None):
+    if stderr is None:
+        stderr = sys.stderr
+    import numpy as np
+    metricflag = display_options['display_metric']
+    if args.at is not None:
+        try:
+            times = np.array([parse_at_time(args.at)], dtype=np.int64)
+        except ValueError:
+            print ("{}: bad --at {!r}, expected an ISO 8601 time or +HOURS" . format(ME, args.at), file=stderr)
+            return(1)
+    elif args.hours < 1:
+        print ("{}: --hours must be at least 1" . format(ME), file=stderr)
+        return(1)
+    else:
+        times = grid_hours(time.time(), args.hours)
+    if args.format == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            print ("{}: --format msgpack needs the msgpack module" . format(ME), file=stderr)
+            return(1)
+
+    failed = []
+    def forecasts():
+        for station_id, forecast, err in fetch_weather_data_many(station_ids, args.jobs, args.as_completed, fetch=get_grid_forecast):
+            if err is not None:
+                print ("{}|error: {}" . format(station_id, err), file=stderr)
+                failed.append(station_id)
+                continue
+            station_info, layers = forecast
+            columns = {}
+            for field, layer, title, kind, accumulated in GRID_LAYERS:
+                columns[field] = grid_column(grid_lookup(layers[field], times), kind, metricflag)
+            yield (station_info, columns)
+
+    if args.format != 'text':
+        def records():
+            iso_times = [dt.fromtimestamp(when).astimezone().isoformat() for when in times.tolist()]
+            for station_info, columns in forecasts():
+                stationID,stationName,stationLON,stationLAT = station_info
+                record = {'station': {'id': stationID, 'name': stationName, 'latitude': stationLAT, 'longitude': stationLON},
+                          'times': iso_times,
+                          'units': {field: unit for field, (values, unit) in columns.items()}}
+                for field, (values, unit) in columns.items():
+                    record[field] = [None if value != value else round(value, 2) for value in values.tolist()]
+                yield record
+        write_records(records(), args.format, stdout)
+        return(1 if failed else 0)
+
+    labels = [time.strftime("%a %m/%d %H:%M", time.localtime(when)) for when in times.tolist()]
+    row_format = "{:<16}" + "{:>8}" * len(GRID_LAYERS)
+    for station_info, columns in forecasts():
+        stationID = station_info[0]
+        cells = [grid_cells(columns[field][0], kind, columns[field][1]) for field, layer, title, kind, accumulated in GRID_LAYERS]
+        if display_options['display_script']:
+            for label, row in zip(labels, zip(*cells)):
+                print ("|" . join((stationID, label) + row), file=stdout)
+            continue
+        if display_options['display_headers']:
+            print ('Hourly forecast for {}({})' . format(station_info[1], stationID), file=stdout)
+            print (row_format . format('Time', *(descriptor[2] for descriptor in GRID_LAYERS)), file=stdout)
+        elif len(station_ids) > 1:
+            print ("{}:" . format(stationID), file=stdout)
+        for label, row in zip(labels, zip(*cells)):
+            print (row_format . format(label, *row), file=stdout)
+    return(1 if failed else 0)
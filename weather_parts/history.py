@@ -0,0 +1,257 @@
+##############################################################################
+# weather_parts/history.py -- observation history for --sync-history,
+# --query and --record
+##############################################################################
+import sys
+import os
+import time
+from weather import (
+    API_URL, DATA_DIR, FIELD_DESCRIPTORS, HISTORY_BATCH_SIZE, HISTORY_DB,
+    HISTORY_DEFAULT_DAYS, HISTORY_PAGE_SIZE, QUERY_FIELDS, as_observation,
+    convert_c_to_f, convert_kmh_to_mph, convert_pa_to_inhg,
+    parse_iso_timestamp)
+from weather_parts.stream import urlreq_stream
+
+#############################################################################
+# Observation history -- a sqlite database under DATA_DIR with one row per
+# station and observation time.  --sync-history pulls everything newer than
+# the last stored observation from /stations/{id}/observations.
+#############################################################################
+HISTORY_FIELDS = (
+    ('temperature', 'temperature'),
+    ('dewpoint', 'dewpoint'),
+    ('relative_humidity', 'relativeHumidity'),
+    ('barometric_pressure', 'barometricPressure'),
+    ('wind_speed', 'windSpeed'),
+    ('wind_gust', 'windGust'),
+    ('wind_direction', 'windDirection'),
+    ('wind_chill', 'windChill'),
+    ('heat_index', 'heatIndex'),
+)
+
+# The Observation field holding each API property
+HISTORY_OBSERVATION_FIELDS = {descriptor.path[0]: descriptor.field for descriptor in FIELD_DESCRIPTORS}
+
+# Columns that get hourly and daily rollups, wind direction can't be averaged
+HISTORY_ROLLUP_FIELDS = tuple(column for column, prop in HISTORY_FIELDS if column != 'wind_direction')
+HISTORY_ROLLUP_PERIODS = ('hour', 'day')
+
+def history_connect():
+    import sqlite3
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(HISTORY_DB, timeout=30)
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    columns = ', '.join('{} REAL' . format(column) for column, prop in HISTORY_FIELDS)
+    conn.execute("""CREATE TABLE IF NOT EXISTS observations (
+                        station TEXT NOT NULL, timestamp INTEGER NOT NULL,
+                        text_description TEXT, {},
+                        PRIMARY KEY (station, timestamp)) WITHOUT ROWID""" . format(columns))
+    # Materialized rollups, bucket is the epoch time the hour/day starts
+    conn.execute("""CREATE TABLE IF NOT EXISTS rollups (
+                        station TEXT NOT NULL, period TEXT NOT NULL, field TEXT NOT NULL,
+                        bucket INTEGER NOT NULL, n INTEGER NOT NULL, total REAL NOT NULL,
+                        low REAL NOT NULL, high REAL NOT NULL,
+                        PRIMARY KEY (station, period, field, bucket)) WITHOUT ROWID""")
+    if 'observations' in existing and 'rollups' not in existing:
+        # History synced before rollups existed
+        with conn:
+            history_rebuild_rollups(conn)
+    return(conn)
+
+# Turn the properties of an observation into a row for the observations table
+def history_row(station_id, properties):
+    row = [station_id.upper(), parse_iso_timestamp(properties["timestamp"]), properties.get("textDescription")]
+    for column, prop in HISTORY_FIELDS:
+        row.append((properties.get(prop) or {}).get("value"))
+    return(tuple(row))
+
+# Start of the hour and of the (local) day an observation falls in
+def history_buckets(timestamp):
+    local = time.localtime(timestamp)
+    day = int(time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1)))
+    hour = day + local.tm_hour * 3600
+    return((('hour', hour), ('day', day)))
+
+def history_rollup(conn, row):
+    station, timestamp = row[0], row[1]
+    values = dict(zip((column for column, prop in HISTORY_FIELDS), row[3:]))
+    params = []
+    for period, bucket in history_buckets(timestamp):
+        for field in HISTORY_ROLLUP_FIELDS:
+            value = values[field]
+            if value is not None:
+                params.append((station, period, field, bucket, value, value, value))
+    conn.executemany("""INSERT INTO rollups VALUES (?, ?, ?, ?, 1, ?, ?, ?)
+                        ON CONFLICT (station, period, field, bucket) DO UPDATE SET
+                            n = n + 1, total = total + excluded.total,
+                            low = min(low, excluded.low), high = max(high, excluded.high)""", params)
+
+def history_rebuild_rollups(conn):
+    conn.execute("DELETE FROM rollups")
+    for row in conn.execute("SELECT * FROM observations").fetchall():
+        history_rollup(conn, row)
+
+# Store rows, updating the rollups for the ones we didn't have yet.
+# Returns the number of new observations.
+def history_insert(conn, rows):
+    placeholders = ', '.join('?' * (len(HISTORY_FIELDS) + 3))
+    sql = "INSERT OR IGNORE INTO observations VALUES ({})" . format(placeholders)
+    stored = 0
+    for row in rows:
+        if conn.execute(sql, row).rowcount:
+            history_rollup(conn, row)
+            stored += 1
+    return(stored)
+
+# Store an observation fetched by a normal run (--record)
+def history_record(station_id, observation):
+    row = [station_id.upper(), parse_iso_timestamp(observation.timestamp), observation.description]
+    for column, prop in HISTORY_FIELDS:
+        row.append(getattr(observation, HISTORY_OBSERVATION_FIELDS[prop]))
+    conn = history_connect()
+    try:
+        with conn:
+            stored = history_insert(conn, [tuple(row)])
+    finally:
+        conn.close()
+    return(stored)
+
+def history_last_timestamp(conn, station_id):
+    row = conn.execute("SELECT max(timestamp) FROM observations WHERE station = ?", (station_id.upper(),)).fetchone()
+    return(row[0])
+
+#############################################################################
+# Sync observation history for a station -- returns the number of new
+# observations stored.  Pages are streamed and written in batches of
+# HISTORY_BATCH_SIZE rows so memory stays flat however big a page is.
+#############################################################################
+def sync_station_history(station_id, days=None):
+    if days is None:
+        days = HISTORY_DEFAULT_DAYS
+    conn = history_connect()
+    try:
+        last = history_last_timestamp(conn, station_id)
+        now = int(time.time())
+        if last is None:
+            start = now - days * 86400
+        else:
+            start = last + 1
+        iso_format = "%Y-%m-%dT%H:%M:%SZ"
+        url = '{}/stations/{}/observations?start={}&end={}&limit={}' . format(API_URL, station_id,
+                  time.strftime(iso_format, time.gmtime(start)), time.strftime(iso_format, time.gmtime(now)),
+                  HISTORY_PAGE_SIZE)
+
+        stored = 0
+        seen_urls = set()
+        while url and url not in seen_urls:
+            seen_urls.add(url)
+            # pagination comes after the features, tail has it once the
+            # page is done streaming
+            tail = {'pagination': None}
+            rows = []
+            features = 0
+            for feature in urlreq_stream(url, ('features',), tail):
+                features += 1
+                properties = feature.get("properties") or {}
+                if properties.get("timestamp"):
+                    rows.append(history_row(station_id, properties))
+                if len(rows) >= HISTORY_BATCH_SIZE:
+                    with conn:
+                        stored += history_insert(conn, rows)
+                    rows = []
+            if rows:
+                with conn:
+                    stored += history_insert(conn, rows)
+            if not features:
+                break
+            url = (tail['pagination'] or {}).get("next")
+    finally:
+        conn.close()
+    return(stored)
+
+#############################################################################
+# Store the latest observation from a normal run, errors are reported but
+# don't change the exit status since the output was already printed
+#############################################################################
+def record_observation(station_id, observation, stderr=None):
+    if stderr is None:
+        stderr = sys.stderr
+    import sqlite3
+    try:
+        history_record(station_id, as_observation(observation))
+    except (sqlite3.Error, OSError, KeyError, ValueError) as err:
+        print ("{}: unable to record observation: {}" . format(station_id, err), file=stderr)
+
+#############################################################################
+# Query the rollups -- QUERY_FIELDS (next to the argument parser in
+# weather.py) gives the history column and kind of value for each --query
+# name, so results come out in the same units as display_weather_data()
+#############################################################################
+def convert_query_value(value, kind, metricflag=False):
+    if value is None:
+        return(None, '')
+    if kind == 'temp':
+        if metricflag:
+            return(round(value, 1), '°C')
+        return(round(convert_c_to_f(value), 1), '°F')
+    if kind == 'wind':
+        if metricflag:
+            return(round(value, 1), 'km/h')
+        return(round(convert_kmh_to_mph(value), 1), 'mph')
+    if kind == 'pressure':
+        if metricflag:
+            return(round(value / 100, 1), 'hPa')
+        return(round(convert_pa_to_inhg(value), 2), 'in')
+    return(round(value, 1), '%')
+
+# Returns a list of (bucket, count, min, max, mean) in raw API units.  For
+# the 'total' period there is one row covering the whole range, built
+# from the daily rollups.
+def query_history(station_id, field, period, since):
+    conn = history_connect()
+    try:
+        if period == 'total':
+            bucket_period = 'day'
+        else:
+            bucket_period = period
+        start = dict(history_buckets(since))[bucket_period]
+        params = (station_id.upper(), bucket_period, QUERY_FIELDS[field][0], start)
+        if period == 'total':
+            rows = conn.execute("""SELECT min(bucket), sum(n), min(low), max(high), sum(total) / sum(n)
+                                   FROM rollups WHERE station = ? AND period = ? AND field = ? AND bucket >= ?
+                                   HAVING sum(n) > 0""", params).fetchall()
+        else:
+            rows = conn.execute("""SELECT bucket, n, low, high, total / n
+                                   FROM rollups WHERE station = ? AND period = ? AND field = ? AND bucket >= ?
+                                   ORDER BY bucket""", params).fetchall()
+    finally:
+        conn.close()
+    return(rows)
+
+#############################################################################
+# Print query results for a station
+#############################################################################
+def display_history_query(station_id, field, period, days, options, stdout=None):
+    metricflag = options['display_metric']
+    kind = QUERY_FIELDS[field][1]
+    rows = query_history(station_id, field, period, time.time() - days * 86400)
+
+    if period == 'hour':
+        bucket_format = "%m/%d/%Y %H:00"
+    else:
+        bucket_format = "%m/%d/%Y"
+
+    if options['display_headers']:
+        period_name = {'hour': 'hourly', 'day': 'daily', 'total': 'total'}[period]
+        print ("{} for {}, {} over the last {} days" . format(field.capitalize(), station_id.upper(), period_name, days), file=stdout)
+        print ("{:<18}{:>10}{:>10}{:>10}{:>8}" . format('Period' if period != 'total' else 'Since', 'Min', 'Max', 'Mean', 'Count'), file=stdout)
+    for bucket, count, low, high, mean in rows:
+        bucket = time.strftime(bucket_format, time.localtime(bucket))
+        values = []
+        for value in (low, high, mean):
+            value, unit = convert_query_value(value, kind, metricflag)
+            values.append('{}{}' . format(value, unit))
+        if options['display_script']:
+            print ("|" . join([station_id.upper(), bucket] + values + [str(count)]), file=stdout)
+        else:
+            print ("{:<18}{:>10}{:>10}{:>10}{:>8}" . format(bucket, values[0], values[1], values[2], count), file=stdout)
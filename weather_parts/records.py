@@ -0,0 +1,120 @@
+##############################################################################
+# weather_parts/records.py -- --format json/jsonl/msgpack records
+##############################################################################
+import sys
+import json
+from datetime import datetime as dt
+from weather import (
+    COMPASS_SECTORS, FIELD_DESCRIPTORS, ME, as_observation,
+    convert_angle_to_sector, convert_c_to_f, convert_kmh_to_mph,
+    convert_pa_to_inhg, fetch_weather_data_many, get_icon_type,
+    get_sun_events, get_weather_data, get_wx_emoji, timed)
+from weather_parts.history import record_observation
+
+#############################################################################
+# Structured output (--format json/jsonl/msgpack) -- one record per station
+# built straight from the observation, numbers stay numbers and every
+# measurement carries its unit.  The fields are the FIELD_DESCRIPTORS,
+# under their record key.
+#############################################################################
+def record_value(value, kind, metricflag=False):
+    if value is None:
+        return(None)
+    if kind == 'temp':
+        if metricflag:
+            return({'value': round(value, 2), 'unit': 'degC'})
+        return({'value': round(convert_c_to_f(value), 2), 'unit': 'degF'})
+    if kind == 'speed':
+        if metricflag:
+            return({'value': round(value, 2), 'unit': 'km/h'})
+        return({'value': round(convert_kmh_to_mph(value), 2), 'unit': 'mph'})
+    if kind == 'pressure':
+        if metricflag:
+            return({'value': round(value / 100, 2), 'unit': 'hPa'})
+        return({'value': round(convert_pa_to_inhg(value), 2), 'unit': 'inHg'})
+    if kind == 'angle':
+        return({'value': value, 'unit': 'deg', 'compass': COMPASS_SECTORS[round(convert_angle_to_sector(value))]})
+    return({'value': round(value, 2), 'unit': '%'})
+
+@timed('render')
+def observation_record(station_id, options, observation=None):
+    if observation is None:
+        observation = get_weather_data(station_id)
+    observation = as_observation(observation)
+    metricflag = options['display_metric']
+
+    sunrise, sunset = get_sun_events(observation.latitude, observation.longitude)
+    if sunrise is not None:
+        sunrise = dt.fromtimestamp(sunrise).astimezone().isoformat()
+    if sunset is not None:
+        sunset = dt.fromtimestamp(sunset).astimezone().isoformat()
+
+    record = {'station': {'id': observation.station_id, 'name': observation.name, 'latitude': observation.latitude, 'longitude': observation.longitude},
+              'timestamp': observation.timestamp, 'sunrise': sunrise, 'sunset': sunset,
+              'stale': observation.stale}
+
+    # No fields picked on the command line means all of them
+    everything = not any(options[descriptor.option] for descriptor in FIELD_DESCRIPTORS) and not options['display_weather']
+    if everything or options['display_weather']:
+        weather = {'description': observation.description}
+        if options['display_icon']:
+            weather['icon'] = get_wx_emoji(observation.description, get_icon_type(observation.latitude, observation.longitude))
+        record['weather'] = weather
+    for descriptor in FIELD_DESCRIPTORS:
+        if everything or options[descriptor.option]:
+            record[descriptor.record_key] = record_value(getattr(observation, descriptor.field), descriptor.kind, metricflag)
+    return(record)
+
+#############################################################################
+# Write records to stdout as they come in, json is the only format that
+# has to wait for all of them since it prints one document, always an
+# array however many stations made it
+#############################################################################
+def write_records(records, output_format, stdout=None):
+    if output_format == 'msgpack':
+        import msgpack
+        packer = msgpack.Packer()
+        out = (stdout or sys.stdout).buffer
+        for record in records:
+            out.write(packer.pack(record))
+            out.flush()
+    elif output_format == 'jsonl':
+        for record in records:
+            print (json.dumps(record, ensure_ascii=False, separators=(',', ':')), flush=True, file=stdout)
+    else:
+        print (json.dumps(list(records), ensure_ascii=False, indent=2), file=stdout)
+
+#############################################################################
+# --format json/jsonl/msgpack version of the loop above, errors still go to
+# stderr so stdout only ever holds records
+#############################################################################
+def run_weather_records(args, station_ids, display_options, stdout=None, stderr=None):
+    if stderr is None:
+        stderr = sys.stderr
+    if args.format == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            print ("{}: --format msgpack needs the msgpack module" . format(ME), file=stderr)
+            return(1)
+
+    failed = []
+    def records():
+        for station_id, observation, err in fetch_weather_data_many(station_ids, args.jobs, args.as_completed):
+            if err is None:
+                try:
+                    record = observation_record(station_id, display_options, observation)
+                except (LookupError, TypeError, ValueError) as render_err:
+                    err = render_err
+            if err is not None:
+                print ("{}|error: {}" . format(station_id, err), file=stderr)
+                failed.append(station_id)
+                continue
+            yield record
+            if args.record:
+                record_observation(station_id, observation, stderr)
+
+    write_records(records(), args.format, stdout)
+    if failed:
+        return(1)
+    return(0)
@@ -0,0 +1,169 @@
+##############################################################################
+# weather_parts/stream.py -- streaming JSON responses for the station
+# catalog, --hourly, --sync-history and --watch
+##############################################################################
+import json
+import weather
+from weather import (
+    HTTP_CONNECT_TIMEOUT, HTTP_STREAM_CHUNK, check_api_status,
+    get_http_session, timing_begin, timing_end, timing_pop, WeatherAPIError)
+
+#############################################################################
+# Streaming JSON -- iter_json_array() walks a JSON document arriving in
+# chunks and yields the elements of the array at path (a tuple of object
+# keys) one at a time, so only one element plus a chunk is ever held in
+# memory.  Top level keys named in tail (e.g. {'pagination': None}) are
+# filled in as they go past; anything else is parsed and dropped.  A
+# level of path may be a set of keys, then the arrays under each of them
+# are walked in the one pass and (key, element) pairs are yielded.
+#############################################################################
+JSON_WHITESPACE = ' \t\n\r'
+JSON_DELIMITERS = ',:]}' + JSON_WHITESPACE
+
+
+def iter_json_array(chunks, path, tail=None):
+    import codecs
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    state = {'buf': '', 'pos': 0, 'eof': False}
+
+    def more():
+        if state['eof']:
+            raise ValueError("unexpected end of JSON stream")
+        # Drop what we have already consumed before growing the buffer
+        state['buf'] = state['buf'][state['pos']:]
+        state['pos'] = 0
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            state['eof'] = True
+            state['buf'] += utf8.decode(b'', final=True)
+            return
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk)
+        state['buf'] += chunk
+
+    def peek():
+        while True:
+            buf = state['buf']
+            pos = state['pos']
+            while pos < len(buf) and buf[pos] in JSON_WHITESPACE:
+                pos += 1
+            state['pos'] = pos
+            if pos < len(buf):
+                return(buf[pos])
+            if state['eof']:
+                return('')
+            more()
+
+    def expect(char):
+        if peek() != char:
+            raise ValueError("expected {!r} in JSON stream" . format(char))
+        state['pos'] += 1
+
+    def value():
+        peek()
+        while True:
+            try:
+                decoded, end = decoder.raw_decode(state['buf'], state['pos'])
+            except json.JSONDecodeError:
+                more()
+                continue
+            # A number cut off by the end of the buffer ("-2", "12.") decodes
+            # fine, so only trust a value that is followed by a delimiter
+            buf = state['buf']
+            if not state['eof'] and (end == len(buf) or buf[end] not in JSON_DELIMITERS):
+                more()
+                continue
+            state['pos'] = end
+            return(decoded)
+
+    keyed = any(isinstance(keys, (set, frozenset)) for keys in path)
+
+    def walk(level, found):
+        expect('{')
+        if peek() == '}':
+            state['pos'] += 1
+            return
+        while True:
+            key = value()
+            expect(':')
+            last = level == len(path) - 1
+            if isinstance(path[level], (set, frozenset)):
+                match = key in path[level]
+                if match:
+                    found = key
+            else:
+                match = key == path[level]
+            if match and last and peek() == '[':
+                state['pos'] += 1
+                if peek() == ']':
+                    state['pos'] += 1
+                else:
+                    while True:
+                        if keyed:
+                            yield (found, value())
+                        else:
+                            yield value()
+                        char = peek()
+                        state['pos'] += 1
+                        if char == ']':
+                            break
+                        if char != ',':
+                            raise ValueError("expected ',' or ']' in JSON stream")
+            elif match and not last and peek() == '{':
+                yield from walk(level + 1, found)
+            elif level == 0 and tail is not None and key in tail:
+                tail[key] = value()
+            else:
+                value()
+            char = peek()
+            state['pos'] += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError("expected ',' or '}' in JSON stream")
+
+    yield from walk(0, None)
+
+#############################################################################
+# GET api_endpoint without reading the whole body and yield the elements of
+# the array at path as they are parsed.  Streamed responses bypass the
+# cache, they are the ones too big to be worth keeping.
+#############################################################################
+def urlreq_stream(api_endpoint, path, tail=None):
+    if weather.OFFLINE_BUNDLE is not None:
+        from weather_parts.bundle import bundle_raw
+        try:
+            yield from iter_json_array([bundle_raw(api_endpoint)], path, tail)
+        except ValueError as err:
+            raise WeatherAPIError("Invalid JSON in the offline bundle for {}: {}" . format(api_endpoint, err))
+        return
+
+    import requests
+    session = get_http_session()
+    headers = {"Content-Type": "application/json", "User-Agent": "weather.py, weather_py@malato.org"}
+    timeout = (HTTP_CONNECT_TIMEOUT, weather.HTTP_READ_TIMEOUT)
+    # A generator cannot be @timed, the record only collects the connection
+    # timings during the request and is finished once the body is read
+    record = None
+    try:
+        if weather.TIMINGS is not None:
+            record = timing_begin('stream', url=api_endpoint)
+        with session.get(api_endpoint, headers=headers, timeout=timeout, stream=True) as response:
+            if record is not None:
+                timing_pop(record)
+                record['status'] = response.status_code
+            check_api_status(response)
+            chunks = response.iter_content(HTTP_STREAM_CHUNK)
+            yield from iter_json_array(chunks, path, tail)
+            if record is not None:
+                record['wire_bytes'] = response.raw.tell()
+    except requests.exceptions.RequestException as err:
+        raise WeatherAPIError("Unable to reach {}: {}" . format(api_endpoint, err))
+    except ValueError as err:
+        raise WeatherAPIError("Invalid JSON from {}: {}" . format(api_endpoint, err))
+    finally:
+        if record is not None:
+            timing_end(record)
@@ -0,0 +1,177 @@
+##############################################################################
+# weather_parts/watch.py -- --watch, following each station's report cadence
+##############################################################################
+import sys
+import time
+import collections
+from weather import (
+    API_URL, ME, WATCH_DEFAULT_LAG, WATCH_DEFAULT_PERIOD, WATCH_JITTER,
+    WATCH_LAG_STEP, WATCH_MARGIN, WATCH_MAX_INTERVAL, WATCH_MIN_INTERVAL,
+    WATCH_SEED_COUNT, display_weather_data, fetch_weather_data_many,
+    parse_iso_timestamp, print_weather_data, WeatherAPIError)
+from weather_parts.stream import urlreq_stream
+from weather_parts.records import observation_record, write_records
+from weather_parts.history import record_observation
+
+#############################################################################
+# --watch -- stay resident and fetch each station just after its next
+# report is expected, printing only when the values change.  The cadence
+# is learned from observation timestamps: routine reports come every
+# period seconds at the same offset into it (e.g. :53 past the hour) and
+# specials in between are ignored by taking the most common gap/offset.
+# lag is how long after its timestamp an observation shows up in the API.
+#############################################################################
+def watch_seed(station_id):
+    # Recent observation timestamps to learn the cadence from
+    iso_format = "%Y-%m-%dT%H:%M:%SZ"
+    now = int(time.time())
+    url = '{}/stations/{}/observations?start={}&end={}&limit={}' . format(API_URL, station_id,
+              time.strftime(iso_format, time.gmtime(now - 86400)), time.strftime(iso_format, time.gmtime(now)),
+              WATCH_SEED_COUNT)
+    timestamps = []
+    for feature in urlreq_stream(url, ('features',)):
+        timestamp = (feature.get("properties") or {}).get("timestamp")
+        if timestamp:
+            timestamps.append(parse_iso_timestamp(timestamp))
+    return(sorted(set(timestamps)))
+
+def watch_cadence(timestamps):
+    import collections
+    period = WATCH_DEFAULT_PERIOD
+    # Report intervals are whole multiples of five minutes, rounding the
+    # gaps to that keeps a minute of jitter from splitting the vote
+    gaps = [round((b - a) / 300) * 300 for a, b in zip(timestamps, timestamps[1:])]
+    gaps = [gap for gap in gaps if gap > 0]
+    if len(gaps) >= 3:
+        period = collections.Counter(gaps).most_common(1)[0][0]
+    offsets = collections.Counter((round(t / 60) * 60) % period for t in timestamps)
+    offset = offsets.most_common(1)[0][0]
+    return(period, offset)
+
+def watch_slot(timestamp, cadence):
+    # The routine report time nearest timestamp
+    period, offset = cadence
+    slot = timestamp - (timestamp % period) + offset
+    if slot - timestamp > period / 2:
+        slot -= period
+    elif timestamp - slot > period / 2:
+        slot += period
+    return(slot)
+
+def watch_schedule(state, now):
+    # Next routine report after the newest one we have, plus the lag.  If
+    # the newest one was a routine report (give or take some jitter) the
+    # next is a period later, after a special it's the nearest slot ahead.
+    last = state['timestamps'][-1]
+    period, offset = state['cadence']
+    expected = watch_slot(last, state['cadence'])
+    if expected <= last + min(WATCH_JITTER, period / 4):
+        expected += period
+    due = expected + state['lag'] + WATCH_MARGIN
+
+    if state['misses']:
+        # Nothing new yet, back off but don't sleep past the next report
+        retry = now + min(WATCH_MIN_INTERVAL * 2 ** (state['misses'] - 1), WATCH_MAX_INTERVAL)
+        if due > now:
+            return(min(due, retry))
+        return(retry)
+    return(max(due, now + WATCH_MIN_INTERVAL))
+
+def watch_update(state, timestamp, now):
+    if state['last_poll'] is None:
+        # First fetch, the seeded timestamps already cover this one
+        if not state['timestamps'] or timestamp > state['timestamps'][-1]:
+            state['timestamps'].append(timestamp)
+        state['cadence'] = watch_cadence(state['timestamps'])
+        state['last_poll'] = now
+        return(True)
+    if timestamp <= state['timestamps'][-1]:
+        state['misses'] += 1
+        state['last_poll'] = now
+        return(False)
+
+    # It showed up somewhere between the last poll and now.  If the first
+    # poll already had it try a little earlier next time, otherwise move
+    # the lag to the middle of that window.  The lag is counted from the
+    # routine slot so late reports push it out too, specials don't count.
+    slot = watch_slot(timestamp, state['cadence'])
+    if abs(timestamp - slot) <= min(WATCH_JITTER, state['cadence'][0] / 4):
+        if state['misses']:
+            state['lag'] = (max(state['last_poll'] - slot, 0) + (now - slot)) / 2
+        else:
+            state['lag'] = max(0, min(state['lag'], now - slot) - WATCH_LAG_STEP)
+    state['timestamps'].append(timestamp)
+    del state['timestamps'][:-WATCH_SEED_COUNT]
+    state['cadence'] = watch_cadence(state['timestamps'])
+    state['misses'] = 0
+    state['last_poll'] = now
+    return(True)
+
+def watch_render(station_id, observation, options, output_format, multi_station):
+    # Returns the values to compare and the text to print if they changed,
+    # the observation timestamp alone changing is not worth printing
+    import contextlib
+    import io
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        if output_format == 'text':
+            values = display_weather_data(station_id, options, observation)
+            print_weather_data(station_id, values, options, multi_station)
+        else:
+            record = observation_record(station_id, options, observation)
+            values = {key: value for key, value in record.items() if key not in ('timestamp', 'sunrise', 'sunset')}
+            write_records([record], output_format)
+    return(values, out.getvalue())
+
+def run_watch(args, station_ids, display_options):
+    if args.format == 'msgpack':
+        print ("{}: --watch prints text, json or jsonl" . format(ME), file=sys.stderr)
+        return(1)
+
+    multi_station = len(station_ids) > 1
+    states = {}
+    now = time.time()
+    for station_id in station_ids:
+        try:
+            timestamps = watch_seed(station_id)
+        except WeatherAPIError as err:
+            print ("{}: unable to learn report cadence: {}" . format(station_id, err), file=sys.stderr)
+            timestamps = []
+        states[station_id] = {'timestamps': timestamps, 'cadence': None, 'lag': WATCH_DEFAULT_LAG,
+                              'misses': 0, 'last_poll': None, 'values': None, 'next': now}
+
+    try:
+        while True:
+            now = time.time()
+            due = [station_id for station_id in station_ids if states[station_id]['next'] <= now]
+            if not due:
+                time.sleep(max(0, min(state['next'] for state in states.values()) - now))
+                continue
+
+            for station_id, observation, err in fetch_weather_data_many(due, args.jobs, revalidate=True):
+                state = states[station_id]
+                now = time.time()
+                if err is None:
+                    try:
+                        timestamp = parse_iso_timestamp(observation[1]["properties"]["timestamp"])
+                        changed = watch_update(state, timestamp, now)
+                        if changed:
+                            values, text = watch_render(station_id, observation, display_options, args.format, multi_station)
+                    except (LookupError, TypeError, ValueError) as render_err:
+                        err = render_err
+                if err is not None:
+                    print ("{}|error: {}" . format(station_id, err), file=sys.stderr)
+                    state['misses'] += 1
+                    state['next'] = now + min(WATCH_MIN_INTERVAL * 2 ** (state['misses'] - 1), WATCH_MAX_INTERVAL)
+                    continue
+                if changed:
+                    if values != state['values']:
+                        sys.stdout.write(text)
+                        sys.stdout.flush()
+                        state['values'] = values
+                    if args.record:
+                        record_observation(station_id, observation)
+                state['next'] = watch_schedule(state, now)
+    except KeyboardInterrupt:
+        pass
+    return(0)